@@ -0,0 +1,186 @@
+"""
+accounting
+
+Resource accounting for child processes: CPU time, peak memory and bytes read
+and written by each program run on behalf of a job, recorded to a per-job
+log for capacity planning.
+"""
+
+import os
+import json
+import time
+import errno
+import ctypes
+import thread
+
+from common_util import Warn, Babble
+
+
+###########################
+# Reaping children        #
+###########################
+
+
+P_PID   = 1
+WEXITED = 0x00000004
+WNOHANG = 0x00000001
+WNOWAIT = 0x01000000
+
+
+class _SigChld(ctypes.Structure):
+    _fields_ = [('si_pid',    ctypes.c_int),
+                ('si_uid',    ctypes.c_uint),
+                ('si_status', ctypes.c_int),
+                ('si_utime',  ctypes.c_long),
+                ('si_stime',  ctypes.c_long)]
+
+class _SigInfo(ctypes.Structure):
+    # the kernel's siginfo_t is 128 bytes; we only look at the SIGCHLD fields
+    _fields_ = [('si_signo', ctypes.c_int),
+                ('si_errno', ctypes.c_int),
+                ('si_code',  ctypes.c_int),
+                ('sigchld',  _SigChld),
+                ('_pad',     ctypes.c_byte * 128)]
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+
+def waitExited(pid, block=True):
+    """Wait for child <pid> to exit *without* reaping it, so that its /proc
+    entry can still be read. Returns True if the child has exited. If <block>
+    is False, returns False immediately if the child is still running."""
+    opts = WEXITED | WNOWAIT | (0 if block else WNOHANG)
+    while True:
+        info = _SigInfo()
+        if _libc.waitid(P_PID, pid, ctypes.byref(info), opts) == 0:
+            return info.sigchld.si_pid == pid
+        err = ctypes.get_errno()
+        if err != errno.EINTR:
+            raise OSError(err, os.strerror(err))
+
+
+def readProcIO(pid):
+    """Return the I/O counters of process <pid> from /proc/<pid>/io as a
+    dictionary, or {} if they are not available."""
+    counters = {}
+    try:
+        with open('/proc/%d/io' % pid, 'r') as f:
+            for line in f:
+                key, val = line.split(':', 1)
+                counters[key.strip()] = int(val)
+    except (IOError, ValueError):
+        pass
+    return counters
+
+
+def reap(pid):
+    """Reap the exited child <pid>, returning (status, rusage)."""
+    while True:
+        try:
+            rpid, status, rusage = os.wait4(pid, 0)
+            return status, rusage
+        except OSError, err:
+            if err.errno != errno.EINTR:
+                raise
+
+
+###########################
+# Accounting records      #
+###########################
+
+
+class ResourceRecord(object):
+    """Resources consumed by one child process."""
+
+    def __init__(self, tool, args, jobID, stage, pid, returncode, wallTime,
+                 rusage, io):
+        self.tool       = tool
+        self.args       = args
+        self.jobID      = jobID
+        self.stage      = stage
+        self.pid        = pid
+        self.returncode = returncode
+        self.finished   = time.time()
+        self.wallTime   = wallTime
+        self.userTime   = rusage.ru_utime
+        self.sysTime    = rusage.ru_stime
+        self.maxRSS     = rusage.ru_maxrss * 1024   # bytes; linux reports KB
+        # bytes which actually hit the storage layer
+        self.bytesRead    = io.get('read_bytes')
+        self.bytesWritten = io.get('write_bytes')
+        # bytes passed through read()/write(), including pipes and page cache
+        self.charsRead    = io.get('rchar')
+        self.charsWritten = io.get('wchar')
+
+    def asDict(self):
+        return dict(self.__dict__)
+
+    def __str__(self):
+        return ("%s (%s/%s): wall %.1fs, cpu %.1fs, peak rss %dMB, "
+                "read %s, written %s" % (self.tool, self.jobID, self.stage,
+                self.wallTime, self.userTime + self.sysTime,
+                self.maxRSS >> 20, _fmtBytes(self.bytesRead),
+                _fmtBytes(self.bytesWritten)))
+
+
+def _fmtBytes(n):
+    if n is None:
+        return '?'
+    return '%dMB' % (n >> 20)
+
+
+class Accountant:
+    """Appends the ResourceRecord of every child process to a log in
+    <logDir> named after the record's job; one JSON object per line."""
+
+    def __init__(self, logDir):
+        self.logDir = logDir
+        self._lock = thread.allocate_lock()
+
+    def logPath(self, jobID):
+        return os.path.join(self.logDir, "%s.acct" % jobID)
+
+    def record(self, rec):
+        Babble(str(rec))
+        line = json.dumps(rec.asDict(), sort_keys=True) + "\n"
+        try:
+            with self._lock:
+                if not os.path.isdir(self.logDir):
+                    os.makedirs(self.logDir)
+                with open(self.logPath(rec.jobID or 'nojob'), 'a') as f:
+                    f.write(line)
+        except (IOError, OSError), err:
+            # losing a record is no reason to fail a rip
+            Warn("Could not write accounting record for %s (%s)" % 
+                 (rec.jobID, err))
+
+    def beginJob(self, jobID):
+        """Start the log of the new job <jobID> afresh, so that it never
+        holds the records of an earlier job of the same ID. (A resumed job
+        keeps its log.)"""
+        try:
+            with self._lock:
+                os.unlink(self.logPath(jobID))
+        except OSError:
+            pass
+
+    def jobRecords(self, jobID):
+        """Return the records logged for <jobID>, as dictionaries."""
+        recs = []
+        path = self.logPath(jobID)
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    recs.append(json.loads(line))
+        return recs
+
+    def summarize(self, jobID):
+        """Return a one-line summary of the resources used by <jobID>."""
+        recs = self.jobRecords(jobID)
+        cpu  = sum(r['userTime'] + r['sysTime'] for r in recs)
+        rss  = max([r['maxRSS'] for r in recs] or [0])
+        rd   = sum(r['bytesRead'] or 0 for r in recs)
+        wr   = sum(r['bytesWritten'] or 0 for r in recs)
+        return ("%s: %d processes, cpu %.0fs, peak rss %dMB, read %dMB, "
+                "written %dMB" % (jobID, len(recs), cpu, rss >> 20, 
+                                  rd >> 20, wr >> 20))
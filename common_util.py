@@ -44,3 +44,16 @@ def uniquePath(p):
         p  = os.path.join(path, "%s.%d%s" % (base, n, ext))
         n += 1
     return p
+
+
+def strsFromJSON(obj):
+    """Convert the unicode strings in <obj>, as produced by the json module, 
+    back to (utf-8) strs."""
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    elif isinstance(obj, list):
+        return [strsFromJSON(x) for x in obj]
+    elif isinstance(obj, dict):
+        return dict((strsFromJSON(k), strsFromJSON(v)) 
+                    for k, v in obj.iteritems())
+    return obj
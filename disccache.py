@@ -0,0 +1,210 @@
+"""
+disccache
+
+A persistent cache of disc properties (the output of slow disc scans), so
+that a disc which is re-inserted, e.g. after a failed rip, need not be
+scanned again.
+
+Entries are keyed by a fingerprint computed from cheap UDisks properties of
+the disc. Because those can collide (many discs are labelled "DVD_VIDEO"),
+each entry also records a hash of the disc's volume descriptors, which is
+checked before the entry is used. The least recently used entries are evicted
+once the cache grows beyond its size limit.
+"""
+
+import os
+import json
+import time
+import struct
+import hashlib
+import tempfile
+import thread
+
+from common_util import Warn, Babble, strsFromJSON
+
+
+# bump this when the format of cached scan results changes
+CACHE_VERSION = 1
+
+# UDisks properties which identify a disc
+FINGERPRINT_PROPERTIES = ('IdLabel', 'IdUuid', 'DeviceSize', 'DriveMedia')
+
+SECTOR_SIZE = 2048
+
+
+###########################
+# Disc identification     #
+###########################
+
+
+def discFingerprint(devprops):
+    """Return a fingerprint of the disc described by the UDisks properties
+    <devprops>, or None if the disc cannot be identified."""
+    if not devprops.get('IdLabel') and not devprops.get('IdUuid'):
+        return None
+    h = hashlib.sha1()
+    for prop in FINGERPRINT_PROPERTIES:
+        h.update("%s=%s\n" % (prop, devprops.get(prop, '')))
+    return h.hexdigest()
+
+
+def volumeDescriptorHash(device):
+    """Return a hash of the volume descriptors of the disc in <device>, or None
+    if they cannot be read. This needs to read only a few sectors.
+
+    Covered are the ISO 9660 volume descriptors (which carry the volume's
+    creation time) and the UDF main volume descriptor sequence, located through
+    the anchor at sector 256 (which carries the UDF volume set identifier)."""
+    h = hashlib.sha1()
+    try:
+        with open(device, 'rb') as f:
+            f.seek(16 * SECTOR_SIZE)
+            h.update(f.read(16 * SECTOR_SIZE))
+            f.seek(256 * SECTOR_SIZE)
+            anchor = f.read(SECTOR_SIZE)
+            if len(anchor) == SECTOR_SIZE and \
+                    struct.unpack('<H', anchor[0:2])[0] == 2:
+                # anchor volume descriptor pointer; main VDS extent follows
+                # the 16-byte descriptor tag
+                length, location = struct.unpack('<II', anchor[16:24])
+                f.seek(location * SECTOR_SIZE)
+                h.update(f.read(min(length, 16 * SECTOR_SIZE)))
+    except (IOError, OSError), err:
+        Babble("Could not read volume descriptors of %s (%s)" % (device, err))
+        return None
+    return h.hexdigest()
+
+
+###########################
+# Cache                   #
+###########################
+
+
+class DiscCache:
+    """Scan results of up to <maxEntries> discs, stored in <cacheDir> as one
+    JSON file per disc and kind of scan."""
+
+    def __init__(self, cacheDir, maxEntries=200):
+        self.cacheDir   = cacheDir
+        self.maxEntries = maxEntries
+        self._lock      = thread.allocate_lock()
+
+    def forDisc(self, fingerprint, device):
+        """Return a CachedDisc for the disc with <fingerprint> in <device>."""
+        return CachedDisc(self, fingerprint, device)
+
+    def _path(self, fingerprint, kind):
+        return os.path.join(self.cacheDir, "%s.%s.json" % (fingerprint, kind))
+
+    def get(self, fingerprint, kind, validator):
+        """Return the cached <kind> scan data of the disc with <fingerprint>,
+        or None if there is none, or it is stale or was recorded for a disc
+        with different volume descriptors than <validator>."""
+        path = self._path(fingerprint, kind)
+        with self._lock:
+            try:
+                with open(path, 'r') as f:
+                    entry = json.load(f)
+            except IOError:
+                return None
+            except ValueError:
+                Warn("Discarding corrupt disc cache entry %s" % path)
+                self._remove(path)
+                return None
+
+            if entry.get('version') != CACHE_VERSION or \
+                    entry.get('kind') != kind or \
+                    entry.get('validator') != validator:
+                Babble("Disc cache entry %s is stale" % path)
+                self._remove(path)
+                return None
+            # mark as recently used
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+        return strsFromJSON(entry['data'])
+
+    def put(self, fingerprint, kind, validator, data):
+        """Store the <kind> scan data of the disc with <fingerprint>. Failure
+        to do so is logged, but not fatal."""
+        entry = {'version'   : CACHE_VERSION,
+                 'kind'      : kind,
+                 'validator' : validator,
+                 'created'   : time.time(),
+                 'data'      : data}
+        path = self._path(fingerprint, kind)
+        with self._lock:
+            try:
+                if not os.path.isdir(self.cacheDir):
+                    os.makedirs(self.cacheDir)
+                # write to a temp file and rename it into place, so that
+                # readers never see a partially written entry
+                fd, tmp = tempfile.mkstemp(dir=self.cacheDir, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(entry, f)
+                    os.rename(tmp, path)
+                except:
+                    self._remove(tmp)
+                    raise
+                self._evict()
+            except (IOError, OSError, TypeError, ValueError), err:
+                Warn("Could not cache properties of disc %s (%s)" %
+                     (fingerprint, err))
+
+    def invalidate(self, fingerprint, kind):
+        with self._lock:
+            self._remove(self._path(fingerprint, kind))
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """Remove the least recently used entries beyond maxEntries."""
+        entries = []
+        for fname in os.listdir(self.cacheDir):
+            path = os.path.join(self.cacheDir, fname)
+            if fname.endswith('.json'):
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+        entries.sort(reverse=True)
+        for mtime, path in entries[self.maxEntries:]:
+            Babble("Evicting disc cache entry %s" % path)
+            self._remove(path)
+
+
+class CachedDisc:
+    """The cache entries of one disc. The disc's volume descriptors are read
+    (once) when the cache is first consulted."""
+
+    def __init__(self, cache, fingerprint, device):
+        self.cache       = cache
+        self.fingerprint = fingerprint
+        self.device      = device
+        self._validator  = None
+        self._validated  = False
+
+    def validator(self):
+        if not self._validated:
+            self._validator = volumeDescriptorHash(self.device)
+            self._validated = True
+        return self._validator
+
+    def load(self, kind):
+        """Return the cached <kind> scan data of this disc, or None."""
+        data = self.cache.get(self.fingerprint, kind, self.validator())
+        if data is not None:
+            Babble("Using cached %s properties of %s" % (kind, self.device))
+        return data
+
+    def store(self, kind, data):
+        self.cache.put(self.fingerprint, kind, self.validator(), data)
+
+    def invalidate(self, kind):
+        self.cache.invalidate(self.fingerprint, kind)
@@ -7,10 +7,10 @@ Module for monitoring optical drives.
 import os, sys
 import dbus
 import gobject
-import thread
 from dbus.mainloop import glib
 
 from common_util import Error, Warn, Msg, Babble, Die
+from disccache import discFingerprint
 
 
 ###########################
@@ -72,22 +72,24 @@ def deviceChangedCallback(bus, dev_name, dev_path, ripper):
                                 'OpticalDiscIsBlank')]
     disc_kind = devprops['DriveMedia']
     if closed and avail and not blank:
-        # each rip job gets its own thread.
+        # each rip is submitted as a job, which runs apart from this thread.
         # we do this so that we don't block the udev monitoring loop, and
-        # also any exceptions in the rip thread will not terminate the main
+        # also any exceptions in the rip job will not terminate the main
         # daemon thread.
         
         discID = None
         if 'IdLabel' in devprops:
             discID = devprops['IdLabel']
+        # identifies the disc to the disc cache
+        fingerprint = discFingerprint(devprops)
         
         if 'optical_bd' in disc_kind:
             Msg('blu-ray inserted into %s' % dev_name)
-            # call ripper.ripBluRay in a dedicated thread, passing dev_name
-            thread.start_new_thread(ripper.ripBluRay, (dev_name, discID))
+            # have the ripper run ripper.ripBluRay as a job, passing dev_name
+            ripper.submitJob(ripper.ripBluRay, (dev_name, discID, fingerprint))
         elif 'optical_dvd' in disc_kind:
             Msg('dvd inserted into %s' % dev_name)
-            thread.start_new_thread(ripper.ripDVD, (dev_name, discID))
+            ripper.submitJob(ripper.ripDVD, (dev_name, discID, fingerprint))
         else:
             Msg('%s inserted into %s; not ripping' % (disc_kind, dev_name))
 
@@ -0,0 +1,311 @@
+"""
+diskspace
+
+Admission control for disk space. Before a job writes a large amount of data
+(a rip, an intermediate encode, a remux), it reserves its estimated peak
+footprint on the filesystem it will write to. Reservations of all running
+jobs are counted against the free space of each filesystem, and a job whose
+footprint does not fit waits in a FIFO queue until space is freed, rather
+than filling the disk and failing hours later.
+"""
+
+import os
+import time
+import threading
+import collections
+
+from common_util import Msg, Warn
+
+
+# seconds between re-checks of free space while jobs are waiting; space may
+# be freed by anybody, so we can't rely on being notified
+RECHECK_INTERVAL = 30
+
+# largest amount of data on a (dual layer) DVD
+DVD_MAX_BYTES = 8547991552
+
+# allowance for estimates which are a bit off
+ESTIMATE_MARGIN = 1.1
+
+
+class InsufficientSpace(Exception):
+    pass
+
+
+def fsFree(path):
+    """Return the bytes available to us on the filesystem containing <path>."""
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def fsSize(path):
+    st = os.statvfs(path)
+    return st.f_blocks * st.f_frsize
+
+
+def _existingDir(path):
+    """Return <path>, or its nearest ancestor which exists."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def _sizeOfFiles(paths, dev):
+    """Return the total size of the files in (or under) <paths> which are on
+    the device <dev>."""
+    total = 0
+    for path in paths:
+        if os.path.isfile(path):
+            walk = [(os.path.dirname(path), [], [os.path.basename(path)])]
+        else:
+            walk = os.walk(path)
+        for d, subdirs, files in walk:
+            for f in files:
+                try:
+                    st = os.lstat(os.path.join(d, f))
+                except OSError:
+                    continue
+                if st.st_dev == dev:
+                    total += st.st_blocks * 512
+    return total
+
+
+class Reservation:
+    """Space reserved on one filesystem for the output of a job.
+
+    If <watch> paths are given, whatever has already been written to them
+    counts against the reservation, since statvfs() no longer reports that
+    space as free."""
+
+    def __init__(self, manager, dev, path, nbytes, label, watch, requested):
+        self.manager = manager
+        self.dev     = dev
+        self.path    = path
+        self.requested = requested      # the path asked for
+        self.nbytes  = nbytes
+        self.label   = label
+        self.watch   = list(watch)
+
+    def outstanding(self):
+        """Return the bytes reserved but not yet written."""
+        if not self.watch:
+            return self.nbytes
+        return max(0, self.nbytes - _sizeOfFiles(self.watch, self.dev))
+
+    def update(self, less=0, watch=()):
+        """Give up <less> (estimated) bytes of the reservation, for output
+        which went elsewhere after all, and count what is written to the
+        paths <watch> against it as well."""
+        self.manager.update(self, less, watch)
+
+    def release(self):
+        self.manager.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, tb):
+        self.release()
+
+
+class ReservationSet:
+    """Reservations taken together by SpaceManager.reserveAll()."""
+
+    def __init__(self, reservations):
+        self.reservations = reservations
+
+    def update(self, path, less=0, watch=()):
+        """As Reservation.update(), for the reservation requested on <path>."""
+        path = os.path.abspath(path)
+        for rsv in self.reservations:
+            if rsv.requested == path:
+                rsv.update(less, watch)
+                return
+
+    def release(self):
+        for rsv in self.reservations:
+            rsv.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, tb):
+        self.release()
+
+
+class SpaceManager:
+    """Holds the space reservations of all running jobs, on any number of
+    filesystems. <minFree> bytes are always left free on every filesystem."""
+
+    def __init__(self, minFree=0):
+        self.minFree  = minFree
+        self._cond    = threading.Condition()
+        self._held    = collections.defaultdict(list)   # dev -> [Reservation]
+        self._queues  = collections.defaultdict(collections.deque)
+
+    def reserve(self, path, nbytes, label='', watch=()):
+        """Block until <nbytes> can be written to the filesystem containing
+        <path> (which need not exist yet) without encroaching on the space
+        reserved by others, then return a Reservation, which must be
+        released when the job's output has been written (or removed).
+
+        Raises InsufficientSpace if the filesystem is too small to ever hold
+        <nbytes>."""
+        return self.reserveAll([(path, nbytes, watch)], label).reservations[0]
+
+    def reserveAll(self, requests, label='', wait=True):
+        """As reserve(), for all of <requests>, a list of (path, nbytes,
+        watch), at once: a job which writes to several places must reserve
+        them together, or, while holding its first reservation, it may wait
+        forever for space that reservation itself takes up. Requests on the
+        same filesystem are summed. Returns a ReservationSet.
+
+        If <wait> is False, returns None rather than wait (or raise
+        InsufficientSpace) when the requests cannot be granted at once."""
+        rsvs = []
+        total = collections.defaultdict(int)    # dev -> bytes
+        where = {}                              # dev -> path
+        for path, nbytes, watch in requests:
+            requested = os.path.abspath(path)
+            path = _existingDir(path)
+            dev  = os.stat(path).st_dev
+            nbytes = int(nbytes * ESTIMATE_MARGIN)
+            rsvs.append(Reservation(self, dev, path, nbytes, label, watch,
+                                    requested))
+            total[dev] += nbytes
+            where.setdefault(dev, path)
+        for dev, nbytes in total.iteritems():
+            if nbytes + self.minFree > fsSize(where[dev]):
+                if not wait:
+                    return None
+                raise InsufficientSpace("%s needs %dMB on %s, which is "
+                                        "smaller" % (label, nbytes >> 20,
+                                                     where[dev]))
+        with self._cond:
+            if not wait and not all(not self._queues[dev] and
+                                    total[dev] <= self.available(where[dev])
+                                    for dev in total):
+                # others are waiting, or there is no room
+                return None
+            # queued on every filesystem at once, so that jobs are in the
+            # same order on all of them, and cannot wait on each other
+            for dev in total:
+                self._queues[dev].append(rsvs)
+            t_queued = time.time()
+            announced = False
+            while not all(self._queues[dev][0] is rsvs and
+                          total[dev] <= self.available(where[dev])
+                          for dev in total):
+                if not announced:
+                    Msg("Waiting for space for %s: %s" % (label, ", ".join(
+                        "%dMB on %s (%dMB free)" %
+                        (total[dev] >> 20, where[dev],
+                         self.available(where[dev]) >> 20)
+                        for dev in total)))
+                    announced = True
+                self._cond.wait(RECHECK_INTERVAL)
+            for dev in total:
+                self._queues[dev].popleft()
+            for rsv in rsvs:
+                self._held[rsv.dev].append(rsv)
+            self._cond.notify_all()
+        if announced:
+            Msg("Reserved space for %s after waiting %d seconds" %
+                (label, time.time() - t_queued))
+        return ReservationSet(rsvs)
+
+    def update(self, rsv, less=0, watch=()):
+        with self._cond:
+            rsv.nbytes = max(0, rsv.nbytes - int(less * ESTIMATE_MARGIN))
+            rsv.watch.extend(watch)
+            self._cond.notify_all()
+
+    def release(self, rsv):
+        with self._cond:
+            held = self._held[rsv.dev]
+            if rsv in held:
+                held.remove(rsv)
+            self._cond.notify_all()
+
+    def available(self, path):
+        """Return the bytes free on the filesystem containing <path>, less
+        what is reserved for others and not yet written."""
+        path = _existingDir(path)
+        dev  = os.stat(path).st_dev
+        with self._cond:
+            reserved = sum(r.outstanding() for r in self._held[dev])
+        return fsFree(path) - reserved - self.minFree
+
+    def reservations(self):
+        """Return [(label, path, reserved bytes, outstanding bytes)] for all
+        held reservations."""
+        with self._cond:
+            return [(r.label, r.path, r.nbytes, r.outstanding())
+                    for held in self._held.itervalues() for r in held]
+
+
+class _NoReservation:
+    """Stands in for a Reservation when space is not being managed."""
+
+    def update(self, *args, **kwargs):
+        pass
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, tb):
+        pass
+
+
+def reserve(manager, path, nbytes, label='', watch=()):
+    """As manager.reserve(), but <manager> may be None, in which case nothing
+    is reserved."""
+    if manager is None or nbytes is None:
+        return _NoReservation()
+    return manager.reserve(path, nbytes, label, watch)
+
+
+def reserveAll(manager, requests, label=''):
+    """As manager.reserveAll(), but <manager> may be None, and requests of
+    None bytes are dropped, in which cases nothing is reserved for them."""
+    requests = [(path, nbytes, watch) for path, nbytes, watch in requests
+                if nbytes is not None]
+    if manager is None or not requests:
+        return _NoReservation()
+    return manager.reserveAll(requests, label)
+
+
+###########################
+# Footprint estimates     #
+###########################
+
+
+def moveFootprint(dst_dir, src_file_dir):
+    """Return the fraction of a file which must be reserved in <dst_dir> to
+    move it there from <src_file_dir>: 0 if the move is a rename, 1 if it is
+    a copy."""
+    a = os.stat(_existingDir(dst_dir)).st_dev
+    b = os.stat(_existingDir(src_file_dir)).st_dev
+    return 0 if a == b else 1
+
+
+def bluRayRipFootprint(title):
+    """Return the estimated size of the rip of the makemkvcon <title>."""
+    return title.get('diskSizeBytes')
+
+
+def handbrakeOutputFootprint(options, duration=None):
+    """Return the estimated size of the output of HandBrakeCLI with
+    <options>, for a title of <duration> seconds (if known). Without a
+    target size (-S), the output is assumed to be no larger than a DVD."""
+    if '-S' in options:
+        return int(options[options.index('-S') + 1]) << 20
+    if '-b' in options and duration is not None:
+        # video bitrate in kbit/s; allow for audio
+        kbps = int(options[options.index('-b') + 1]) + 640
+        return kbps * 1000 / 8 * duration
+    return DVD_MAX_BYTES
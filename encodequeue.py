@@ -0,0 +1,66 @@
+"""
+encodequeue
+
+A queue of deferred jobs (e.g. encodes of discs which have already been
+copied off the drive), run in order by a fixed pool of worker threads.
+"""
+
+import Queue
+import threading
+import traceback
+
+from common_util import Error, Msg
+
+
+class EncodeQueue:
+    """Runs submitted jobs in FIFO order, at most <workers> at a time. The
+    worker threads are started by start(); jobs submitted before then wait."""
+
+    def __init__(self, workers):
+        self.workers  = workers
+        self._queue   = Queue.Queue()
+        self._lock    = threading.Lock()
+        self._waiting = []     # names of queued jobs, in order
+        self._running = set()
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for i in xrange(self.workers):
+            t = threading.Thread(target=self._work, name="encoder-%d" % i)
+            t.daemon = True
+            t.start()
+
+    def submit(self, name, fn, args=()):
+        """Queue fn(*args) to be run as the job <name>."""
+        with self._lock:
+            self._waiting.append(name)
+            n = len(self._waiting)
+        Msg("Queued %s; %d job(s) waiting to be encoded" % (name, n))
+        self._queue.put((name, fn, args))
+
+    def waiting(self):
+        """Return the names of queued jobs which have not yet started."""
+        with self._lock:
+            return list(self._waiting)
+
+    def running(self):
+        with self._lock:
+            return list(self._running)
+
+    def _work(self):
+        while True:
+            name, fn, args = self._queue.get()
+            with self._lock:
+                self._waiting.remove(name)
+                self._running.add(name)
+            try:
+                fn(*args)
+            except:
+                Error("Job %s failed:\n%s" % (name, traceback.format_exc()))
+            finally:
+                with self._lock:
+                    self._running.discard(name)
@@ -0,0 +1,264 @@
+"""
+encplanner
+
+Choice of the x264 preset of an encode by the throughput it must reach. A
+fixed preset is too slow when discs pile up, and wastes quality when the
+queue is empty; instead, a short clip of the actual source is encoded at a
+few presets, and the slowest (best) preset which still meets the configured
+deadline or frame rate is used for the full encode.
+
+Measurements are cached per host and source format (resolution, frame rate
+and scan type; see formatKey()), in a JSON file of the form
+
+    {host : {"1920x1080@23.976p" : {"slow" : {"fps" : 31.2, "speed" : 1.3,
+                                              "samples" : 2}, ...}}}
+
+so that later encodes of similar sources need not be benchmarked again.
+Sources are only benchmarked from files; reading clips from a drive would
+be slow, and would measure the drive rather than the encoder.
+"""
+
+import os
+import re
+import json
+import time
+import socket
+import tempfile
+import threading
+
+from common_util import Msg, Warn, Error, Babble, uniquePath, strsFromJSON
+
+
+# x264 presets, fastest first
+PRESETS = ('ultrafast', 'superfast', 'veryfast', 'faster', 'fast',
+           'medium', 'slow', 'slower', 'veryslow')
+
+# HandBrakeCLI's summary of an encode
+SPEED_LINE = re.compile(r'average encoding speed for job is ([0-9.]+) fps')
+
+# a cached rate is the mean of (at most) this many measurements
+MAX_SAMPLES = 5
+
+
+def withPreset(cmd, preset):
+    """Return the HandBrakeCLI <cmd> with its x264 preset set to <preset>."""
+    out = []
+    skip = False
+    for arg in cmd:
+        if skip:
+            skip = False
+        elif arg in ('--x264-preset', '--encoder-preset'):
+            skip = True
+        else:
+            out.append(arg)
+    return out + ['--x264-preset', preset]
+
+
+def formatKey(resolution, framerate=None, interlaced=None):
+    """Return the key under which encode rates of sources with frames of
+    <resolution> (e.g. '1920x1080') at <framerate> are cached, e.g.
+    '1920x1080@23.976p'. <interlaced> is True, False, or None if unknown."""
+    rate = "%.3f" % framerate if framerate else 'unknown'
+    scan = {True : 'i', False : 'p'}.get(interlaced, '?')
+    return "%s@%s%s" % (resolution or 'unknown', rate, scan)
+
+
+def usesX264(cmd):
+    """Whether the HandBrakeCLI <cmd> encodes with x264."""
+    for opt in ('-e', '--encoder'):
+        if opt in cmd[:-1]:
+            return cmd[cmd.index(opt) + 1].startswith('x264')
+    return False
+
+
+class PresetCache:
+    """Encode rates measured on this host, stored in <path>."""
+
+    def __init__(self, path, host=None):
+        self.path  = path
+        self.host  = host or socket.gethostname()
+        self._lock = threading.Lock()
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            try:
+                with open(self.path, 'r') as f:
+                    self._data = strsFromJSON(json.load(f))
+            except IOError:
+                self._data = {}
+            except ValueError:
+                Warn("Discarding corrupt preset cache %s" % self.path)
+                self._data = {}
+        return self._data.setdefault(self.host, {})
+
+    def _save(self):
+        d = os.path.dirname(self.path)
+        try:
+            if d and not os.path.isdir(d):
+                os.makedirs(d)
+            # write to a temp file and rename it into place, so that readers
+            # never see a partially written cache
+            fd, tmp = tempfile.mkstemp(dir=d or '.', suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._data, f, indent=1)
+            os.rename(tmp, self.path)
+        except (IOError, OSError), err:
+            Warn("Could not write preset cache %s (%s)" % (self.path, err))
+
+    def get(self, fmt, preset):
+        """Return the rate of <preset> for sources of the format <fmt> (see
+        formatKey()) as a dictionary (see above), or None if it has not been
+        measured on this host."""
+        with self._lock:
+            return self._load().get(fmt, {}).get(preset)
+
+    def record(self, fmt, preset, fps, speed):
+        """Fold a measurement of <fps> frames per second, <speed> times
+        real time, into the rate of <preset> for sources of the format
+        <fmt>."""
+        with self._lock:
+            rates = self._load().setdefault(fmt, {})
+            entry = rates.get(preset)
+            if entry is None:
+                entry = rates[preset] = {'fps': fps, 'speed': speed,
+                                         'samples': 1}
+            else:
+                n = min(entry['samples'], MAX_SAMPLES - 1)
+                entry['fps']     = (entry['fps'] * n + fps) / (n + 1)
+                entry['speed']   = (entry['speed'] * n + speed) / (n + 1)
+                entry['samples'] = n + 1
+            self._save()
+            return dict(entry)
+
+
+class EncodePlanner:
+    """Chooses presets for encodes which must run at <minFps> frames per
+    second, and/or finish, along with the <queueDepth>() encodes waiting
+    behind them, within <deadline> seconds. Uncached presets are measured by
+    encoding <clipLength> seconds of the source."""
+
+    def __init__(self, cache, deadline=None, minFps=None, clipLength=30,
+                 queueDepth=None, presets=PRESETS):
+        self.cache      = cache
+        self.deadline   = deadline
+        self.minFps     = minFps
+        self.clipLength = clipLength
+        self.queueDepth = queueDepth
+        self.presets    = presets
+
+    def requirement(self, duration):
+        """Return (speed, fps): the multiple of real time at which a title
+        <duration> seconds long must be encoded to meet the deadline, and
+        the minimum frame rate. Either may be None."""
+        speed = None
+        if self.deadline and duration:
+            waiting = self.queueDepth() if self.queueDepth is not None else 0
+            speed = duration * (1 + waiting) / float(self.deadline)
+        return speed, self.minFps
+
+    def choose(self, cmd, resolution, duration, framerate, procMgr, workDir,
+               interlaced=None, benchmark=True):
+        """Return the slowest preset at which HandBrakeCLI <cmd> (all
+        arguments but the output file) can encode a title of <duration>
+        seconds, with frames of <resolution> (e.g. '1920x1080') at
+        <framerate>, interlaced or not (either may be None if unknown), fast
+        enough, or None if there is nothing to meet or the source cannot be
+        benchmarked. Unless <benchmark> is set (it should not be if <cmd>
+        reads a drive), only cached rates are used."""
+        speed, fps = self.requirement(duration)
+        if speed is None and fps is None or not usesX264(cmd):
+            return None
+        fmt = formatKey(resolution, framerate, interlaced)
+
+        def fast(rate):
+            if speed is not None and rate['speed'] < speed:
+                return False
+            return fps is None or rate['fps'] >= fps
+
+        # presets get slower, and no better, in order; the slowest fast
+        # enough is found by bisection, benchmarking only where needed
+        best = None
+        lo, hi = 0, len(self.presets) - 1
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            rate = self.rate(cmd, self.presets[mid], fmt, duration,
+                             framerate, procMgr, workDir, benchmark)
+            if rate is None:
+                return None
+            if fast(rate):
+                best = mid
+                lo = mid + 1
+            else:
+                hi = mid - 1
+        if best is None:
+            Warn("No x264 preset is fast enough for %s at %s; using %s" %
+                 (fmt, self.describe(speed, fps), self.presets[0]))
+            best = 0
+        Msg("Using x264 preset %s for %s at %s" %
+            (self.presets[best], fmt, self.describe(speed, fps)))
+        return self.presets[best]
+
+    def describe(self, speed, fps):
+        needs = []
+        if speed is not None:
+            needs.append("%.2fx real time" % speed)
+        if fps is not None:
+            needs.append("%g fps" % fps)
+        return " and ".join(needs)
+
+    def rate(self, cmd, preset, fmt, duration, framerate, procMgr, workDir,
+             benchmark=True):
+        """Return the cached rate of <preset> for sources of the format
+        <fmt>, measuring it first if there is none (and <benchmark> is set).
+        Returns None if it cannot be measured."""
+        rate = self.cache.get(fmt, preset)
+        if rate is not None:
+            return rate
+        if not benchmark:
+            Babble("x264 preset %s has not been measured for %s; not "
+                   "benchmarking this source" % (preset, fmt))
+            return None
+        measured = self.measure(cmd, preset, duration, framerate, procMgr,
+                                workDir)
+        if measured is None:
+            return None
+        return self.cache.record(fmt, preset, *measured)
+
+    def measure(self, cmd, preset, duration, framerate, procMgr, workDir):
+        """Encode a clip from the middle of the title with <cmd> at <preset>,
+        and return (fps, speed), or None on failure."""
+        length = min(self.clipLength, duration) if duration else \
+                 self.clipLength
+        start  = max(0, int(duration / 2. - length / 2.)) if duration else 0
+        outfile = uniquePath(os.path.join(workDir, "benchmark.%s.mkv" %
+                                                   preset))
+        clipcmd = withPreset(cmd, preset) + \
+                  ['--start-at', 'duration:%d' % start,
+                   '--stop-at',  'duration:%d' % length,
+                   '-o', outfile]
+        Babble("Benchmarking x264 preset %s: %s" % (preset, " ".join(clipcmd)))
+        t0 = time.time()
+        try:
+            retcode, sout, serr = procMgr.call(clipcmd)
+        finally:
+            if os.path.exists(outfile):
+                os.unlink(outfile)
+        elapsed = time.time() - t0
+        if retcode != 0:
+            Error("Benchmark of x264 preset %s failed:\n%s" % (preset, serr))
+            return None
+        found = SPEED_LINE.findall(sout + serr)
+        if found:
+            fps = float(found[-1])
+            speed = fps / framerate if framerate else length / elapsed
+        elif framerate and elapsed > 0:
+            # includes start-up (and any wait for admission); errs slow
+            speed = length / elapsed
+            fps = speed * framerate
+        else:
+            Error("Could not tell the speed of x264 preset %s" % preset)
+            return None
+        Babble("x264 preset %s: %.1f fps, %.2fx real time" %
+               (preset, fps, speed))
+        return fps, speed
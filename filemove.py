@@ -0,0 +1,224 @@
+"""
+filemove
+
+Moving of large files (rips, remuxes) between folders which may be on
+different filesystems. A file is renamed if possible; otherwise it is cloned
+(reflinked) or copied in the kernel without passing through our memory, and
+only then replaces the destination atomically and is removed from its source.
+"""
+
+import os
+import time
+import errno
+import fcntl
+import ctypes
+import shutil
+import tempfile
+
+from common_util import Msg, Babble
+
+
+# _IOW(0x94, 9, int), from linux/fs.h
+FICLONE = 0x40049409
+
+# bytes copied per system call; also the granularity of progress reports
+CHUNK_SIZE = 64 << 20
+
+# errors meaning "this way of copying is not possible here; try another"
+_UNSUPPORTED = set([errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY,
+                    errno.EOPNOTSUPP, errno.EBADF, errno.EPERM])
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+def _cfunc(name, argtypes):
+    fn = getattr(_libc, name, None)
+    if fn is not None:
+        fn.restype  = ctypes.c_ssize_t
+        fn.argtypes = argtypes
+    return fn
+
+# both are missing from the os module of python 2
+_copy_file_range = _cfunc('copy_file_range',
+                          [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                           ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint])
+_sendfile = _cfunc('sendfile',
+                   [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                    ctypes.c_size_t])
+
+
+class _Unsupported(Exception):
+    pass
+
+
+###########################
+# Copy methods            #
+###########################
+
+# Each copies the whole of the file open as <fd_in> (of <size> bytes) to
+# <fd_out>, calling onChunk(bytes_copied) as it goes, and returns the number
+# of bytes copied; or raises _Unsupported before having written anything.
+
+
+def _reflink(fd_in, fd_out, size, onChunk):
+    try:
+        fcntl.ioctl(fd_out, FICLONE, fd_in)
+    except IOError, err:
+        if err.errno in _UNSUPPORTED:
+            raise _Unsupported()
+        raise
+    onChunk(size)
+    return size
+
+
+def _kernelCopy(syscall, args):
+    """Return a copy method which calls the libc function <syscall> with
+    args(fd_in, fd_out, count) until the whole file is copied."""
+    def copy(fd_in, fd_out, size, onChunk):
+        if syscall is None:
+            raise _Unsupported()
+        done = 0
+        while done < size:
+            n = syscall(*args(fd_in, fd_out, min(CHUNK_SIZE, size - done)))
+            if n < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if done == 0 and err in _UNSUPPORTED:
+                    raise _Unsupported()
+                raise OSError(err, os.strerror(err))
+            if n == 0:
+                if done == 0:
+                    # some filesystems (FUSE, procfs and the like) report
+                    # end of file rather than refuse
+                    raise _Unsupported()
+                # the file shrank underneath us; caught by copyFile()
+                break
+            done += n
+            onChunk(done)
+        return done
+    return copy
+
+
+def _readWrite(fd_in, fd_out, size, onChunk):
+    done = 0
+    while True:
+        buf = os.read(fd_in, CHUNK_SIZE)
+        if len(buf) == 0:
+            break
+        while len(buf) > 0:
+            n = os.write(fd_out, buf)
+            buf = buf[n:]
+            done += n
+        onChunk(done)
+    return done
+
+
+COPY_METHODS = [
+    ('reflink',         _reflink),
+    ('copy_file_range', _kernelCopy(_copy_file_range,
+                            lambda i, o, n: (i, None, o, None, n, 0))),
+    ('sendfile',        _kernelCopy(_sendfile,
+                            lambda i, o, n: (o, i, None, n))),
+    ('read/write',      _readWrite),
+]
+
+
+###########################
+# Moving                  #
+###########################
+
+
+def moveFile(src, dst, progress=None, stage='move'):
+    """Move the file <src> to <dst>, which is replaced atomically if it
+    exists. If the two are on different filesystems, <src> is copied (and
+    synced to disk) before it is removed. If given, <progress> is a
+    progress.JobProgress to which the progress of a copy is reported as
+    <stage>.
+
+    Returns the name of the method by which the file was moved."""
+    try:
+        os.rename(src, dst)
+        return 'rename'
+    except OSError, err:
+        if err.errno != errno.EXDEV:
+            raise
+
+    size = os.path.getsize(src)
+    t_start = time.time()
+    def onChunk(done):
+        if progress is not None and size > 0:
+            progress.stage(stage, float(done) / size)
+
+    method = copyFile(src, dst, onChunk)
+    # never remove the source of an incomplete copy
+    copied = os.path.getsize(dst)
+    if copied != size:
+        raise IOError(errno.EIO, "Copy of %s to %s is incomplete (%d of %d "
+                      "bytes); %s kept" % (src, dst, copied, size, src))
+    os.unlink(src)
+
+    elapsed = max(time.time() - t_start, 1e-3)
+    Msg("Moved %s to %s (%dMB by %s at %.1fMB/s)" %
+        (src, dst, size >> 20, method, size / elapsed / (1 << 20)))
+    return method
+
+
+def copyFile(src, dst, onChunk=None):
+    """Copy <src> to <dst> by the fastest method available, replacing <dst>
+    atomically. Permissions and times are copied, and the copy is synced to
+    disk before it replaces <dst>. onChunk(bytes_copied) is called as the
+    copy progresses. Raises IOError, leaving <dst> as it was, if fewer bytes
+    than <src> holds could be copied.
+
+    Returns the name of the method used."""
+    if onChunk is None:
+        onChunk = lambda done: None
+    dstdir = os.path.dirname(os.path.abspath(dst))
+    # the copy is written next to <dst>, so that it can be renamed into place
+    fd_out, tmp = tempfile.mkstemp(dir=dstdir,
+                                   prefix='.%s.' % os.path.basename(dst),
+                                   suffix='.part')
+    try:
+        fd_in = os.open(src, os.O_RDONLY)
+        try:
+            size = os.fstat(fd_in).st_size
+            for name, copy in COPY_METHODS:
+                try:
+                    copied = copy(fd_in, fd_out, size, onChunk)
+                    break
+                except _Unsupported:
+                    Babble("Cannot copy %s by %s" % (src, name))
+            written = os.fstat(fd_out).st_size
+            if copied != size or written != size:
+                # don't let a truncated copy replace <dst>
+                raise IOError(errno.EIO, "Copy of %s by %s is incomplete "
+                              "(%d of %d bytes copied, %d written)" %
+                              (src, name, copied, size, written))
+            os.fsync(fd_out)
+        finally:
+            os.close(fd_in)
+        os.close(fd_out)
+        fd_out = None
+        shutil.copystat(src, tmp)
+        os.rename(tmp, dst)
+    except:
+        if fd_out is not None:
+            os.close(fd_out)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    _syncDir(dstdir)
+    return name
+
+
+def _syncDir(path):
+    """Make a rename into the directory <path> durable."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
@@ -0,0 +1,256 @@
+"""
+hbscan
+
+Parser of the title scan HandBrakeCLI prints (to stderr) for `-t 0`. The
+scan is a tree of '+' nodes, delimited by indent:
+
+    + title 1:
+      + Main Feature
+      + duration: 01:58:12
+      + size: 720x480, pixel aspect: 32/27, display aspect: 1.78, 23.976 fps
+      + chapters:
+        + 1: cells 0->0, 93287 blocks, duration 00:04:48
+      + audio tracks:
+        + 1, English (AC3) (5.1 ch) (iso639-2: eng), 48000Hz, 384000bps
+      + subtitle tracks:
+        + 1, English (iso639-2: eng) (Bitmap)(VOBSUB)
+
+Lines are fed to a ScanParser one at a time, as HandBrake prints them, and
+matched against precompiled patterns. Lines which match nothing are
+skipped, so an odd node loses only itself, never the rest of the scan.
+
+The properties differ from those of the parser dvdDiscProperties() used
+before in three ways: a scan with an empty track section followed by
+another section (as on side 2 of Amadeus) is parsed, where it raised
+ValueError; a title which follows an empty section is a title of its own,
+where it was nested in the title before it (e.g. title 3 of
+testdata/scans/feature_extras.scan, in title 2); and a title noted as
+"combing detected" has the property 'combing'.
+"""
+
+import re
+import collections
+
+from common_util import Warn
+
+
+NODE      = re.compile(r'^(\s*)\+\s*(.*?)\s*$')
+TITLE     = re.compile(r'^title (\d+):$')
+SECTION   = re.compile(r'^(chapters|audio tracks|subtitle tracks):$')
+CHAPTER   = re.compile(r'^(\d+):\s*(?:cells (\S+), (\d+) blocks, )?'
+                       r'duration (\d+:\d+:\d+)')
+TRACK     = re.compile(r'^(\d+),\s*(.*)$')
+LANGUAGE  = re.compile(r'iso639-2: (\w+)')
+SIZE      = re.compile(r'^size: (\d+x\d+), pixel aspect: ([^,]+), '
+                       r'display aspect: ([^,]+), ([\d.]+ fps)')
+PAIR      = re.compile(r'^([^:]+?):\s*(.*)$')
+DISC_LINE = re.compile(r'(DVD Title|DVD Title \(Alternative\)|'
+                       r'DVD Serial Number):\s*(.*?)\s*$')
+
+DISC_KEYS = {'DVD Title'                 : 'dvd_title',
+             'DVD Title (Alternative)'   : 'dvd_alt_title',
+             'DVD Serial Number'         : 'dvd_serial_number'}
+
+
+###########################
+# Model                   #
+###########################
+
+
+class Chapter:
+    def __init__(self, number, duration, cells=None, blocks=None):
+        self.number   = number
+        self.duration = duration    # e.g. '00:04:48'
+        self.cells    = cells       # e.g. '0->0'
+        self.blocks   = blocks
+
+    def properties(self):
+        props = {'duration' : self.duration}
+        if self.cells is not None:
+            props['cells']  = self.cells
+            props['blocks'] = self.blocks
+        return props
+
+
+class Track:
+    """An audio or subtitle track, as HandBrake describes it, e.g.
+    'English (AC3) (5.1 ch) (iso639-2: eng), 48000Hz, 384000bps'."""
+
+    def __init__(self, number, description):
+        self.number      = number
+        self.description = description
+        m = LANGUAGE.search(description)
+        self.language    = m.group(1) if m else None
+
+
+class Title:
+    def __init__(self, number):
+        self.number        = number
+        self.mainFeature   = False
+        self.duration      = None
+        self.size          = None   # e.g. '720x480'
+        self.pixelAspect   = None
+        self.displayAspect = None
+        self.fps           = None   # e.g. '23.976 fps'
+        self.combing       = False  # interlaced or telecined, it seems
+        self.chapters      = []
+        self.audio         = []
+        self.subtitles     = []
+        self.other         = {}     # any other properties, by name
+
+    def name(self):
+        return "title %d" % self.number
+
+    def frameRate(self):
+        return float(self.fps.split()[0]) if self.fps else None
+
+    def seconds(self):
+        """Return the duration of this title in seconds, or None."""
+        if self.duration is None:
+            return None
+        secs = 0
+        for part in self.duration.split(':'):
+            secs = secs * 60 + int(part)
+        return secs
+
+    def properties(self):
+        """Return this title as a dictionary, as the disc cache stores it."""
+        props = dict(self.other)
+        for key, val in (('duration',       self.duration),
+                         ('size',           self.size),
+                         ('pixel aspect',   self.pixelAspect),
+                         ('display aspect', self.displayAspect),
+                         ('fps',            self.fps)):
+            if val is not None:
+                props[key] = val
+        if self.mainFeature:
+            props['main_feature'] = True
+        if self.combing:
+            props['combing'] = True
+        props['chapters'] = dict((str(c.number), c.properties())
+                                 for c in self.chapters)
+        props['audio tracks'] = dict((str(t.number), t.description)
+                                     for t in self.audio)
+        props['subtitle tracks'] = dict((str(t.number), t.description)
+                                        for t in self.subtitles)
+        return props
+
+
+###########################
+# Parser                  #
+###########################
+
+
+class ScanParser:
+    """Builds Titles from the lines of a scan, fed to feed() in order."""
+
+    def __init__(self):
+        self.disc   = {}    # dvd_title, dvd_alt_title, dvd_serial_number
+        self.titles = collections.OrderedDict()   # number -> Title
+        self.errors = 0
+        self.skipped = []   # chapter and track lines which made no sense
+        self._title   = None
+        self._indent  = None    # of the current title's node
+        self._section = None    # (name, indent, list or dict) within it
+
+    def feed(self, line):
+        try:
+            self._feed(line)
+        except Exception, err:
+            # one bad line must not cost the whole scan
+            self.errors += 1
+            Warn("Could not parse scan line %r (%s)" % (line, err))
+
+    def _feed(self, line):
+        node = NODE.match(line)
+        if node is None:
+            if not self.titles:
+                # the disc's properties are logged before the tree
+                m = DISC_LINE.search(line)
+                if m:
+                    self.disc[DISC_KEYS[m.group(1)]] = m.group(2)
+            return
+        indent = len(node.group(1).expandtabs())
+        text   = node.group(2)
+
+        m = TITLE.match(text)
+        if m:
+            self._title = Title(int(m.group(1)))
+            self.titles[self._title.number] = self._title
+            self._indent  = indent
+            self._section = None
+            return
+        title = self._title
+        if title is None or indent <= self._indent:
+            # a top-level node which is not a title
+            self._title = self._section = None
+            return
+        if self._section is not None and indent <= self._section[1]:
+            self._section = None
+
+        if self._section is not None:
+            self._sectionItem(text)
+        elif text == 'Main Feature':
+            title.mainFeature = True
+        elif text.startswith('combing detected'):
+            title.combing = True
+        elif SECTION.match(text):
+            items = {'chapters'        : title.chapters,
+                     'audio tracks'    : title.audio,
+                     'subtitle tracks' : title.subtitles}[text[:-1]]
+            self._section = (text[:-1], indent, items)
+        else:
+            m = SIZE.match(text)
+            if m:
+                (title.size, title.pixelAspect, title.displayAspect,
+                 title.fps) = m.groups()
+                return
+            m = PAIR.match(text)
+            if m is None:
+                # unlabelled, e.g. 'vts 1, ttn 1, cells 0->17 (1234 blocks)'
+                return
+            key, val = m.groups()
+            if key == 'duration':
+                title.duration = val
+            elif val:
+                title.other[key] = val
+            else:
+                # a section we know nothing of; keep its labelled items
+                self._section = (key, indent, title.other.setdefault(key, {}))
+
+    def _sectionItem(self, text):
+        name, indent, items = self._section
+        if name == 'chapters':
+            m = CHAPTER.match(text)
+            if m:
+                number, cells, blocks, duration = m.groups()
+                items.append(Chapter(int(number), duration, cells, blocks))
+            else:
+                self.skipped.append(text)
+        elif name in ('audio tracks', 'subtitle tracks'):
+            m = TRACK.match(text)
+            if m:
+                items.append(Track(int(m.group(1)), m.group(2)))
+            else:
+                self.skipped.append(text)
+        else:
+            m = PAIR.match(text)
+            if m and m.group(2):
+                items[m.group(1)] = m.group(2)
+
+    def properties(self):
+        """Return the scan as the dictionary returned by
+        ripdisc.dvdDiscProperties(): the disc's properties, and its
+        'titles', by name."""
+        props = dict(self.disc)
+        props['titles'] = dict((t.name(), t.properties())
+                               for t in self.titles.itervalues())
+        return props
+
+
+def parseScan(lines):
+    """Parse the scan <lines> (an iterable) and return its ScanParser."""
+    parser = ScanParser()
+    for line in lines:
+        parser.feed(line)
+    return parser
@@ -0,0 +1,217 @@
+"""
+jobengine
+
+An event-loop job engine. A single reactor thread services the output pipes,
+exits and timeouts of every child process, so that a job which runs many
+programs at once does not need a thread blocked on each of them. Jobs
+themselves are submitted to the engine, which runs each in its own
+lightweight thread, logs anything that goes wrong with it, and can cancel it.
+
+Child processes are still spawned through the ProcessManager, so PID
+tracking, the start lock and admission control apply to them as usual.
+"""
+
+import os, sys
+import time
+import errno
+import select
+import thread
+import threading
+import traceback
+import subprocess as subp
+
+from procmgmt import ProcessTimeout, READ_CHUNK
+from common_util import Error, Msg
+
+
+# seconds a child has to exit after SIGTERM before it is killed
+KILL_GRACE = 2.0
+
+
+class _Watch:
+    """A child process being serviced by the reactor."""
+
+    def __init__(self, pipe, onData, timeout):
+        self.pipe     = pipe
+        self.onData   = onData
+        self.deadline = None if timeout is None else time.time() + timeout
+        self.fds      = {pipe.stdout.fileno() : 'stdout',
+                         pipe.stderr.fileno() : 'stderr'}
+        self.done     = threading.Event()
+        self.error    = None   # exc_info of a failure, to re-raise in caller
+        self.t_term   = None   # time at which we sent SIGTERM
+
+
+class JobEngine:
+    """Runs jobs, and the child processes of all jobs, from one event loop.
+
+    Attaching the engine to a ProcessManager (done by the constructor) routes
+    the manager's call() and callStreaming() through the engine."""
+
+    def __init__(self, procManager):
+        self._procman = procManager
+        self._lock    = thread.allocate_lock()
+        self._poller  = select.poll()
+        self._fds     = {}      # fd -> _Watch
+        self._watches = set()
+        self._new     = []      # watches waiting to be picked up by the loop
+        self._jobs    = {}      # job name -> thread
+        self._wakeR, self._wakeW = os.pipe()
+        self._poller.register(self._wakeR, select.POLLIN)
+        procManager.engine = self
+        thread.start_new_thread(self._loop, ())
+
+    ##########################
+    # jobs                   #
+    ##########################
+
+    def submit(self, name, fn, args=()):
+        """Run fn(*args) as the job <name>, in its own thread."""
+        t = threading.Thread(target=self._runJob, args=(name, fn, args),
+                             name=name)
+        t.daemon = True
+        with self._lock:
+            self._jobs[name] = t
+        t.start()
+
+    def _runJob(self, name, fn, args):
+        try:
+            fn(*args)
+        except:
+            Error("Job %s failed:\n%s" % (name, traceback.format_exc()))
+        finally:
+            with self._lock:
+                self._jobs.pop(name, None)
+
+    def activeJobs(self):
+        with self._lock:
+            return list(self._jobs)
+
+    def cancel(self, jobID):
+        """Kill every process of <jobID> and prevent it from starting more;
+        the job will fail at its next step."""
+        Msg("Cancelling job %s" % jobID)
+        self._procman.cancelJob(jobID)
+
+    ##########################
+    # processes              #
+    ##########################
+
+    def run(self, args, onData, workClass=None, timeout=None):
+        """Spawn <args>, passing each chunk of its output to
+        onData(stream_name, data) from the event loop, and wait for it to
+        exit. Returns the exit code. Raises ProcessTimeout if the child ran
+        longer than <timeout> seconds, or any exception raised by <onData>;
+        in both cases the child is terminated first."""
+        pipe = self._procman.Popen(args, workClass=workClass,
+                                   stdout=subp.PIPE, stderr=subp.PIPE)
+        watch = _Watch(pipe, onData, timeout)
+        with self._lock:
+            self._new.append(watch)
+        self._wake()
+        try:
+            while not watch.done.is_set():
+                # a timed wait, so that signals are still delivered
+                watch.done.wait(1.0)
+        except:
+            # we are abandoning the child; don't leave it running
+            self._terminate(watch)
+            raise
+        if watch.error is not None:
+            etype, evalue, tb = watch.error
+            raise etype, evalue, tb
+        return pipe.returncode
+
+    def _wake(self):
+        try:
+            os.write(self._wakeW, 'x')
+        except OSError, err:
+            if err.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def _loop(self):
+        while True:
+            try:
+                self._step()
+            except:
+                # the loop must survive, or every job would hang
+                Error("Job engine error:\n%s" % traceback.format_exc())
+                time.sleep(1)
+
+    def _step(self):
+        with self._lock:
+            new, self._new = self._new, []
+        for watch in new:
+            self._watches.add(watch)
+            for fd in watch.fds:
+                self._fds[fd] = watch
+                self._poller.register(fd, select.POLLIN | select.POLLHUP |
+                                          select.POLLERR)
+
+        # children whose pipes are closed must be polled for their exit
+        exiting = [w for w in self._watches
+                   if len(w.fds) == 0 or w.t_term is not None]
+        wait_ms = 100 if exiting else 1000
+        deadlines = [w.deadline for w in self._watches
+                     if w.deadline is not None and w.t_term is None]
+        if deadlines:
+            to_deadline = int((min(deadlines) - time.time()) * 1000) + 1
+            wait_ms = max(0, min(wait_ms, to_deadline))
+        try:
+            events = self._poller.poll(wait_ms)
+        except select.error, err:
+            if err.args[0] == errno.EINTR:
+                return
+            raise
+
+        for fd, evt in events:
+            if fd == self._wakeR:
+                os.read(self._wakeR, 4096)
+                continue
+            self._service(fd)
+        self._checkWatches()
+
+    def _service(self, fd):
+        watch = self._fds[fd]
+        chunk = os.read(fd, READ_CHUNK)
+        if len(chunk) == 0:
+            self._closeFd(watch, fd)
+        elif watch.error is None:
+            try:
+                watch.onData(watch.fds[fd], chunk)
+            except:
+                watch.error = sys.exc_info()
+                self._terminate(watch)
+
+    def _closeFd(self, watch, fd):
+        self._poller.unregister(fd)
+        del self._fds[fd]
+        name = watch.fds.pop(fd)
+        getattr(watch.pipe, name).close()
+
+    def _checkWatches(self):
+        now = time.time()
+        for watch in list(self._watches):
+            if watch.deadline is not None and now > watch.deadline and \
+                    watch.t_term is None:
+                try:
+                    raise ProcessTimeout("%s ran for too long" %
+                                         watch.pipe.pid)
+                except ProcessTimeout:
+                    watch.error = sys.exc_info()
+                self._terminate(watch)
+            if watch.t_term is not None and now > watch.t_term + KILL_GRACE:
+                watch.pipe.kill()
+
+            if (len(watch.fds) == 0 or watch.t_term is not None) and \
+                    watch.pipe.poll() is not None:
+                # exited and reaped
+                for fd in watch.fds.keys():
+                    self._closeFd(watch, fd)
+                self._watches.discard(watch)
+                watch.done.set()
+
+    def _terminate(self, watch):
+        if watch.t_term is None:
+            watch.t_term = time.time()
+            watch.pipe.terminate()
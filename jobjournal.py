@@ -0,0 +1,170 @@
+"""
+jobjournal
+
+A durable record of rip jobs: the stages each job has started and completed,
+and what each completed stage produced (ripped files, disc copies, plugin
+output). After a crash or restart, unfinished jobs can be resumed from their
+last completed stage.
+
+The journal is an SQLite database in WAL mode, so that a record is durable
+once written, and a crash cannot leave it corrupt.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from common_util import Warn, strsFromJSON
+
+
+# job states
+JOB_RUNNING = 'running'
+JOB_DONE    = 'done'
+JOB_FAILED  = 'failed'
+
+# stage states
+STAGE_STARTED = 'started'
+STAGE_DONE    = 'done'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id       TEXT PRIMARY KEY,
+    kind     TEXT NOT NULL,
+    wdir     TEXT NOT NULL,
+    params   TEXT NOT NULL,
+    state    TEXT NOT NULL,
+    started  REAL NOT NULL,
+    updated  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stages (
+    job        TEXT NOT NULL REFERENCES jobs(id),
+    stage      TEXT NOT NULL,
+    state      TEXT NOT NULL,
+    started    REAL NOT NULL,
+    finished   REAL,
+    artifacts  TEXT,
+    PRIMARY KEY (job, stage)
+);
+"""
+
+
+class JournalJob:
+    """A job, as recorded in the journal."""
+
+    def __init__(self, jobID, kind, wdir, params, state, started):
+        self.jobID   = jobID
+        self.kind    = kind
+        self.wdir    = wdir
+        self.params  = params
+        self.state   = state
+        self.started = started
+
+
+class JobJournal:
+    """Journal of jobs, stored in the SQLite database at <path>. If <path> is
+    None, the journal is kept in memory only (and nothing can be resumed).
+
+    The database is opened on first use, so that a journal may be created
+    before the daemon forks."""
+
+    def __init__(self, path):
+        self.path  = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self._conn is None:
+            if self.path is None:
+                conn = sqlite3.connect(':memory:', check_same_thread=False)
+            else:
+                d = os.path.dirname(self.path)
+                if d and not os.path.isdir(d):
+                    os.makedirs(d)
+                # we serialize access ourselves; see _lock
+                conn = sqlite3.connect(self.path, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=FULL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _write(self, sql, args):
+        try:
+            with self._lock:
+                conn = self._db()
+                with conn:   # commits
+                    conn.execute(sql, args)
+        except (sqlite3.Error, OSError), err:
+            # the job itself can carry on; it just can't be resumed
+            Warn("Could not write to job journal %s (%s)" % (self.path, err))
+
+    def _read(self, sql, args=()):
+        try:
+            with self._lock:
+                return self._db().execute(sql, args).fetchall()
+        except (sqlite3.Error, OSError), err:
+            # as if nothing were recorded; there is just nothing to resume
+            Warn("Could not read job journal %s (%s)" % (self.path, err))
+            return []
+
+    ##########################
+    # jobs                   #
+    ##########################
+
+    def beginJob(self, jobID, kind, wdir, params=None):
+        """Record the start of <jobID>, a job of <kind> ('bluray', 'dvd', ...)
+        working in <wdir>. <params> is a JSON-compatible dictionary of what is
+        needed to resume the job."""
+        now = time.time()
+        # a new job has no completed stages, whatever an old job of the same
+        # ID may have left
+        self._write("DELETE FROM stages WHERE job=?", (jobID,))
+        self._write("INSERT OR REPLACE INTO jobs VALUES (?,?,?,?,?,?,?)",
+                    (jobID, kind, wdir, json.dumps(params or {}), JOB_RUNNING,
+                     now, now))
+
+    def finishJob(self, jobID, ok=True):
+        self._write("UPDATE jobs SET state=?, updated=? WHERE id=?",
+                    (JOB_DONE if ok else JOB_FAILED, time.time(), jobID))
+
+    def unfinishedJobs(self):
+        """Return the JournalJobs which were running when last recorded."""
+        rows = self._read("SELECT id, kind, wdir, params, state, started "
+                          "FROM jobs WHERE state=? ORDER BY started",
+                          (JOB_RUNNING,))
+        return [JournalJob(r[0], r[1], r[2], json.loads(r[3]), r[4], r[5])
+                for r in rows]
+
+    ##########################
+    # stages                 #
+    ##########################
+
+    def stageStarted(self, jobID, stage):
+        now = time.time()
+        self._write("INSERT OR REPLACE INTO stages VALUES (?,?,?,?,NULL,NULL)",
+                    (jobID, stage, STAGE_STARTED, now))
+        self._write("UPDATE jobs SET updated=? WHERE id=?", (now, jobID))
+
+    def stageDone(self, jobID, stage, artifacts=None):
+        """Record the completion of <stage> of <jobID>, which produced
+        <artifacts> (anything JSON-compatible: paths of files, plugin output,
+        etc.)."""
+        try:
+            art = json.dumps(artifacts)
+        except (TypeError, ValueError), err:
+            Warn("Output of stage %s of %s cannot be journaled (%s)" %
+                 (stage, jobID, err))
+            art = json.dumps(None)
+        now = time.time()
+        self._write("UPDATE stages SET state=?, finished=?, artifacts=? "
+                    "WHERE job=? AND stage=?",
+                    (STAGE_DONE, now, art, jobID, stage))
+        self._write("UPDATE jobs SET updated=? WHERE id=?", (now, jobID))
+
+    def completedStages(self, jobID):
+        """Return {stage : artifacts} for the completed stages of <jobID>."""
+        rows = self._read("SELECT stage, artifacts FROM stages "
+                          "WHERE job=? AND state=?", (jobID, STAGE_DONE))
+        return dict((r[0], strsFromJSON(json.loads(r[1]))) for r in rows)
@@ -0,0 +1,165 @@
+"""
+jobsched
+
+Admission control for child processes. Work is classified as disc reading,
+CPU-bound encoding or I/O (extraction, muxing, file moves), and each class
+is admitted against its own budget of concurrently running processes. Work
+which does not fit in its budget waits in a FIFO queue.
+"""
+
+import os
+import time
+import thread
+import threading
+import collections
+
+from common_util import Msg
+
+
+# work classes
+WORK_DISC = 'disc'
+WORK_CPU  = 'cpu'
+WORK_IO   = 'io'
+
+WORK_CLASSES = (WORK_DISC, WORK_CPU, WORK_IO)
+
+# class of work done by each external tool
+TOOL_CLASSES = {
+    'makemkvcon'   : WORK_DISC,
+    'HandBrakeCLI' : WORK_CPU,
+    'x264'         : WORK_CPU,
+    'aften'        : WORK_CPU,
+    'dcadec'       : WORK_CPU,
+    'mkvextract'   : WORK_IO,
+    'mkvmerge'     : WORK_IO,
+    'tsMuxeR'      : WORK_IO,
+}
+
+
+def classifyCommand(args):
+    """Return the class of work done by the command <args>, or None if the
+    command should not be subject to admission control."""
+    tool = os.path.basename(args[0])
+    if tool == 'HandBrakeCLI' and '-i' in args:
+        # HandBrake reading straight from the drive is limited by the drive
+        src = args[args.index('-i') + 1]
+        if src.startswith('/dev/'):
+            return WORK_DISC
+    return TOOL_CLASSES.get(tool)
+
+
+class SchedulerClosed(Exception):
+    pass
+
+
+class Ticket:
+    """Record of a unit of admitted (or waiting) work."""
+
+    def __init__(self, workClass, label):
+        self.workClass = workClass
+        self.label     = label
+        self.thread    = thread.get_ident()
+        self.t_queued  = time.time()
+        self.t_admit   = None
+        self.nested    = False
+
+    def waited(self):
+        return self.t_admit - self.t_queued
+
+
+class JobScheduler:
+    """Admits work against a per-class budget of concurrent processes.
+
+    Admission is re-entrant per thread: a thread which already holds a ticket
+    of some class (e.g. the decoder of a decode | encode pipe) is admitted
+    again immediately, since both processes belong to the same job. This
+    prevents a job from deadlocking against itself."""
+
+    def __init__(self, budgets):
+        self._cond    = threading.Condition()
+        self._budgets = dict(budgets)
+        self._running = collections.defaultdict(int)
+        self._holders = collections.defaultdict(lambda: collections.defaultdict(int))
+        self._queues  = collections.defaultdict(collections.deque)
+        self._waits   = collections.defaultdict(lambda: collections.deque(maxlen=100))
+        self._closed  = False
+
+    def acquire(self, workClass, label=''):
+        """Block until work of <workClass> may start, then return a Ticket
+        which must be passed to release() when the work is finished. Raises
+        SchedulerClosed if the scheduler is shut down while waiting."""
+        tkt = Ticket(workClass, label)
+        with self._cond:
+            if self._closed:
+                raise SchedulerClosed("scheduler is shut down")
+            holders = self._holders[workClass]
+            if holders[tkt.thread] > 0:
+                # this thread's job is already admitted
+                tkt.nested = True
+            else:
+                queue = self._queues[workClass]
+                queue.append(tkt)
+                if not self._admissible(tkt):
+                    Msg("Queued %s (%s work); %d waiting" %
+                        (label, workClass, len(queue)))
+                while not self._admissible(tkt):
+                    self._cond.wait()
+                    if self._closed:
+                        queue.remove(tkt)
+                        self._cond.notify_all()
+                        raise SchedulerClosed("scheduler is shut down")
+                queue.popleft()
+                self._running[workClass] += 1
+                # someone else may be admissible now, too
+                self._cond.notify_all()
+            holders[tkt.thread] += 1
+            tkt.t_admit = time.time()
+            if not tkt.nested:
+                self._waits[workClass].append(tkt.waited())
+                if tkt.waited() >= 1:
+                    Msg("Started %s (%s work) after waiting %d seconds" %
+                        (label, workClass, tkt.waited()))
+        return tkt
+
+    def release(self, tkt):
+        with self._cond:
+            holders = self._holders[tkt.workClass]
+            holders[tkt.thread] -= 1
+            if holders[tkt.thread] <= 0:
+                del holders[tkt.thread]
+            if not tkt.nested:
+                self._running[tkt.workClass] -= 1
+            self._cond.notify_all()
+
+    def _admissible(self, tkt):
+        queue  = self._queues[tkt.workClass]
+        budget = self._budgets.get(tkt.workClass)
+        return queue[0] is tkt and \
+               (budget is None or self._running[tkt.workClass] < budget)
+
+    def shutdown(self):
+        """Refuse all further work, and wake any waiting threads."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def reopen(self):
+        """Undo shutdown()."""
+        with self._cond:
+            self._closed = False
+    
+    def stats(self):
+        """Return {workClass : {'budget', 'running', 'queued', 'avgWait',
+        'maxWait'}}, where the wait times cover recently admitted work."""
+        s = {}
+        with self._cond:
+            for cls in WORK_CLASSES:
+                waits = self._waits[cls]
+                s[cls] = {
+                    'budget'  : self._budgets.get(cls),
+                    'running' : self._running[cls],
+                    'queued'  : len(self._queues[cls]),
+                    'avgWait' : sum(waits) / len(waits) if waits else 0.,
+                    'maxWait' : max(waits) if waits else 0.}
+        return s
+
@@ -0,0 +1,149 @@
+"""
+mediacache
+
+A persistent cache of the media info of files (see ripdisc.mediaInfoData()),
+so that a file which is probed again unchanged (by another plugin, a resumed
+job, or a testplugin run) costs no more than a stat().
+
+Entries are keyed by the file's device, inode, size and modification time,
+so a file which is changed or replaced is probed afresh, and its stale entry
+ages out. The least recently used entries are evicted once the cache grows
+beyond its size limit. Recently used entries are also kept in memory.
+"""
+
+import os
+import copy
+import json
+import time
+import hashlib
+import tempfile
+import thread
+import collections
+
+from common_util import Warn, Babble, strsFromJSON
+
+
+# bump this when the format of media info changes
+CACHE_VERSION = 1
+
+# entries also kept in memory
+MEMORY_ENTRIES = 64
+
+
+def fileKey(path):
+    """Return (device, inode, size, mtime in ns) of <path>, or None if it
+    cannot be stat()ed."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_dev, st.st_ino, st.st_size, int(round(st.st_mtime * 1e9))]
+
+
+class MediaInfoCache:
+    """Media info of up to <maxEntries> files, stored in <cacheDir> as one
+    JSON file per file."""
+
+    def __init__(self, cacheDir, maxEntries=1000):
+        self.cacheDir   = cacheDir
+        self.maxEntries = maxEntries
+        self._lock      = thread.allocate_lock()
+        self._memory    = collections.OrderedDict()
+
+    def _path(self, key):
+        name = hashlib.sha1("%d:%d:%d:%d" % tuple(key)).hexdigest()
+        return os.path.join(self.cacheDir, "%s.json" % name)
+
+    def _remember(self, path, data):
+        self._memory[path] = data
+        while len(self._memory) > min(self.maxEntries, MEMORY_ENTRIES):
+            self._memory.popitem(last=False)
+
+    def get(self, fpath):
+        """Return the cached media info of the file <fpath>, or None if there
+        is none for it as it is now."""
+        key = fileKey(fpath)
+        if key is None:
+            return None
+        path = self._path(key)
+        with self._lock:
+            data = self._memory.pop(path, None)
+            if data is None:
+                try:
+                    with open(path, 'r') as f:
+                        entry = json.load(f)
+                except IOError:
+                    return None
+                except ValueError:
+                    Warn("Discarding corrupt media info cache entry %s" % path)
+                    self._remove(path)
+                    return None
+
+                if entry.get('version') != CACHE_VERSION or \
+                        entry.get('key') != key:
+                    Babble("Media info cache entry %s is stale" % path)
+                    self._remove(path)
+                    return None
+                data = strsFromJSON(entry['data'])
+            self._remember(path, data)
+            # mark as recently used
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+        Babble("Using cached media info of %s" % fpath)
+        # callers may scribble on what they're given
+        return copy.deepcopy(data)
+
+    def put(self, fpath, data):
+        """Store the media info <data> of the file <fpath>. Failure to do so
+        is logged, but not fatal."""
+        key = fileKey(fpath)
+        if key is None:
+            return
+        entry = {'version' : CACHE_VERSION,
+                 'key'     : key,
+                 'file'    : fpath,
+                 'created' : time.time(),
+                 'data'    : data}
+        path = self._path(key)
+        with self._lock:
+            self._remember(path, copy.deepcopy(data))
+            try:
+                if not os.path.isdir(self.cacheDir):
+                    os.makedirs(self.cacheDir)
+                # write to a temp file and rename it into place, so that
+                # readers never see a partially written entry
+                fd, tmp = tempfile.mkstemp(dir=self.cacheDir, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(entry, f)
+                    os.rename(tmp, path)
+                except:
+                    self._remove(tmp)
+                    raise
+                self._evict()
+            except (IOError, OSError, TypeError, ValueError), err:
+                Warn("Could not cache media info of %s (%s)" % (fpath, err))
+
+    def _remove(self, path):
+        self._memory.pop(path, None)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """Remove the least recently used entries beyond maxEntries."""
+        entries = []
+        for fname in os.listdir(self.cacheDir):
+            path = os.path.join(self.cacheDir, fname)
+            if fname.endswith('.json'):
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+        entries.sort(reverse=True)
+        for mtime, path in entries[self.maxEntries:]:
+            Babble("Evicting media info cache entry %s" % path)
+            self._remove(path)
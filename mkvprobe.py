@@ -0,0 +1,383 @@
+"""
+mkvprobe
+
+In-process reader of the metadata of Matroska files, in place of spawning
+`mediainfo -f` and parsing its text. The file is mapped into memory and only
+the header elements of its segment (Info, Tracks, Chapters and the Tags which
+carry track statistics) are read; they are found through the SeekHead, so
+the clusters, which hold the media, are never touched.
+
+probe() returns the same dictionary as ripdisc.mediaInfoData():
+
+    {'file name' : ..., 'duration' : <ms>, 'file size' : <bytes>, ...
+     'tracks' : [{'type' : 'video', 'unique id' : 1, 'codec id' : ...},
+                 ...,
+                 {'type' : 'menu', 'items' : {<chapter> : '00:05:00.000'}}]}
+"""
+
+import os
+import mmap
+import struct
+import binascii
+
+from common_util import Babble
+
+
+# element IDs, with their length markers
+EBML            = 0x1A45DFA3
+DOC_TYPE        = 0x4282
+SEGMENT         = 0x18538067
+SEEK_HEAD       = 0x114D9B74
+SEEK            = 0x4DBB
+SEEK_ID         = 0x53AB
+SEEK_POSITION   = 0x53AC
+INFO            = 0x1549A966
+TIMECODE_SCALE  = 0x2AD7B1
+DURATION        = 0x4489
+TITLE           = 0x7BA9
+TRACKS          = 0x1654AE6B
+TRACK_ENTRY     = 0xAE
+TRACK_NUMBER    = 0xD7
+TRACK_UID       = 0x73C5
+TRACK_TYPE      = 0x83
+CODEC_ID        = 0x86
+CODEC_PRIVATE   = 0x63A2
+LANGUAGE        = 0x22B59C
+NAME            = 0x536E
+DEFAULT_DURATION = 0x23E383
+FLAG_DEFAULT    = 0x88
+FLAG_FORCED     = 0x55AA
+VIDEO           = 0xE0
+PIXEL_WIDTH     = 0xB0
+PIXEL_HEIGHT    = 0xBA
+FLAG_INTERLACED = 0x9A
+AUDIO           = 0xE1
+SAMPLING_FREQ   = 0xB5
+CHANNELS        = 0x9F
+BIT_DEPTH       = 0x6264
+CHAPTERS        = 0x1043A770
+EDITION_ENTRY   = 0x45B9
+CHAPTER_ATOM    = 0xB6
+CHAPTER_START   = 0x91
+CHAPTER_HIDDEN  = 0x98
+CHAPTER_DISPLAY = 0x80
+CHAP_STRING     = 0x85
+CHAP_LANGUAGE   = 0x437C
+TAGS            = 0x1254C367
+TAG             = 0x7373
+TARGETS         = 0x63C0
+TAG_TRACK_UID   = 0x63C5
+SIMPLE_TAG      = 0x67C8
+TAG_NAME        = 0x45A3
+TAG_STRING      = 0x4487
+CLUSTER         = 0x1F43B675
+
+TRACK_TYPES = {1 : 'video', 2 : 'audio', 17 : 'text'}
+SCAN_TYPES  = {1 : 'Interlaced', 2 : 'Progressive'}
+
+# statistics tags written by mkvmerge and MakeMKV, as mediainfo names them
+STATISTICS = {'BPS'              : 'bit rate',
+              'NUMBER_OF_BYTES'  : 'stream size',
+              'NUMBER_OF_FRAMES' : 'frame count'}
+
+
+class ProbeError(Exception):
+    pass
+
+
+###########################
+# EBML                    #
+###########################
+
+
+def _vint(m, pos, keepMarker):
+    """Read the variable length integer at <pos> of <m>; return (value,
+    position after it). Sizes of all ones (unknown) are returned as None."""
+    first = ord(m[pos])
+    if first == 0:
+        raise ProbeError("bad EBML number at %d" % pos)
+    length = 1
+    mask = 0x80
+    while not first & mask:
+        mask >>= 1
+        length += 1
+    value = first if keepMarker else first & (mask - 1)
+    allOnes = value == mask - 1
+    for c in m[pos + 1:pos + length]:
+        value = (value << 8) | ord(c)
+        allOnes = allOnes and c == '\xff'
+    if pos + length > len(m):
+        raise ProbeError("truncated EBML number at %d" % pos)
+    if not keepMarker and allOnes:
+        value = None
+    return value, pos + length
+
+
+def children(m, start, end):
+    """Yield (id, data start, data end) of the elements from <start> to
+    <end> of <m>."""
+    pos = start
+    while pos < end:
+        eid, pos = _vint(m, pos, True)
+        size, pos = _vint(m, pos, False)
+        if size is None:
+            # unknown size; runs to the end of its parent
+            size = end - pos
+        yield eid, pos, min(pos + size, end)
+        pos += size
+
+
+def uint(m, a, b):
+    data = m[a:b]
+    return int(binascii.hexlify(data), 16) if data else 0
+
+
+def fl(m, a, b):
+    if b - a == 4:
+        return struct.unpack('>f', m[a:b])[0]
+    elif b - a == 8:
+        return struct.unpack('>d', m[a:b])[0]
+    return 0.
+
+
+def string(m, a, b):
+    return m[a:b].rstrip('\x00')
+
+
+###########################
+# Matroska                #
+###########################
+
+
+def timestamp(ms):
+    """Format <ms> as mediainfo does, e.g. 01:02:03.456."""
+    secs, ms = divmod(int(round(ms)), 1000)
+    mins, secs = divmod(secs, 60)
+    hours, mins = divmod(mins, 60)
+    return "%02d:%02d:%02d.%03d" % (hours, mins, secs, ms)
+
+
+def _info(m, a, b, props):
+    scale = 1000000
+    duration = None
+    for eid, s, e in children(m, a, b):
+        if eid == TIMECODE_SCALE:
+            scale = uint(m, s, e)
+        elif eid == DURATION:
+            duration = fl(m, s, e)
+        elif eid == TITLE:
+            props['movie name'] = string(m, s, e)
+    if duration is not None:
+        # in ticks of <scale> ns
+        props['duration'] = int(duration * scale / 1000000)
+
+
+def _track(m, a, b):
+    track = {'language' : 'eng'}    # the Matroska default
+    for eid, s, e in children(m, a, b):
+        if eid == TRACK_NUMBER:
+            track['id'] = uint(m, s, e)
+        elif eid == TRACK_UID:
+            track['unique id'] = uint(m, s, e)
+        elif eid == TRACK_TYPE:
+            track['type'] = TRACK_TYPES.get(uint(m, s, e))
+        elif eid == CODEC_ID:
+            track['codec id'] = string(m, s, e)
+        elif eid == CODEC_PRIVATE:
+            track['codec private'] = m[s:e]
+        elif eid == LANGUAGE:
+            track['language'] = string(m, s, e)
+        elif eid == NAME:
+            track['title'] = string(m, s, e)
+        elif eid == DEFAULT_DURATION:
+            ns = uint(m, s, e)
+            if ns:
+                track['frame rate'] = "%.3f fps" % (1e9 / ns)
+        elif eid == FLAG_DEFAULT:
+            track['default'] = 'Yes' if uint(m, s, e) else 'No'
+        elif eid == FLAG_FORCED:
+            track['forced'] = 'Yes' if uint(m, s, e) else 'No'
+        elif eid == VIDEO:
+            for vid, vs, ve in children(m, s, e):
+                if vid == PIXEL_WIDTH:
+                    track['width'] = uint(m, vs, ve)
+                elif vid == PIXEL_HEIGHT:
+                    track['height'] = uint(m, vs, ve)
+                elif vid == FLAG_INTERLACED and \
+                        uint(m, vs, ve) in SCAN_TYPES:
+                    track['scan type'] = SCAN_TYPES[uint(m, vs, ve)]
+        elif eid == AUDIO:
+            for aid, as_, ae in children(m, s, e):
+                if aid == SAMPLING_FREQ:
+                    track['sampling rate'] = int(fl(m, as_, ae))
+                elif aid == CHANNELS:
+                    track['channel(s)'] = uint(m, as_, ae)
+                elif aid == BIT_DEPTH:
+                    track['bit depth'] = uint(m, as_, ae)
+    private = track.pop('codec private', '')
+    if track.get('codec id') == 'V_MS/VFW/FOURCC' and len(private) >= 20:
+        # a BITMAPINFOHEADER; mediainfo names the codec by its FourCC
+        # (e.g. WVC1)
+        track['codec id'] = private[16:20]
+    return track
+
+
+def _tracks(m, a, b, props):
+    for eid, s, e in children(m, a, b):
+        if eid == TRACK_ENTRY:
+            track = _track(m, s, e)
+            if track.get('type') is not None:
+                props['tracks'].append(track)
+
+
+def _chapters(m, a, b, props):
+    items = {}
+    for eid, s, e in children(m, a, b):
+        if eid != EDITION_ENTRY:
+            continue
+        for cid, cs, ce in children(m, s, e):
+            if cid != CHAPTER_ATOM:
+                continue
+            start, hidden, name, lang = None, False, None, ''
+            for aid, as_, ae in children(m, cs, ce):
+                if aid == CHAPTER_START:
+                    start = uint(m, as_, ae) / 1e6    # ns
+                elif aid == CHAPTER_HIDDEN:
+                    hidden = bool(uint(m, as_, ae))
+                elif aid == CHAPTER_DISPLAY and name is None:
+                    for did, ds, de in children(m, as_, ae):
+                        if did == CHAP_STRING:
+                            name = string(m, ds, de)
+                        elif did == CHAP_LANGUAGE:
+                            lang = string(m, ds, de)
+            if start is None or hidden:
+                continue
+            name = name or "chapter %d" % (len(items) + 1)
+            key = ("%s:%s" % (lang, name) if lang else name).lower()
+            while key in items:
+                key += "'"
+            items[key] = timestamp(start)
+        # the first edition is the default one
+        break
+    if items:
+        props['tracks'].append({'type' : 'menu', 'items' : items})
+
+
+def _tags(m, a, b, stats):
+    for eid, s, e in children(m, a, b):
+        if eid != TAG:
+            continue
+        uids = []
+        values = {}
+        for tid, ts, te in children(m, s, e):
+            if tid == TARGETS:
+                uids += [uint(m, xs, xe) for xid, xs, xe
+                         in children(m, ts, te) if xid == TAG_TRACK_UID]
+            elif tid == SIMPLE_TAG:
+                name = value = None
+                for sid, ss, se in children(m, ts, te):
+                    if sid == TAG_NAME:
+                        name = string(m, ss, se)
+                    elif sid == TAG_STRING:
+                        value = string(m, ss, se)
+                if name in STATISTICS and value is not None:
+                    try:
+                        values[STATISTICS[name]] = int(value)
+                    except ValueError:
+                        pass
+        for uid in uids:
+            stats.setdefault(uid, {}).update(values)
+
+
+def _segment(m, a, b, props):
+    """Read the header elements of the segment from <a> to <b>, finding
+    those which lie beyond the first cluster through the SeekHead."""
+    readers = {INFO : _info, TRACKS : _tracks, CHAPTERS : _chapters}
+    found = {}
+    seeks = []
+    for eid, s, e in children(m, a, b):
+        if eid == CLUSTER:
+            break
+        if eid == SEEK_HEAD:
+            for sid, ss, se in children(m, s, e):
+                if sid != SEEK:
+                    continue
+                target = pos = None
+                for xid, xs, xe in children(m, ss, se):
+                    if xid == SEEK_ID:
+                        target = uint(m, xs, xe)
+                    elif xid == SEEK_POSITION:
+                        pos = a + uint(m, xs, xe)
+                if target is not None and pos is not None:
+                    seeks.append((target, pos))
+        elif eid in readers or eid == TAGS:
+            found.setdefault(eid, []).append((s, e))
+    for target, pos in seeks:
+        if target in found or target not in readers and target != TAGS \
+                or pos >= b:
+            continue
+        for eid, s, e in children(m, pos, b):
+            if eid == target:
+                found.setdefault(eid, []).append((s, e))
+            break
+
+    if TRACKS not in found:
+        raise ProbeError("no tracks")
+    for eid in (INFO, TRACKS, CHAPTERS):
+        for s, e in found.get(eid, ()):
+            readers[eid](m, s, e, props)
+    stats = {}
+    for s, e in found.get(TAGS, ()):
+        _tags(m, s, e, stats)
+    for track in props['tracks']:
+        track.update(stats.get(track.get('unique id'), {}))
+
+
+def probe(path):
+    """Return the metadata of the Matroska file <path>, as described above,
+    or None if it is not a Matroska file or its metadata is incomplete
+    (in which case mediainfo should be asked instead)."""
+    try:
+        with open(path, 'rb') as f:
+            if f.read(4) != '\x1a\x45\xdf\xa3':
+                return None
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, ValueError, mmap.error), err:
+        Babble("Cannot probe %s (%s)" % (path, err))
+        return None
+
+    name, ext = os.path.splitext(os.path.basename(path))
+    props = {'complete name'  : path,
+             'folder name'    : os.path.dirname(path),
+             'file name'      : name,
+             'file extension' : ext.lstrip('.'),
+             'file size'      : len(m),
+             'format'         : 'Matroska',
+             'tracks'         : []}
+    try:
+        segment = None
+        for eid, s, e in children(m, 0, len(m)):
+            if eid == EBML:
+                for hid, hs, he in children(m, s, e):
+                    if hid == DOC_TYPE and \
+                            string(m, hs, he) not in ('matroska', 'webm'):
+                        return None
+            elif eid == SEGMENT:
+                segment = (s, e)
+                break
+        if segment is None:
+            raise ProbeError("no segment")
+        _segment(m, segment[0], segment[1], props)
+    except (ProbeError, IndexError, TypeError, struct.error), err:
+        Babble("Cannot probe %s (%s)" % (path, err))
+        return None
+    finally:
+        m.close()
+
+    for track in props['tracks']:
+        if track['type'] != 'menu' and 'bit rate' not in track:
+            # written without statistics tags; only mediainfo can tell
+            Babble("%s has no statistics for track %s" %
+                   (path, track.get('id')))
+            return None
+    return props
@@ -6,6 +6,14 @@ import tempfile
 import shutil
 import subprocess as subp
 from pluginbase import PluginBase
+import jobsched
+from progress import lineHandler
+from filemove import moveFile
+from diskspace import reserve, reserveAll, moveFootprint
+from segencode import SegmentPolicy, segmentedEncode, mediaInfoChapterDurations
+from taskgraph import TaskGraph
+from ratecontrol import RatePolicy, chooseCRF, withQuality, checkBitrate
+from encplanner import withPreset
 
 """
 This plugin remuxes a ripped video to .m2ts in a way that ensures the ps3 
@@ -63,6 +71,24 @@ Configuration settings:
     mux_turboFirstPass (bool):
       If using mux_twoPassEncode, the first (scanning) pass will use 
       speed optimizations, in exchange for a very small impact on quality.
+    mux_sampledRateControl (bool):
+      If set to True, VC-1 -> AVC transcoding is done in a single pass at a 
+      constant rate factor (CRF), chosen by encoding short samples of the 
+      title at several CRFs and fitting their bitrates, instead of in two 
+      passes. The peak bitrate is still capped by the vbv options of 
+      mux_x264opts. If the title is too short to sample, or the samples do not 
+      fit, mux_twoPassEncode applies.
+    mux_rateSamples (int):
+      Number of samples, spread evenly across the title, encoded at each CRF 
+      by mux_sampledRateControl. Default 5.
+    mux_rateSampleLength (int):
+      Length of each sample, in seconds. Default 20.
+    mux_rateSampleCRFs (list(number)):
+      The CRFs at which the samples are encoded. Default [18, 22, 26].
+    mux_rateTolerance (float):
+      How far, as a fraction of the target bitrate, the fit may stray from the 
+      samples before it is rejected. A transcode which misses its target by 
+      more than this is warned about. Default 0.1.
     mux_h264bitrate (int):
       Bitrate at which to transcode VC1 video to H.264 in Kbps. If unset, the 
       same bitrate as the source will be used.
@@ -87,6 +113,17 @@ Configuration settings:
       Command to run dcadec. Set this if dcadec is not in your search path.
     mux_aften (str):
       Command to run aften. Set this if aften is not in your search path.
+    mux_parallelTasks (int):
+      Number of track processing tasks (the extraction of tracks, the VC-1 
+      transcode, and the transcode of each DTS track) which may run at once. 
+      Tasks run as soon as the tasks they depend on are complete; e.g. the 
+      VC-1 transcode runs alongside the extraction. Encoders are also subject 
+      to the 'cpu' budget of jobBudgets.
+    mux_streamExtraction (bool):
+      If set, DTS tracks are extracted into named pipes, from which they are 
+      transcoded as mkvextract goes, instead of being written to the working 
+      directory and read back. All DTS tracks are transcoded at once, as a 
+      single unit of 'cpu' work.
 
 """
 
@@ -97,15 +134,16 @@ Configuration settings:
 # http://www.digital-digest.com/articles/PS3_H.264_Conversion_Guide_page4.html
 # TODO: move vc-1 processing to post-extraction
 
-# TODO: dcadec spews a billion "skip" messages for No Good Reason. It would be
-#       nice to pipe these and trim them out, displaying only relevant messages.
-#       I am not sure how to do this (i.e. pipe between two programs, run them 
-#       both, AND read from the stdout/err of sboth) without risking deadlock.
-
 class struct(object):
     pass
 
 
+def keepDTSLine(stage, line):
+    """Whether a line of output of a DTS transcode is worth keeping."""
+    # dcadec spews 'skip' x 1 billion; aften's progress is noise too
+    return line.strip() != 'skip' and not line.startswith('progress:')
+
+
 #########################
 # Plugin factory method #
 #########################
@@ -147,8 +185,14 @@ class RemuxPlugin(PluginBase):
         outname = fname + ".m2ts"
         outfile = common_util.uniquePath(os.path.join(outdir, outname))
         
-        # perform the mux
-        newfile = self.remux(mediaFilePath, outfile, mediaMetadata, workingDir)
+        # perform the mux, once there is room for it
+        space = self.getSpaceManager()
+        work_bytes, out_bytes = self.estimateFootprint(mediaMetadata)
+        with reserveAll(space, [(workingDir, work_bytes, ()),
+                                (outdir, out_bytes, [outfile])],
+                        "remux of %s" % fname) as rsvs:
+            newfile = self.remux(mediaFilePath, outfile, mediaMetadata, 
+                                 workingDir, rsvs)
         
         # backup and/or delete the original source
         if newfile is not None:
@@ -158,9 +202,14 @@ class RemuxPlugin(PluginBase):
                   not os.path.samefile(bkupdir, os.path.dirname(mediaFilePath)):
                 
                 if not os.path.isdir(bkupdir):
-                    os.path.makedirs(bkupdir)
+                    os.makedirs(bkupdir)
                 dstpath = common_util.uniquePath(os.path.join(bkupdir, media_base))
-                os.rename(mediaFilePath, dstpath)
+                mv_bytes = os.path.getsize(mediaFilePath) * \
+                           moveFootprint(bkupdir, os.path.dirname(mediaFilePath))
+                with reserve(space, bkupdir, mv_bytes, 
+                             "backup of %s" % media_base, [dstpath]):
+                    moveFile(mediaFilePath, dstpath, self.getProgress(), 
+                             'backup')
             elif not self.preserveSrc:
                 os.unlink(mediaFilePath)
                 common_util.Msg("Removed %s" % mediaFilePath) 
@@ -182,6 +231,8 @@ class RemuxPlugin(PluginBase):
             'mux_mkvextract'         : 'mkvextract',
             'mux_dcadec'             : 'dcadec',
             'mux_aften'              : 'aften',
+            'mux_parallelTasks'      : 3,
+            'mux_streamExtraction'   : False,
             
             'mux_subtitleWorkaround' : True,
             'mux_subtitleLangs'      : [], # TODO: revert to None (TEST)
@@ -196,6 +247,11 @@ class RemuxPlugin(PluginBase):
             'mux_h264bitrate'        : None,
             'mux_twoPassEncode'      : True,
             'mux_turboFirstPass'     : True,
+            'mux_sampledRateControl' : False,
+            'mux_rateSamples'        : 5,
+            'mux_rateSampleLength'   : 20,
+            'mux_rateSampleCRFs'     : [18, 22, 26],
+            'mux_rateTolerance'      : 0.1,
             'mux_x264opts'           : 
             
                 {
@@ -261,9 +317,11 @@ class RemuxPlugin(PluginBase):
         self.autoripd_settings = s
     
     
-    def remux(self, infile, outfile, info, workingdir):
+    def remux(self, infile, outfile, info, workingdir, rsvs=None):
         """Remux <infile> into an .m2ts at <outfile>, returning the complete 
-        path of <outfile> upon success, or None upon failure."""
+        path of <outfile> upon success, or None upon failure. <rsvs> holds 
+        the space reserved for the remux in <workingdir>, which is given up 
+        for intermediate files placed on scratch tiers instead."""
         
         fpath    = os.path.abspath(infile)
         outfpath = os.path.abspath(common_util.uniquePath(outfile))
@@ -271,6 +329,8 @@ class RemuxPlugin(PluginBase):
             common_util.Error('File %s could not be found for remuxing' % fpath)
             return None
         titlename = os.path.splitext(info['file name'])[0]
+        self.duration = info.get('duration', 0) / 1000.   # ms
+        self.chapters = mediaInfoChapterDurations(info)
         
         tkProcessData = {}
         
@@ -291,6 +351,18 @@ class RemuxPlugin(PluginBase):
                 meta += result.metaline
                 tkProcessData[id] = result
         
+        if rsvs is not None:
+            # scratch tiers reserve their files themselves; what is written 
+            # to the rest counts against our reservation
+            moved, local = 0, []
+            for result in tkProcessData.itervalues():
+                for path, size in result.workFiles:
+                    if self.inWorkingDir(path, workingdir):
+                        local.append(path)
+                    else:
+                        moved += size
+            rsvs.update(workingdir, moved, local)
+        
         # do the remux
         with tempfile.NamedTemporaryFile(mode='w', 
                                          suffix='.meta', 
@@ -301,7 +373,7 @@ class RemuxPlugin(PluginBase):
             tmpf.flush()
             
             # extract/process streams
-            ok = self.extractTracks(fpath, tkProcessData)
+            ok = self.processTracks(fpath, tkProcessData)
             if not ok:
                 return None
             
@@ -310,7 +382,10 @@ class RemuxPlugin(PluginBase):
             
             # do remux
             mgr = self.getProcessManager()
-            retcode, sout, serr = mgr.call([self.tsMuxeR, metaname, outfpath])
+            mgr.setStage('mux')
+            retcode, sout, serr = mgr.callStreaming(
+                        [self.tsMuxeR, metaname, outfpath],
+                        lineHandler(self.getProgress(), 'tsMuxeR', 'mux'))
             if retcode != 0:
                 common_util.Error('Failure to remux %s to %s' % 
                                  (infile, outfpath))
@@ -332,29 +407,106 @@ class RemuxPlugin(PluginBase):
         return outfpath
     
     
-    def extractTracks(self, srcfile, trackProcessData):
+    def processTracks(self, srcfile, trackProcessData):
+        """Produce all the files to be muxed: extract tracks (in a single 
+        pass), process the extracted tracks, and do the work which needs only 
+        the source file (e.g. a VC-1 transcode). Work which does not depend 
+        on other work runs concurrently, up to mux_parallelTasks at a time.
+        Returns False on failure."""
         procMgr = self.getProcessManager()
+        jobID, stage = procMgr.jobContext()
+        cancelled = []
+        def cancel():
+            # stop the processes of the other tasks, rather than wait hours
+            # for results which will be thrown away
+            if jobID is not None and procMgr.cancelJob(jobID):
+                cancelled.append(jobID)
+        graph = TaskGraph(self.parallelTasks, 
+                          lambda: procMgr.setJobContext(jobID, stage),
+                          cancel)
+        
         files = []
         for id, t in trackProcessData.iteritems():
             if t.extractTo is not None:
                 files.append("%s:%s" % (id, t.extractTo))
-        
-        if len(files) > 0: 
-            common_util.Msg("Extracting tracks from %s" % srcfile)
-            cmd = [self.mkvextract, 'tracks', srcfile] + files
-            retcode, sout, serr = procMgr.call(cmd)
-            
-            if retcode != 0:
-                common_util.Error("Failure to extract track data from %s" % srcfile)
-                common_util.Msg("mkvextract output: %s\n%s" % (sout, serr))
-                return False
-        
-        for dat in trackProcessData.itervalues():
+        streamed = [t for t in trackProcessData.itervalues() if t.streamed]
+        extract = ()
+        if len(streamed) > 0:
+            extract = (graph.add('extract', self.streamTracks, 
+                                 (srcfile, files, streamed)),)
+        elif len(files) > 0: 
+            extract = (graph.add('extract', self.extractTracks, 
+                                 (srcfile, files)),)
+        
+        for id, dat in trackProcessData.iteritems():
+            if dat.doFromSource is not None:
+                fn, args = dat.doFromSource
+                graph.add('track %s' % id, fn, args)
             if hasattr(dat.doOnExtracted, '__call__'):
-                if not dat.doOnExtracted(dat):
-                    # error condition
-                    # autoripd will clean up the working dir
-                    return False
+                graph.add('track %s extracted' % id, dat.doOnExtracted, 
+                          (dat,), extract)
+        
+        # autoripd will clean up the working dir on failure
+        try:
+            return graph.run()
+        finally:
+            # the job itself goes on, to clean up and report the failure
+            for j in cancelled:
+                procMgr.clearCancel(j)
+    
+    
+    def extractTracks(self, srcfile, files):
+        """Extract the tracks <files> (as 'id:file') from <srcfile>."""
+        procMgr = self.getProcessManager()
+        common_util.Msg("Extracting tracks from %s" % srcfile)
+        procMgr.setStage('extract')
+        cmd = [self.mkvextract, 'tracks', srcfile] + files
+        retcode, sout, serr = procMgr.callStreaming(cmd,
+                    lineHandler(self.getProgress(), 'mkvextract', 'extract'))
+        
+        if retcode != 0:
+            common_util.Error("Failure to extract track data from %s" % srcfile)
+            common_util.Msg("mkvextract output: %s\n%s" % (sout, serr))
+            return False
+        return True
+    
+    
+    def streamTracks(self, srcfile, files, streamed):
+        """Extract the tracks <files> from <srcfile>, as extractTracks(), 
+        while the DTS tracks <streamed>, extracted into named pipes, are 
+        transcoded as they arrive. If any program fails, all are stopped."""
+        procMgr = self.getProcessManager()
+        common_util.Msg("Extracting tracks from %s; transcoding %d DTS "
+                        "track(s) as they are extracted" % 
+                        (srcfile, len(streamed)))
+        procMgr.setStage('extract')
+        
+        # the readers go first; each waits for mkvextract to open its pipe.
+        # all are started together, so none can be left waiting for 
+        # admission while the others wait for it
+        pipes   = [self.dtsTranscodeCmds(dat) for dat in streamed]
+        classes = [jobsched.WORK_CPU] * len(pipes)
+        pipes.append([[self.mkvextract, 'tracks', srcfile] + files])
+        classes.append(jobsched.WORK_IO)
+        
+        onProgress = lineHandler(self.getProgress(), 'aften', 'transcode-dts')
+        def onStderr(stage, line):
+            # the first track's aften speaks for all of them
+            if stage == 1 and onProgress is not None:
+                onProgress('stderr', line)
+        
+        result = procMgr.pipelines(pipes, 
+                                   onStderr=onStderr,
+                                   keepLine=keepDTSLine,
+                                   workClasses=classes)
+        common_util.Babble("Extraction output:\n%s" % result.report())
+        
+        missing = [dat.ac3file for dat in streamed 
+                   if not os.path.isfile(dat.ac3file)]
+        if not result.ok() or missing:
+            common_util.Error("Failure to extract and transcode tracks of "
+                              "%s:\n%s" % (srcfile, result.report()))
+            return False
         return True
     
     
@@ -366,7 +518,9 @@ class RemuxPlugin(PluginBase):
         
         Track extraction should not be performed here; we extract tracks all
         at once when track analysis is complete (it's faster this way)-- then 
-        describe any processing on the extracted tracks with a callback."""
+        describe any processing on the extracted tracks with a callback. 
+        Likewise, work which needs only the source file is described, to be 
+        run alongside extraction."""
         
         # we'll return this object:
         tkinfo = struct()
@@ -375,7 +529,12 @@ class RemuxPlugin(PluginBase):
         tkinfo.doOnExtracted = None  # fn to call when extraction complete
                                      # (will be passed the tkinfo object)
                                      # (shall return false on error, true otherwise)
+        tkinfo.doFromSource  = None  # (fn, args) of work needing only the 
+                                     # source file; runs alongside extraction
+        tkinfo.streamed      = False # is extractTo a named pipe, transcoded
+                                     # as it is extracted?
         tkinfo.cleanupFiles  = set() # extra files to delete after mux completed
+        tkinfo.workFiles     = []    # (path, estimated bytes) of intermediates
         tkinfo.metadata = track
         
         codec = track['codec id']
@@ -396,13 +555,14 @@ class RemuxPlugin(PluginBase):
             elif codec == 'WVC1' or codec == 'V_MS/VFW/WVC1':
                 if self.transcodeVC1:
                     h264name = "%s.%s.x264.mkv" % (titlename, id)
-                    h264dest = common_util.uniquePath(
-                                  os.path.join(workingdir, h264name)) 
+                    h264dest = self.workFile(tkinfo, workingdir, h264name,
+                                   self.h264Size(track, self.duration))
                     tracksrc = h264dest
                     trackid  = 1
                     codec    = 'V_MPEG4/ISO/AVC'
                     
-                    self.doTranscodeVC1(srcfile, h264dest, track)
+                    tkinfo.doFromSource = (self.doTranscodeVC1, 
+                                           (srcfile, h264dest, track))
                     
                     tkinfo.cleanupFiles.add(h264dest)
                 else:
@@ -440,8 +600,8 @@ class RemuxPlugin(PluginBase):
                 # save it for when we perform extraction
                 # (we will extract them all at once)
                 pgsname  = "%s.%s.%s.pgs" % (titlename, track['language'], id)
-                tracksrc = common_util.uniquePath(
-                              os.path.join(workingdir, pgsname))
+                tracksrc = self.workFile(tkinfo, workingdir, pgsname,
+                               self.streamSize(track, self.duration))
                 tkinfo.extractTo = tracksrc
                 tracktag = '' # not needed; src file only has one track
             elif codec == 'A_DTS' and self.transcodeDTS:
@@ -449,12 +609,20 @@ class RemuxPlugin(PluginBase):
                 # eventual converted .ac3). the meta file must reflect this
                 dtsname  = "%s.%s.%s.dts" % (titlename, track['language'], id)
                 ac3name  = "%s.%s.%s.ac3" % (titlename, track['language'], id)
-                tracksrc = common_util.uniquePath(
-                              os.path.join(workingdir, ac3name))
-                tkinfo.extractTo = common_util.uniquePath(
-                              os.path.join(workingdir, dtsname))
+                tracksrc = self.workFile(tkinfo, workingdir, ac3name,
+                               self.ac3Size(self.duration))
                 tkinfo.ac3file = tracksrc # extra info for the callback
-                tkinfo.doOnExtracted =  self.doTranscodeDTS
+                if self.streamExtraction:
+                    # mkvextract writes into a named pipe which dcadec reads;
+                    # the .dts never touches the disk
+                    tkinfo.extractTo = common_util.uniquePath(
+                                  os.path.join(workingdir, dtsname))
+                    os.mkfifo(tkinfo.extractTo)
+                    tkinfo.streamed = True
+                else:
+                    tkinfo.extractTo = self.workFile(tkinfo, workingdir, 
+                                   dtsname, self.streamSize(track, self.duration))
+                    tkinfo.doOnExtracted =  self.doTranscodeDTS
                 codec = 'A_AC3'
                 tracktag = ''
             else:
@@ -467,59 +635,62 @@ class RemuxPlugin(PluginBase):
         return tkinfo
     
     
+    def workFile(self, tkinfo, workingdir, name, size):
+        """Return a scratch path for the intermediate file <name>, of about 
+        <size> bytes, of the track described by <tkinfo>, and note it there."""
+        path = self.getScratchPath(workingdir, name, size)
+        tkinfo.workFiles.append((path, size))
+        return path
+    
+    
+    @staticmethod
+    def inWorkingDir(path, workingdir):
+        return os.path.dirname(os.path.abspath(path)) == \
+               os.path.abspath(workingdir)
+    
+    
     def doTranscodeDTS(self, tkinfo):
         pman     = self.getProcessManager()
+        pman.setStage('transcode-dts')
         metadata = tkinfo.metadata
         dtsfile  = tkinfo.extractTo
         ac3file  = tkinfo.ac3file
         
         common_util.Msg("Encoding DTS track %s to AC3" % metadata['unique id'])
         
-        try:
-            devnull = open(os.devnull, 'w')
-            dcadec_cmd = [self.dcadec, '-o', 'wavall', dtsfile]
-            
-            # we directly pipe the decoded stream to aften for encoding to avoid
-            # writing an enormous 2-hour 6-channel WAV file to disk
-            with pman.Popen(dcadec_cmd, 
-                            stdout=subp.PIPE,
-                            # really important; dcadec spews 'skip' x 1 billion
-                            stderr=devnull) as decodp:
-                
-                aften_cmd = [self.aften, '-b', str(self.dtsBitrate),
-                             '-w', str(self.dtsBandwidth),
-                             '-v', '0',
-                             '-', ac3file]
-                
-                with pman.Popen(aften_cmd,
-                                stderr=subp.PIPE,
-                                stdout=subp.PIPE,
-                                stdin=decodp.stdout) as encodp:
-                    decodp.stdout.close() # release our handle on this pipe
-                    e_sout, e_serr = encodp.communicate()
-                    d_ret = decodp.wait()
-                    e_ret = encodp.returncode
-            devnull.close()
-        except OSError, err:
-            if err.errno == errno.ENOENT:
-                Error("Trouble launching program while transcoding DTS. "
-                      "Are dcadec and aften installed?")
-            try:
-                devnull.close()
-            except:
-                pass
-            raise
-        
-        common_util.Babble("aften output:\n%s\n%s" % (e_sout, e_serr))
-        
-        if e_ret != 0 or d_ret != 0 or not os.path.isfile(ac3file):
-            common_util.Error("Error re-encoding DTS track")
+        # we directly pipe the decoded stream to aften for encoding to avoid
+        # writing an enormous 2-hour 6-channel WAV file to disk
+        onProgress = lineHandler(self.getProgress(), 'aften', 'transcode-dts')
+        def onStderr(stage, line):
+            if stage == 1 and onProgress is not None:
+                onProgress('stderr', line)
+        
+        result = pman.pipeline(self.dtsTranscodeCmds(tkinfo),
+                               onStderr=onStderr, 
+                               keepLine=keepDTSLine)
+        
+        common_util.Babble("DTS transcode output:\n%s" % result.report())
+        
+        if not result.ok() or not os.path.isfile(ac3file):
+            common_util.Error("Error re-encoding DTS track:\n%s" % 
+                              result.report())
             return False
         else:
             os.unlink(dtsfile)
             return True
     
     
+    def dtsTranscodeCmds(self, tkinfo):
+        """Return the commands of the dcadec | aften pipe which transcodes 
+        the extracted DTS track of <tkinfo> to AC3."""
+        dcadec_cmd = [self.dcadec, '-o', 'wavall', tkinfo.extractTo]
+        aften_cmd  = [self.aften, '-b', str(self.dtsBitrate),
+                      '-w', str(self.dtsBandwidth),
+                      '-v', '1',
+                      '-', tkinfo.ac3file]
+        return [dcadec_cmd, aften_cmd]
+    
+    
     def doTranscodeVC1(self, srcfile, outfile, trackinfo):
         id = trackinfo['unique id']
         if self.h264bitrate is None:
@@ -540,7 +711,6 @@ class RemuxPlugin(PluginBase):
         
         txcode_cmd = ['HandBrakeCLI', 
                       '-i', srcfile,
-                      '-o', outfile, 
                         # no audio
                       '-a', 'none',
                       '-e', 'x264',
@@ -550,34 +720,127 @@ class RemuxPlugin(PluginBase):
                       '-r', framerate,
                       '-x', encopts]
         
-        if self.twoPassEncode:
+        mgr = self.getProcessManager()
+        mgr.setStage('transcode-vc1')
+        
+        planner = self.getEncodePlanner()
+        if planner is not None:
+            # 'Interlaced', 'MBAFF' or 'Progressive', if known
+            scan = trackinfo.get('scan type')
+            interlaced = None if scan is None else scan != 'Progressive'
+            preset = planner.choose(txcode_cmd, 
+                                    "%sx%s" % (trackinfo['width'], 
+                                               trackinfo['height']),
+                                    self.duration, float(framerate), mgr,
+                                    os.path.dirname(outfile), interlaced)
+            # chosen first, since the bitrate of a CRF depends on the preset
+            if preset is not None:
+                txcode_cmd = withPreset(txcode_cmd, preset)
+        
+        crf = None
+        if self.sampledRateControl:
+            policy = RatePolicy(self.rateSamples, 
+                                self.rateSampleLength,
+                                self.rateSampleCRFs,
+                                self.rateTolerance)
+            crf = chooseCRF(txcode_cmd, self.duration, int(bitrate),
+                            os.path.dirname(outfile), mgr, policy)
+            if crf is None:
+                common_util.Warn("Falling back to a bitrate-targeted "
+                                 "transcode of video track %s" % id)
+        
+        if crf is not None:
+            # one pass at constant quality; the VBV options cap the peaks
+            txcode_cmd = withQuality(txcode_cmd, crf)
+        elif self.twoPassEncode:
             txcode_cmd += ['--two-pass']
             if self.turboFirstPass:
                 txcode_cmd += ['--turbo']
         
-        printFriendlyCmd = " ".join(txcode_cmd)
-        
         common_util.Msg("Transcoding video track %s to H.264" % id)
+        
+        s = self.autoripd_settings
+        if s.segmentedEncode:
+            policy   = SegmentPolicy(s.encodeSegments, s.minSegmentDuration)
+            segments = policy.plan(self.chapters)
+            if segments:
+                # -b is a rate, so every segment is encoded alike
+                if segmentedEncode(txcode_cmd, outfile, segments, 
+                                   os.path.dirname(outfile), mgr, 
+                                   self.getProgress(), 
+                                   'transcode-vc1',
+                                   inputs=[srcfile],
+                                   duration=self.duration,
+                                   fps=float(framerate)) is None:
+                    raise Exception("Segmented transcode of video track %s "
+                                    "failed" % id)
+                if crf is not None:
+                    checkBitrate(outfile, self.duration, int(bitrate),
+                                 self.rateTolerance)
+                common_util.Msg("Transcode complete.")
+                return
+        
+        txcode_cmd += ['-o', outfile]
+        printFriendlyCmd = " ".join(txcode_cmd)
         common_util.Babble("Video endoding cmd: %s" % printFriendlyCmd)
         
-        mgr = self.getProcessManager()
-        retcode, sout, serr = mgr.call(txcode_cmd)
+        # a background job; it must yield the machine to disc reads
+        retcode, sout, serr = mgr.callEncoder(txcode_cmd,
+                lineHandler(self.getProgress(), 'HandBrakeCLI', 'transcode-vc1'),
+                [srcfile],
+                [outfile],
+                workClass=jobsched.WORK_CPU)
         
         if retcode == 0:
+            if crf is not None:
+                checkBitrate(outfile, self.duration, int(bitrate),
+                             self.rateTolerance)
             common_util.Msg("Transcode complete.")
         else:
             raise subp.CalledProcessError(retcode, printFriendlyCmd)
     
     
-    def checkSpace(self, srcfile):
-        #TODO: actually call this
-        #TODO: engineer a consistent framework for calling this.
-        srcdir  = os.path.dirname(srcfile)
-        srcsize = os.path.getsize(srcdir)
-        st      = os.statvfs(srcdir)
-        avail   = st.f_bavail * st.f_frsize
-        
-        # we will need space for the both final remuxed movie and the 
-        # intermediate re-encoding. Each of these may be somewhat larger
-        # than the source, so we demand an extra 25% for safety.
-        return avail > 2.25 * srcsize
+    def estimateFootprint(self, info):
+        """Return (working_bytes, output_bytes): the estimated peak disk space 
+        needed in the working directory for extracted and transcoded tracks, 
+        and the estimated size of the .m2ts, for the media described by 
+        <info>. Languages are not taken into account; overestimating is safe."""
+        duration = info.get('duration', 0) / 1000.   # ms
+        work = 0
+        for track in info['tracks']:
+            codec = track.get('codec id')
+            if codec == 'S_HDMV/PGS' and self.subtitleWorkaround:
+                work += self.streamSize(track, duration)
+            elif codec == 'A_DTS' and self.transcodeDTS:
+                # the extracted .dts (unless streamed) and its .ac3 transcode
+                work += self.ac3Size(duration)
+                if not self.streamExtraction:
+                    work += self.streamSize(track, duration)
+            elif codec in ('WVC1', 'V_MS/VFW/WVC1') and self.transcodeVC1:
+                work += self.h264Size(track, duration)
+        # the .m2ts holds (roughly) the same streams as the source, plus the
+        # overhead of the transport stream
+        out = int(info.get('file size', 0) * 1.05)
+        return int(work), out
+    
+    
+    def streamSize(self, track, duration):
+        """Return the (estimated) size in bytes of the stream of <track>, in 
+        a title of <duration> seconds."""
+        size = track.get('stream size')
+        if not isinstance(size, int):
+            size = int(track.get('bit rate', 0) / 8 * duration)
+        return size
+    
+    
+    def ac3Size(self, duration):
+        """Return the size of an AC3 transcode of <duration> seconds."""
+        return int(self.dtsBitrate * 1000 / 8 * duration)
+    
+    
+    def h264Size(self, track, duration):
+        """Return the estimated size of the H.264 transcode of the video 
+        <track>, in a title of <duration> seconds."""
+        if self.h264bitrate is not None:
+            return int(self.h264bitrate * 1000 / 8 * duration)
+        return self.streamSize(track, duration)
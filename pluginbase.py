@@ -1,4 +1,6 @@
 import procmgmt
+import scratch
+import ripdisc
 
 """
 All plugin modules should expose a subclass of PluginBase.
@@ -6,8 +8,14 @@ All plugin modules should expose a subclass of PluginBase.
 
 class PluginBase:
     
-    def __init__(self, procmgr=procmgmt.DFT_MGR):
+    def __init__(self, procmgr=procmgmt.DFT_MGR, progress=None, space=None,
+                       scratch=None, planner=None, mediaCache=None):
         self.procmgr = procmgr
+        self.progress = progress
+        self.space = space
+        self.scratch = scratch
+        self.planner = planner
+        self.mediaCache = mediaCache
     
     def processRip(self, mediaFilePath,
                          mediaMetadata, 
@@ -49,5 +57,44 @@ class PluginBase:
         handles logging and safe process termination when the daemon exits.""" 
         
         return self.procmgr
-
-
+    
+    
+    def getProgress(self):
+        """Return the progress.JobProgress to which this plugin should report 
+        the progress of the job it is processing, or None if progress is not 
+        being collected."""
+        
+        return self.progress
+    
+    
+    def getSpaceManager(self):
+        """Return the diskspace.SpaceManager with which this plugin should 
+        reserve space for the files it writes (see diskspace.reserveAll()), or 
+        None if disk space is not being managed."""
+        
+        return self.space
+    
+    
+    def getScratchPath(self, workingDir, name, size=None):
+        """Return a path at which to write the intermediate file <name>, of 
+        about <size> bytes (if known), for the job working in <workingDir>. 
+        The file is placed on the fastest scratch storage with room for it, 
+        and is removed with the working directory when the job ends."""
+        
+        return scratch.scratchPath(self.scratch, workingDir, name, size)
+    
+    
+    def getEncodePlanner(self):
+        """Return the encplanner.EncodePlanner which should choose the x264 
+        preset of any encode this plugin runs, or None if presets are not 
+        being chosen by throughput."""
+        
+        return self.planner
+    
+    
+    def getMediaInfo(self, path):
+        """Return the media info of the file <path>, as passed to processRip() 
+        for the ripped file, or None on failure. Files which have been probed 
+        before, and not changed since, are not probed again."""
+        
+        return ripdisc.mediaInfoData(path, self.procmgr, self.mediaCache)
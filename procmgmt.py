@@ -1,8 +1,30 @@
+import os, sys
+import re
+import select
 import subprocess as subp
 import time
 import thread
 import errno
-from common_util import Error, Babble
+import signal
+import collections
+import common_util
+import jobsched
+import accounting
+import threading
+from common_util import Error, Warn, Babble
+
+# number of trailing output lines kept by streamed calls for error reports
+DFT_TAIL_LINES = 200
+# lines longer than this are broken up, so a child which never emits a newline
+# cannot make us buffer without bound
+MAX_LINE_LEN = 65536
+READ_CHUNK = 65536
+# seconds for which the stderr of an exited pipe stage is still read; longer
+# only if something the stage left running keeps the pipe open
+DRAIN_TIMEOUT = 5
+
+# progress meters (HandBrake, tsMuxeR, etc.) overwrite their line with '\r'
+_LINE_SPLIT = re.compile(r'\r\n|\r|\n')
 
 ###########################
 # Process Management      #
@@ -11,6 +33,12 @@ from common_util import Error, Babble
 class SpawnLockedException(Exception):
     pass 
 
+class JobCancelledException(SpawnLockedException):
+    pass
+
+class ProcessTimeout(Exception):
+    pass
+
 
 class ProcessManager:
     """Class for keeping track of child processes. All processes spawned from 
@@ -19,50 +47,309 @@ class ProcessManager:
     signal. 
     
     A process "start lock" is provided so that when the daemon recieves the 
-    SIGTERM, it can safely prevent new child processes from spawning."""
+    SIGTERM, it can safely prevent new child processes from spawning.
     
-    def __init__(self):
+    If a jobsched.JobScheduler is given, each child must first be admitted 
+    by it; Popen() blocks until the child's class of work is within budget.
+    If a procprio.PriorityPolicy is given, each child runs with the priority 
+    of its class of work. If an accounting.Accountant is given, the resources 
+    used by each child are recorded, along with the job and stage set for the 
+    spawning thread by setJobContext().
+    
+    If a jobengine.JobEngine is attached (as `engine`), the output of 
+    call() and callStreaming() is serviced by the engine's event loop rather 
+    than by the calling thread. If a remoteenc.RemoteEncoder is attached (as 
+    `remote`), callEncoder() runs encodes on other machines."""
+    
+    def __init__(self, scheduler=None, priorities=None, accountant=None):
         self._threadlock = thread.allocate_lock()
-        self._pids = set()
+        self._pids = {}
+        self._cancelled = set()
         self._startlock = False
+        self._scheduler = scheduler
+        self._priorities = priorities
+        self._context = threading.local()
+        self.accountant = accountant
+        self.engine = None
+        self.remote = None
     
     def Popen(self, *args, **kwargs):
+        """Spawn a child process, accepting the same arguments as 
+        subprocess.Popen, plus an optional `workClass` (one of the jobsched 
+        WORK_* classes) which overrides the class guessed from the command."""
+        workClass = kwargs.pop('workClass', None)
         if self._startlock:
             sys.stdout.flush()
             raise SpawnLockedException("process spawning is locked")
-        else:
+        jobID, stage = self.jobContext()
+        self._checkCancelled(jobID)
+        
+        cmd = args[0] if args else kwargs['args']
+        if workClass is None:
+            workClass = jobsched.classifyCommand(cmd)
+        if self._priorities is not None:
+            kwargs['preexec_fn'] = self._priorities.preexecFn(
+                                       workClass, kwargs.get('preexec_fn'))
+        
+        ticket = self._admit(cmd, workClass)
+        try:
+            if self._startlock:
+                # we may have been waiting for admission for a long time
+                raise SpawnLockedException("process spawning is locked")
+            self._checkCancelled(jobID)
             p = subp.Popen(*args, **kwargs)
-            self.addProcess(p.pid)
-            return PopenWrapper(p, self)
+        except:
+            if ticket is not None:
+                self._scheduler.release(ticket)
+            raise
+        self.addProcess(p.pid, jobID)
+        return PopenWrapper(p, self, ticket=ticket, args=list(cmd),
+                            context=(jobID, stage))
+    
+    def _admit(self, cmd, workClass):
+        """Wait for the scheduler to admit <cmd>. Returns the scheduler 
+        ticket, or None if <cmd> is not subject to admission control."""
+        if self._scheduler is None or workClass is None:
+            return None
+        try:
+            return self._scheduler.acquire(workClass, os.path.basename(cmd[0]))
+        except jobsched.SchedulerClosed:
+            raise SpawnLockedException("process spawning is locked")
+    
+    def releaseTicket(self, ticket):
+        self._scheduler.release(ticket)
+    
+    def setJobContext(self, jobID, stage=None):
+        """Declare that processes spawned by the current thread work on 
+        behalf of <jobID>, in <stage>."""
+        self._context.jobID = jobID
+        self._context.stage = stage
+    
+    def setStage(self, stage):
+        """Change the stage of the current thread's job."""
+        self._context.stage = stage
+    
+    def jobContext(self):
+        """Return (jobID, stage) of the current thread."""
+        return (getattr(self._context, 'jobID', None),
+                getattr(self._context, 'stage', None))
+    
+    def endJob(self, jobID):
+        """The current thread is finished with <jobID>."""
+        self.setJobContext(None)
+        with self._threadlock:
+            self._cancelled.discard(jobID)
+    
+    def cancelJob(self, jobID):
+        """Terminate the running processes of <jobID>, and refuse to start 
+        any more of them. Returns False if <jobID> was already cancelled."""
+        with self._threadlock:
+            if jobID in self._cancelled:
+                return False
+            self._cancelled.add(jobID)
+            pids = [pid for pid, j in self._pids.iteritems() if j == jobID]
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError, err:
+                if err.errno != errno.ESRCH:
+                    raise
+        return True
+    
+    def clearCancel(self, jobID):
+        """Allow <jobID> to start processes again after cancelJob(), e.g. 
+        once the part of it which was cancelled has stopped."""
+        with self._threadlock:
+            self._cancelled.discard(jobID)
     
-    def call(self, args):
+    def _checkCancelled(self, jobID):
+        if jobID is not None and jobID in self._cancelled:
+            raise JobCancelledException("job %s was cancelled" % jobID)
+    
+    def _run(self, args, onData, workClass=None, timeout=None):
+        """Run <args>, passing each chunk of its output to 
+        onData(stream_name, data). Returns the exit code. Raises 
+        ProcessTimeout (having killed the child) if the child runs for more 
+        than <timeout> seconds."""
         try:
-            with self.Popen(args,
+            if self.engine is not None:
+                return self.engine.run(args, onData, workClass, timeout)
+            with self.Popen(args, workClass=workClass,
                             stdout=subp.PIPE, stderr=subp.PIPE) as pipe:
-                sout, serr = pipe.communicate()
-                Babble("%s output:\n%s\n%s\n" % (args[0], sout, serr))
-                return pipe.returncode, sout, serr
+                streams = [('stdout', pipe.stdout), ('stderr', pipe.stderr)]
+                for src, chunk in readChunks(streams, timeout):
+                    onData(src, chunk)
+                return pipe.wait()
         except OSError, err:
             if err.errno == errno.ENOENT:
                 Error("%s could not be found. Is it installed?" % args[0])
             raise
     
-    def addProcess(self, pid):
+    def call(self, args, workClass=None, timeout=None):
+        """Run <args> to completion and return (returncode, stdout, stderr).
+        The complete output is held in memory; use callStreaming() for 
+        long-running or chatty programs."""
+        output = {'stdout' : [], 'stderr' : []}
+        retcode = self._run(args, lambda src, data: output[src].append(data),
+                            workClass, timeout)
+        sout, serr = ''.join(output['stdout']), ''.join(output['stderr'])
+        if common_util.verbose:
+            Babble("%s output:\n%s\n%s\n" % (args[0], sout, serr))
+        return retcode, sout, serr
+    
+    def stream(self, args, tailLines=DFT_TAIL_LINES, workClass=None):
+        """Return a StreamedCall which runs <args> when iterated, yielding 
+        (stream_name, line) pairs as the child produces them. Only the last 
+        <tailLines> lines of each stream are retained."""
+        return StreamedCall(self, args, tailLines, workClass)
+    
+    def callStreaming(self, args, onLine=None, tailLines=DFT_TAIL_LINES,
+                      workClass=None, timeout=None):
+        """Like call(), but the output is never held in memory in its 
+        entirety. Each line is passed to onLine(stream_name, line) as it 
+        arrives (stream_name is 'stdout' or 'stderr'). Returns 
+        (returncode, stdout_tail, stderr_tail), where the tails are the last 
+        <tailLines> lines of each stream, for error reporting."""
+        splitters = {'stdout' : LineSplitter(), 'stderr' : LineSplitter()}
+        tails = {'stdout' : collections.deque(maxlen=tailLines),
+                 'stderr' : collections.deque(maxlen=tailLines)}
+        
+        def take(src, lines):
+            for line in lines:
+                tails[src].append(line)
+                if onLine is not None:
+                    onLine(src, line)
+        
+        retcode = self._run(args, 
+                            lambda src, data: take(src, splitters[src].feed(data)),
+                            workClass, timeout)
+        for src, splitter in splitters.iteritems():
+            take(src, splitter.flush())
+        
+        sout, serr = "\n".join(tails['stdout']), "\n".join(tails['stderr'])
+        if common_util.verbose:
+            Babble("%s output (tail):\n%s\n%s\n" % (args[0], sout, serr))
+        return retcode, sout, serr
+    
+    def callEncoder(self, args, onLine=None, inputs=None, outputs=(),
+                    tailLines=DFT_TAIL_LINES, workClass=None):
+        """Like callStreaming(), for a CPU-heavy command which reads only the 
+        files or folders <inputs> and writes only the files <outputs>. If a 
+        remoteenc.RemoteEncoder is attached (as `remote`), the command is run 
+        by an encode worker, unless <inputs> is None (the command reads 
+        something which cannot be sent, e.g. a drive) or no worker is 
+        available."""
+        if self.remote is not None and inputs is not None:
+            jobID = self.jobContext()[0]
+            self._checkCancelled(jobID)
+            result = self.remote.run(args, onLine, inputs, outputs, tailLines,
+                                     lambda: jobID in self._cancelled)
+            if result is not None:
+                return result
+            self._checkCancelled(jobID)
+            Warn("Running %s locally" % os.path.basename(args[0]))
+        return self.callStreaming(args, onLine, tailLines, workClass)
+    
+    def pipeline(self, cmds, stdout=None, onStderr=None, keepLine=None,
+                 tailLines=DFT_TAIL_LINES, workClass=None, timeout=None):
+        """Run the commands in <cmds> as a shell-style pipe 
+        (cmds[0] | cmds[1] | ...), and wait for all of them to finish. 
+        
+        The stderr of every stage is read concurrently (so no stage can block 
+        on a full pipe), passed line by line to onStderr(stage_index, line), 
+        and its last <tailLines> lines retained; if given, 
+        keepLine(stage_index, line) decides which lines are worth retaining. 
+        The last stage's stdout goes to the file object or descriptor 
+        <stdout>, or to /dev/null. If any stage fails, the others are 
+        terminated. Raises ProcessTimeout if the pipe is not finished after 
+        <timeout> seconds.
+        
+        Returns a PipelineResult."""
+        return self.pipelines([cmds], [stdout], onStderr, keepLine, tailLines,
+                              [workClass], timeout)
+    
+    def pipelines(self, pipes, stdouts=None, onStderr=None, keepLine=None,
+                  tailLines=DFT_TAIL_LINES, workClasses=None, timeout=None):
+        """Like pipeline(), but runs several pipes (each a list of commands) 
+        at once, e.g. a program writing to named pipes and the programs 
+        reading them. stdouts[i] and workClasses[i] apply to pipes[i]. Stages 
+        are numbered across all the pipes, in order, and if any stage fails, 
+        the stages of all the pipes are terminated. 
+        
+        All the stages are started by the calling thread, so that once one 
+        is admitted by the scheduler, the rest of its class are too; a group 
+        of processes which need each other to make progress cannot be left 
+        half started.
+        
+        Returns a PipelineResult covering all the stages."""
+        if stdouts is None:
+            stdouts = [None] * len(pipes)
+        if workClasses is None:
+            workClasses = [None] * len(pipes)
+        cmds = [cmd for pipe in pipes for cmd in pipe]
+        devnull = None
+        stages = []
+        try:
+            try:
+                for pipe, stdout, workClass in zip(pipes, stdouts, workClasses):
+                    if stdout is None:
+                        if devnull is None:
+                            devnull = open(os.devnull, 'w')
+                        stdout = devnull
+                    stdin = None
+                    for i, cmd in enumerate(pipe):
+                        last = (i == len(pipe) - 1)
+                        p = self.Popen(cmd, workClass=workClass,
+                                       stdin=stdin,
+                                       stdout=stdout if last else subp.PIPE,
+                                       stderr=subp.PIPE)
+                        if stdin is not None:
+                            # the pipe now belongs to the two children
+                            stdin.close()
+                        stdin = p.stdout
+                        stages.append(p)
+                return _runPipeline(cmds, stages, onStderr, keepLine, 
+                                    tailLines, timeout)
+            except:
+                for p in stages:
+                    p.terminate()
+                for p in stages:
+                    p.wait()
+                raise
+        except OSError, err:
+            if err.errno == errno.ENOENT:
+                Error("%s could not be found. Is it installed?" % 
+                      cmds[len(stages)][0])
+            raise
+        finally:
+            if devnull is not None:
+                devnull.close()
+    
+    def addProcess(self, pid, jobID=None):
         with self._threadlock:
-            self._pids.add(pid)
+            self._pids[pid] = jobID
     
     def releaseProcess(self, pid):
         with self._threadlock:
-            self._pids.remove(pid)
+            del self._pids[pid]
     
     def lockProcessStart(self):
         """Prevent any new processes from being launched."""
         with self._threadlock:
             self._startlock = True
+        if self._scheduler is not None:
+            # don't leave anyone waiting for admission
+            self._scheduler.shutdown()
     
     def unlockProcessStart(self):
         with self._threadlock:
             self._startlock = False
+        if self._scheduler is not None:
+            self._scheduler.reopen()
+    
+    def isProcessStartLocked(self):
+        with self._threadlock:
+            return self._startlock
     
     def getActivePIDs(self):
         pidsCopy = None
@@ -71,37 +358,303 @@ class ProcessManager:
         return pidsCopy
 
 
+class StageResult:
+    """Outcome of one stage of a pipeline."""
+    
+    def __init__(self, args, returncode, stderrTail, wallTime, usage=None):
+        self.args       = args
+        self.returncode = returncode
+        self.stderrTail = stderrTail
+        self.wallTime   = wallTime
+        self.usage      = usage   # an accounting.ResourceRecord, if recorded
+
+
+class PipelineResult:
+    """Outcome of ProcessManager.pipeline(): a StageResult per stage."""
+    
+    def __init__(self, stages):
+        self.stages = stages
+    
+    def ok(self):
+        return all(st.returncode == 0 for st in self.stages)
+    
+    def returncodes(self):
+        return [st.returncode for st in self.stages]
+    
+    def report(self):
+        """Describe each stage's exit code and last stderr output."""
+        s = ''
+        for st in self.stages:
+            s += "%s exited with %s (%.1fs); stderr:\n%s\n" % (
+                     os.path.basename(st.args[0]), st.returncode, 
+                     st.wallTime, st.stderrTail)
+        return s
+
+
+def _runPipeline(cmds, stages, onStderr, keepLine, tailLines, timeout):
+    """Drain the stderr of all <stages> until they have all finished, 
+    terminating the rest as soon as one fails."""
+    t_start   = time.time()
+    deadline  = None if timeout is None else t_start + timeout
+    poller    = select.poll()
+    fds       = {}
+    splitters = [LineSplitter() for p in stages]
+    tails     = [collections.deque(maxlen=tailLines) for p in stages]
+    walltimes = [None] * len(stages)
+    for i, p in enumerate(stages):
+        fds[p.stderr.fileno()] = i
+        poller.register(p.stderr, select.POLLIN | select.POLLHUP | select.POLLERR)
+    
+    def take(i, lines):
+        for line in lines:
+            if keepLine is None or keepLine(i, line):
+                tails[i].append(line)
+            if onStderr is not None:
+                onStderr(i, line)
+    
+    def read(wait_ms):
+        try:
+            events = poller.poll(wait_ms)
+        except select.error, err:
+            if err.args[0] == errno.EINTR:
+                return
+            raise
+        for fd, evt in events:
+            i = fds[fd]
+            chunk = os.read(fd, READ_CHUNK)
+            if len(chunk) == 0:
+                poller.unregister(fd)
+                del fds[fd]
+                take(i, splitters[i].flush())
+            else:
+                take(i, splitters[i].feed(chunk))
+    
+    failed = False
+    while any(p.returncode is None for p in stages):
+        if deadline is not None and time.time() > deadline:
+            raise ProcessTimeout("pipe still running after %s seconds" % 
+                                 timeout)
+        # wake up now and then to check for exited stages
+        read(250 if fds else 50)
+        for i, p in enumerate(stages):
+            if p.returncode is None and p.poll() is not None:
+                walltimes[i] = time.time() - t_start
+                if p.returncode != 0 and not failed:
+                    # no point in continuing; the output is broken.
+                    failed = True
+                    for other in stages:
+                        other.terminate()
+    
+    # what the stages wrote just before they exited (often the reason they 
+    # failed) may still be in the pipes
+    drained = time.time() + DRAIN_TIMEOUT
+    while fds and time.time() < drained:
+        read(100)
+    for i in fds.itervalues():
+        take(i, splitters[i].flush())
+    for p in stages:
+        p.stderr.close()
+    return PipelineResult([StageResult(cmds[i], p.returncode, 
+                                       "\n".join(tails[i]), walltimes[i], 
+                                       p.usage)
+                           for i, p in enumerate(stages)])
+
+
+class StreamedCall:
+    """Iterable over the output of a child process, line by line. The process
+    is spawned when iteration begins and is terminated if iteration is 
+    abandoned early (e.g. by an exception in the consuming code). After 
+    iteration completes, `returncode` is set."""
+    
+    def __init__(self, procman, args, tailLines=DFT_TAIL_LINES, workClass=None):
+        self.args = args
+        self.returncode = None
+        self._procman = procman
+        self._workClass = workClass
+        self._tails = {'stdout' : collections.deque(maxlen=tailLines),
+                       'stderr' : collections.deque(maxlen=tailLines)}
+    
+    def __iter__(self):
+        with self._procman.Popen(self.args,
+                                 workClass=self._workClass,
+                                 stdout=subp.PIPE, 
+                                 stderr=subp.PIPE) as pipe:
+            streams = [('stdout', pipe.stdout), ('stderr', pipe.stderr)]
+            for src, line in readLines(streams):
+                self._tails[src].append(line)
+                yield src, line
+            self.returncode = pipe.wait()
+    
+    def tail(self, streamName):
+        """Return the retained last lines of the named stream as a string."""
+        return "\n".join(self._tails[streamName])
+
+
+def readChunks(streams, timeout=None):
+    """Read from several pipes at once without risk of deadlock, yielding
+    (name, data) pairs as data arrives, until every pipe is closed. <streams> 
+    is a list of (name, fileobject) pairs. Raises ProcessTimeout if the pipes 
+    are still open after <timeout> seconds."""
+    poller = select.poll()
+    names = {}
+    for name, f in streams:
+        fd = f.fileno()
+        names[fd] = name
+        poller.register(fd, select.POLLIN | select.POLLHUP | select.POLLERR)
+    
+    deadline = None if timeout is None else time.time() + timeout
+    while len(names) > 0:
+        wait_ms = None
+        if deadline is not None:
+            wait_ms = int((deadline - time.time()) * 1000)
+            if wait_ms <= 0:
+                raise ProcessTimeout("no EOF after %s seconds" % timeout)
+        try:
+            events = poller.poll(wait_ms)
+        except select.error, err:
+            if err.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd, evt in events:
+            chunk = os.read(fd, READ_CHUNK)
+            if len(chunk) == 0:
+                # EOF
+                poller.unregister(fd)
+                del names[fd]
+            else:
+                yield names[fd], chunk
+
+
+def readLines(streams):
+    """As readChunks(), but yields (name, line) pairs as complete lines 
+    arrive. Lines are split on both '\\n' and '\\r'; blank lines are 
+    dropped."""
+    splitters = dict((name, LineSplitter()) for name, f in streams)
+    for name, chunk in readChunks(streams):
+        for line in splitters[name].feed(chunk):
+            yield name, line
+    
+    for name, splitter in splitters.iteritems():
+        for line in splitter.flush():
+            yield name, line
+
+
+class LineSplitter:
+    """Splits a stream of data into lines as it arrives. Lines are split on 
+    both '\\n' and '\\r'; blank lines are dropped, and lines longer than 
+    MAX_LINE_LEN are broken up."""
+    
+    def __init__(self):
+        self._partial = ''
+    
+    def feed(self, chunk):
+        """Return the list of lines completed by <chunk>."""
+        lines = _LINE_SPLIT.split(self._partial + chunk)
+        partial = lines.pop()
+        if len(partial) > MAX_LINE_LEN:
+            lines.append(partial)
+            partial = ''
+        self._partial = partial
+        return [line for line in lines if len(line) > 0]
+    
+    def flush(self):
+        """Return the unterminated last line, if any."""
+        partial, self._partial = self._partial, ''
+        return [partial] if len(partial) > 0 else []
+
+
 class PopenWrapper:
     """Wrapper for a subprocess.Popen object that keeps track of when the 
     process finishes, and reports this to its parent ProcessManager."""
     
-    def __init__(self, pipe, procman, killtimeout=1.0):
+    def __init__(self, pipe, procman, killtimeout=1.0, ticket=None, 
+                 args=None, context=(None, None)):
         self._pipe = pipe
         self._procman = procman
         self._timeout = killtimeout
+        self._ticket = ticket
         self._released = False
+        self._args = args
+        self._context = context
+        self._t_start = time.time()
         self.returncode = None
+        self.usage = None
         self.stdout = pipe.stdout
         self.stdin = pipe.stdin
-        self.stder = pipe.stderr
+        self.stderr = pipe.stderr
         self.pid = pipe.pid
     
     def poll(self):
-        ret = self._pipe.poll()
-        if ret is not None:
-            #process has finished. log it as done.
-            self.release()
-        return ret
+        return self._collect(block=False)
     
     def wait(self):
-        ret = self._pipe.wait()
-        self.release()
-        return ret
+        return self._collect(block=True)
     
     def communicate(self, input=None):
-        out = self._pipe.communicate(input)
+        """As subprocess.Popen.communicate(). <input> must be small enough to 
+        fit in the pipe's buffer."""
+        if self.stdin is not None:
+            if input:
+                self.stdin.write(input)
+            self.stdin.close()
+        output = {'stdout' : [], 'stderr' : []}
+        streams = [(name, f) for name, f in (('stdout', self.stdout), 
+                                             ('stderr', self.stderr))
+                   if f is not None]
+        for name, chunk in readChunks(streams):
+            output[name].append(chunk)
+        for name, f in streams:
+            f.close()
+        self.wait()
+        return tuple(''.join(output[name]) if getattr(self, name) else None
+                     for name in ('stdout', 'stderr'))
+    
+    def _collect(self, block):
+        """Reap the child if it has finished, waiting for it to do so if 
+        <block> is set. Returns the exit code, or None if the child is still 
+        running."""
+        if self._pipe.returncode is None:
+            accountant = self._procman.accountant
+            if accountant is None:
+                ret = self._pipe.wait() if block else self._pipe.poll()
+                if ret is None:
+                    return None
+            else:
+                # the child's I/O counters vanish when it is reaped, so
+                # read them while it is a zombie
+                if not accounting.waitExited(self.pid, block):
+                    return None
+                io = accounting.readProcIO(self.pid)
+                status, rusage = accounting.reap(self.pid)
+                self._pipe._handle_exitstatus(status)
+                jobID, stage = self._context
+                tool = os.path.basename(self._args[0]) if self._args else None
+                self.usage = accounting.ResourceRecord(
+                                 tool, self._args, jobID, stage, self.pid,
+                                 self._pipe.returncode, 
+                                 time.time() - self._t_start,
+                                 rusage, io)
+                accountant.record(self.usage)
         self.release()
-        return out
+        return self._pipe.returncode
+    
+    def terminate(self):
+        """Send SIGTERM to the child, if it is still running."""
+        self._signal(self._pipe.terminate)
+    
+    def kill(self):
+        """Send SIGKILL to the child, if it is still running."""
+        self._signal(self._pipe.kill)
+    
+    def _signal(self, sendFn):
+        try:
+            sendFn()
+        except OSError, err:
+            if err.errno == errno.ESRCH:
+                # process already dead
+                pass
+            else:
+                raise
     
     def release(self):
         """Owned process is finished; report it so."""
@@ -109,6 +662,8 @@ class PopenWrapper:
         self.returncode = self._pipe.returncode
         if not self._released:
             self._procman.releaseProcess(pid)
+            if self._ticket is not None:
+                self._procman.releaseTicket(self._ticket)
             self._released = True
     
     def __enter__(self):
@@ -116,45 +671,28 @@ class PopenWrapper:
     
     def __exit__(self, errtype, errval, tracebk):
         """Ensure that our child process is no longer running upon return"""
-        pid = self._pipe.pid
-        self.returncode = self._pipe.returncode
-        if self._pipe.poll() is not None and not self._released:
+        if self.poll() is not None:
             # process finished, but we haven't checked it until now.
-            self.release()
-        elif errtype is not None and not self._released:
+            # poll() has released it.
+            pass
+        elif errtype is not None:
             # inner code has thrown an exception.
             # terminate the child process now.
-            
-            try:
-                self._pipe.terminate()
-            except OSError, err:
-                if err.errno == errno.ESRCH:
-                    # process already dead
-                    pass
-                else:
-                    raise
+            self.terminate()
             
             # wait for child to finish cleaning up
             t_kill = time.time() + self._timeout
-            while time.time() < t_kill and self._pipe.poll() is None:
+            while time.time() < t_kill and self.poll() is None:
                 time.sleep(0.05)
             
             # out of time. kill it
             if self.poll() is None:
-                try:
-                    self._pipe.kill()
-                except OSError, err:
-                    if err.errno == errno.ESRCH:
-                        # process already dead
-                        pass
-                    else:
-                        raise
-                self.release()
+                self.kill()
+                self.wait()
         else:
             # healthy exit of `with` stmt; but process still running.
             # wait for it to finish of its own accord.
-            self._pipe.wait()
-            self.release() 
+            self.wait()
 
 
 DFT_MGR = ProcessManager()
@@ -0,0 +1,133 @@
+"""
+procprio
+
+Scheduling priority of child processes by class of work (see jobsched): CPU
+niceness, I/O priority (ioprio_set) and, optionally, placement in a cgroup v2
+subtree with its own cpu.weight and io.weight.
+"""
+
+import os
+import ctypes
+import thread
+import platform
+
+from common_util import Warn
+
+
+# I/O scheduling classes, from linux/ioprio.h
+IOPRIO_CLASSES = {'realtime' : 1, 'best-effort' : 2, 'idle' : 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+
+# ioprio_set has no libc wrapper
+SYS_IOPRIO_SET = {
+    'x86_64'  : 251,
+    'i386'    : 289,
+    'i686'    : 289,
+    'armv7l'  : 314,
+    'aarch64' : 30,
+}.get(platform.machine())
+
+# priority of each class of work. disc reads must never stall for want of I/O,
+# whereas encodes can run in the background.
+DEFAULT_PRIORITIES = {
+    'disc' : {'nice' : 0,  'ioclass' : 'best-effort', 'iolevel' : 0,
+              'cpuweight' : 200, 'ioweight' : 1000},
+    'io'   : {'nice' : 5,  'ioclass' : 'best-effort', 'iolevel' : 4,
+              'cpuweight' : 100, 'ioweight' : 100},
+    'cpu'  : {'nice' : 10, 'ioclass' : 'best-effort', 'iolevel' : 7,
+              'cpuweight' : 50,  'ioweight' : 25},
+}
+
+# loaded up front; we want to do as little as possible in a forked child
+_libc = ctypes.CDLL(None, use_errno=True)
+
+def _ioprioSet(ioclass, level):
+    if SYS_IOPRIO_SET is None:
+        return
+    prio = (IOPRIO_CLASSES[ioclass] << IOPRIO_CLASS_SHIFT) | level
+    _libc.syscall(SYS_IOPRIO_SET, IOPRIO_WHO_PROCESS, 0, prio)
+
+
+class PriorityPolicy:
+    """Maps classes of work to process priorities. <priorities> overrides
+    entries of DEFAULT_PRIORITIES. If <cgroupRoot> is given, it must be a
+    cgroup v2 directory writable by the daemon; a child group is created
+    beneath it for each class of work."""
+
+    def __init__(self, priorities=None, cgroupRoot=None):
+        self._prios = {}
+        for cls, prio in DEFAULT_PRIORITIES.iteritems():
+            self._prios[cls] = dict(prio)
+        if priorities is not None:
+            for cls, prio in priorities.iteritems():
+                self._prios.setdefault(cls, {}).update(prio)
+        self._cgroupRoot = cgroupRoot
+        self._cgroups = {}
+        self._lock = thread.allocate_lock()
+
+    def preexecFn(self, workClass, chained=None):
+        """Return a function to be run in a newly forked child doing
+        <workClass> work, which applies that class's priority and then calls
+        <chained> (if given). Returns <chained> if the class is unknown."""
+        if workClass not in self._prios:
+            return chained
+        prio   = self._prios[workClass]
+        cgroup = self._cgroup(workClass)
+
+        def apply():
+            # failures are not fatal; the child just runs at our priority.
+            try:
+                if prio.get('nice'):
+                    os.nice(prio['nice'])
+                if 'ioclass' in prio:
+                    _ioprioSet(prio['ioclass'], prio.get('iolevel', 4))
+                if cgroup is not None:
+                    fd = os.open(os.path.join(cgroup, 'cgroup.procs'),
+                                 os.O_WRONLY)
+                    try:
+                        os.write(fd, '0')
+                    finally:
+                        os.close(fd)
+            except (OSError, IOError):
+                pass
+            if chained is not None:
+                chained()
+        return apply
+
+    def _cgroup(self, workClass):
+        """Return the path of the cgroup for <workClass>, creating and
+        configuring it on first use. Returns None if cgroups are not in use
+        or the group cannot be set up."""
+        if self._cgroupRoot is None:
+            return None
+        with self._lock:
+            if workClass not in self._cgroups:
+                self._cgroups[workClass] = self._makeCgroup(workClass)
+            return self._cgroups[workClass]
+
+    def _makeCgroup(self, workClass):
+        prio = self._prios[workClass]
+        path = os.path.join(self._cgroupRoot, 'autoripd-%s' % workClass)
+        try:
+            if not os.path.isdir(path):
+                os.mkdir(path)
+        except OSError, err:
+            Warn("Could not create cgroup %s (%s); %s work will not be "
+                 "placed in a cgroup" % (path, err, workClass))
+            return None
+
+        settings = [(self._cgroupRoot, 'cgroup.subtree_control', '+cpu +io')]
+        if 'cpuweight' in prio:
+            settings.append((path, 'cpu.weight', prio['cpuweight']))
+        if 'ioweight' in prio:
+            settings.append((path, 'io.weight', 'default %d' % prio['ioweight']))
+        for cgroup, name, value in settings:
+            try:
+                with open(os.path.join(cgroup, name), 'w') as f:
+                    f.write(str(value))
+            except (OSError, IOError), err:
+                # e.g. the io controller is not available
+                Warn("Could not set %s of cgroup %s (%s)" % (name, cgroup, err))
+        return path
+
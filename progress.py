@@ -0,0 +1,279 @@
+"""
+progress
+
+Parsing of the progress output of external tools (makemkvcon, HandBrakeCLI,
+tsMuxeR, mkvextract, aften) into ProgressEvents, and a ProgressBoard which
+collects the most recent event of every running job.
+"""
+
+import re
+import time
+import thread
+import datetime
+
+from common_util import Warn, Msg
+
+
+###########################
+# Progress events         #
+###########################
+
+
+class ProgressEvent(object):
+    """A snapshot of the progress of one stage of a job.
+
+    `fraction` is in [0,1]. `fps` and `eta` (seconds remaining) are None when
+    not known."""
+
+    def __init__(self, jobID, tool, stage, fraction, fps=None, eta=None,
+                 detail=None):
+        self.jobID    = jobID
+        self.tool     = tool
+        self.stage    = stage
+        self.fraction = fraction
+        self.fps      = fps
+        self.eta      = eta
+        self.detail   = detail
+        self.time     = time.time()
+
+    def __str__(self):
+        s = "%s: %s %.1f%%" % (self.jobID, self.stage, 100. * self.fraction)
+        if self.fps is not None:
+            s += ", %.1f fps" % self.fps
+        if self.eta is not None:
+            s += ", ETA %s" % datetime.timedelta(seconds=int(self.eta))
+        return s
+
+
+###########################
+# Tool output parsers     #
+###########################
+
+# Each parser takes one line of output and returns (fraction, fps, eta, detail)
+# or None if the line does not report progress.
+
+
+_MAKEMKV_PRGV = re.compile(r'^PRGV:(\d+),(\d+),(\d+)')
+_MAKEMKV_PRGT = re.compile(r'^PRG[CT]:\d+,\d+,"(.*)"')
+
+class MakeMKVProgressParser:
+    """makemkvcon in robot mode (-r --progress=-same) reports:
+        PRGT:code,id,"name"            (name of the whole operation)
+        PRGC:code,id,"name"            (name of the current sub-operation)
+        PRGV:current,total,max         (sub-operation and total progress)"""
+
+    def __init__(self):
+        self.detail = None
+
+    def __call__(self, line):
+        m = _MAKEMKV_PRGV.match(line)
+        if m is not None:
+            current, total, maxval = map(int, m.groups())
+            if maxval <= 0:
+                return None
+            return (float(total) / maxval, None, None, self.detail)
+        m = _MAKEMKV_PRGT.match(line)
+        if m is not None:
+            self.detail = m.group(1)
+        return None
+
+
+_HANDBRAKE_ENCODING = re.compile(
+        r'Encoding: task (\d+) of (\d+), ([\d.]+) %'
+        r'(?: \(([\d.]+) fps, avg ([\d.]+) fps, ETA (\d+)h(\d+)m(\d+)s\))?')
+
+class HandBrakeProgressParser:
+    """HandBrakeCLI reports:
+        Encoding: task 1 of 2, 45.12 % (35.21 fps, avg 36.01 fps, ETA 00h12m34s)
+    Multi-pass encodes are reported as one stage spanning all the tasks."""
+
+    def __call__(self, line):
+        m = _HANDBRAKE_ENCODING.search(line)
+        if m is None:
+            return None
+        task, ntasks = int(m.group(1)), int(m.group(2))
+        pct = float(m.group(3))
+        fraction = (task - 1 + pct / 100.) / max(ntasks, 1)
+        fps = eta = None
+        if m.group(4) is not None:
+            fps = float(m.group(5))
+            if task == ntasks:
+                # HandBrake's ETA only covers the current task
+                h, mn, sec = map(int, m.group(6, 7, 8))
+                eta = h * 3600 + mn * 60 + sec
+        detail = "task %d of %d" % (task, ntasks)
+        return (fraction, fps, eta, detail)
+
+
+_PERCENT_PATTERNS = {
+    # tsMuxeR: "45.3% complete"
+    'tsMuxeR'    : re.compile(r'([\d.]+)% complete'),
+    # mkvextract: "Progress: 45%"
+    'mkvextract' : re.compile(r'Progress: (\d+)%'),
+    # aften (-v 1): "progress:  45% | q: 240.0 | bw: 60.0 | ..."
+    'aften'      : re.compile(r'progress:\s*(\d+)%'),
+}
+
+class PercentProgressParser:
+    """Parser for tools which report nothing more than a percentage."""
+
+    def __init__(self, pattern):
+        self._pattern = pattern
+
+    def __call__(self, line):
+        m = self._pattern.search(line)
+        if m is None:
+            return None
+        return (float(m.group(1)) / 100., None, None, None)
+
+
+def parserForTool(tool):
+    """Return a new progress parser for the named tool, or None if the tool's
+    progress output is not understood."""
+    if tool == 'makemkvcon':
+        return MakeMKVProgressParser()
+    elif tool == 'HandBrakeCLI':
+        return HandBrakeProgressParser()
+    elif tool in _PERCENT_PATTERNS:
+        return PercentProgressParser(_PERCENT_PATTERNS[tool])
+    else:
+        return None
+
+
+###########################
+# Progress collection     #
+###########################
+
+
+class ProgressBoard:
+    """Thread-safe collection of the most recent progress of each running job.
+    Subscribers are called with every ProgressEvent published."""
+
+    def __init__(self, logStep=0.1):
+        self._lock = thread.allocate_lock()
+        self._latest = {}
+        self._started = {}
+        self._subscribers = []
+        self._logStep = logStep
+
+    def subscribe(self, fn):
+        with self._lock:
+            self._subscribers.append(fn)
+
+    def job(self, jobID):
+        """Return a JobProgress which publishes events for <jobID> to this
+        board."""
+        with self._lock:
+            self._started[jobID] = time.time()
+        return JobProgress(self, jobID)
+
+    def publish(self, evt):
+        with self._lock:
+            prev = self._latest.get(evt.jobID)
+            self._latest[evt.jobID] = evt
+            subscribers = list(self._subscribers)
+
+        # log a message every time we cross a `logStep` boundary
+        if prev is None or prev.stage != evt.stage or \
+                int(evt.fraction / self._logStep) != \
+                int(prev.fraction / self._logStep):
+            Msg(str(evt))
+        for fn in subscribers:
+            fn(evt)
+
+    def finish(self, jobID):
+        """Forget the progress of a completed job."""
+        with self._lock:
+            self._latest.pop(jobID, None)
+            self._started.pop(jobID, None)
+
+    def latest(self, jobID):
+        """Return the most recent ProgressEvent of <jobID>, or None."""
+        with self._lock:
+            return self._latest.get(jobID)
+
+    def activeJobs(self):
+        """Return {jobID : latest ProgressEvent or None} for all running
+        jobs."""
+        with self._lock:
+            return dict((j, self._latest.get(j)) for j in self._started)
+
+    def busyUntil(self):
+        """Return the estimated number of seconds until every running job is
+        finished, or None if any running job has no estimate."""
+        longest = 0
+        for evt in self.activeJobs().itervalues():
+            if evt is None or evt.eta is None:
+                return None
+            longest = max(longest, evt.eta - (time.time() - evt.time))
+        return longest
+
+    def stalledJobs(self, timeout):
+        """Return the IDs of jobs which have not reported progress for
+        <timeout> seconds."""
+        now = time.time()
+        stalled = []
+        with self._lock:
+            for jobID, t_start in self._started.iteritems():
+                evt = self._latest.get(jobID)
+                if evt is not None and evt.stage == 'queued':
+                    # waiting its turn; nothing is expected of it
+                    continue
+                t_last = t_start if evt is None else evt.time
+                if now - t_last > timeout:
+                    stalled.append(jobID)
+        return stalled
+
+    def watchStalls(self, timeout, interval=60):
+        """Spawn a thread which warns about stalled jobs every <interval>
+        seconds."""
+        def watch():
+            while True:
+                time.sleep(interval)
+                for jobID in self.stalledJobs(timeout):
+                    Warn("Job %s has reported no progress for %d seconds" %
+                         (jobID, timeout))
+        thread.start_new_thread(watch, ())
+
+
+class JobProgress:
+    """Publishes the progress of a single job to a ProgressBoard."""
+
+    def __init__(self, board, jobID):
+        self.board = board
+        self.jobID = jobID
+
+    def lineHandler(self, tool, stage):
+        """Return a function suitable as the `onLine` argument of
+        ProcessManager.callStreaming(), which turns the output of <tool> into
+        ProgressEvents for <stage>. Returns None if <tool>'s output is not
+        understood."""
+        parser = parserForTool(tool)
+        if parser is None:
+            return None
+        t_start = time.time()
+
+        def onLine(src, line):
+            parsed = parser(line)
+            if parsed is None:
+                return
+            fraction, fps, eta, detail = parsed
+            fraction = min(max(fraction, 0.), 1.)
+            if eta is None and fraction > 0:
+                # extrapolate from progress so far
+                elapsed = time.time() - t_start
+                eta = elapsed * (1. - fraction) / fraction
+            self.board.publish(ProgressEvent(self.jobID, tool, stage, fraction,
+                                             fps, eta, detail))
+        return onLine
+
+    def stage(self, stage, fraction=0.):
+        """Report the beginning of a stage which has no progress output."""
+        self.board.publish(ProgressEvent(self.jobID, None, stage, fraction))
+
+
+def lineHandler(jobProgress, tool, stage):
+    """As JobProgress.lineHandler(), but <jobProgress> may be None."""
+    if jobProgress is None:
+        return None
+    return jobProgress.lineHandler(tool, stage)
@@ -0,0 +1,175 @@
+"""
+ratecontrol
+
+Single-pass rate control for x264 encodes by HandBrakeCLI. Rather than
+decoding a whole title twice (--two-pass), a few short samples spread across
+the title are encoded at several constant rate factors (CRF), and the bitrate
+of each is measured. The log of the bitrate is close to linear in the CRF, so
+a least-squares line through the samples gives the CRF which should hit a
+target bitrate. The title is then encoded once at that CRF; the VBV limits in
+the x264 options still cap the peak bitrate, so the result stays playable by
+devices which need them.
+"""
+
+import os
+import math
+
+import jobsched
+from common_util import Msg, Warn, Error, Babble, uniquePath
+
+
+# x264's useful range of rate factors
+MIN_CRF = 0
+MAX_CRF = 51
+
+
+class RateModel:
+    """A fit of log(bitrate) = a + b * crf through <samples>, a list of
+    (crf, bitrate in kbit/s)."""
+
+    def __init__(self, samples):
+        self.samples = samples
+        n   = float(len(samples))
+        xs  = [crf for crf, kbps in samples]
+        ys  = [math.log(kbps) for crf, kbps in samples]
+        mx  = sum(xs) / n
+        my  = sum(ys) / n
+        sxx = sum((x - mx) ** 2 for x in xs)
+        sxy = sum((x - mx) * (y - my) for x, y in zip(xs, ys))
+        if sxx == 0:
+            raise ValueError("rate samples need at least two distinct CRFs")
+        self.b = sxy / sxx
+        self.a = my - self.b * mx
+
+    def bitrate(self, crf):
+        """Return the predicted bitrate (kbit/s) at <crf>."""
+        return math.exp(self.a + self.b * crf)
+
+    def crf(self, kbps):
+        """Return the CRF predicted to give <kbps>, within x264's range."""
+        if self.b >= 0:
+            # higher CRFs must give lower bitrates; the samples are garbage
+            raise ValueError("bitrate does not fall with CRF (slope %.3f)" %
+                             self.b)
+        crf = (math.log(kbps) - self.a) / self.b
+        return min(max(crf, MIN_CRF), MAX_CRF)
+
+    def error(self):
+        """Return the largest relative error of the fit over its samples."""
+        return max(abs(self.bitrate(crf) / kbps - 1)
+                   for crf, kbps in self.samples)
+
+
+class RatePolicy:
+    """How to choose a CRF: encode <samples> samples of <length> seconds
+    each, at each of the rate factors <crfs>, and accept the fit if its
+    samples are predicted within <tolerance> (a fraction of the bitrate)."""
+
+    def __init__(self, samples=5, length=20, crfs=(18, 22, 26),
+                 tolerance=0.1):
+        self.samples   = samples
+        self.length    = length
+        self.crfs      = crfs
+        self.tolerance = tolerance
+
+    def sampleStarts(self, duration):
+        """Return the start times (seconds) of the samples of a title
+        <duration> seconds long, or [] if it is too short to sample. The
+        samples are centred in equal shares of the title, so that opening
+        and closing credits weigh no more than they should."""
+        if self.samples < 1 or duration < self.samples * self.length * 2:
+            return []
+        share = duration / float(self.samples)
+        return [int(share * (i + 0.5) - self.length / 2.)
+                for i in xrange(self.samples)]
+
+
+def withQuality(cmd, crf):
+    """Return the HandBrakeCLI <cmd> with its bitrate (-b) and multi-pass
+    options replaced by the constant rate factor <crf>."""
+    out = []
+    skip = False
+    for arg in cmd:
+        if skip:
+            skip = False
+        elif arg in ('-b', '--vb', '-S', '--size'):
+            skip = True
+        elif arg not in ('--two-pass', '-2', '--turbo', '-T'):
+            out.append(arg)
+    return out + ['-q', '%.2f' % crf]
+
+
+def sampleBitrate(cmd, crf, start, length, workDir, procMgr):
+    """Encode <length> seconds of the title from <start> seconds at <crf>
+    with HandBrakeCLI <cmd> (all arguments but the output file), and return
+    the bitrate of the result in kbit/s, or None on failure."""
+    outfile = uniquePath(os.path.join(workDir, "ratesample.crf%d.%d.mkv" %
+                                               (crf, start)))
+    samplecmd = withQuality(cmd, crf) + \
+                ['--start-at', 'duration:%d' % start,
+                 '--stop-at',  'duration:%d' % length,
+                 '-o', outfile]
+    try:
+        retcode, sout, serr = procMgr.call(samplecmd,
+                                           workClass=jobsched.WORK_CPU)
+        if retcode != 0 or not os.path.isfile(outfile):
+            Error("Rate sample at %ds (CRF %d) failed:\n%s" %
+                  (start, crf, serr))
+            return None
+        return os.path.getsize(outfile) * 8 / 1000. / length
+    finally:
+        if os.path.exists(outfile):
+            os.unlink(outfile)
+
+
+def chooseCRF(cmd, duration, kbps, workDir, procMgr, policy):
+    """Return the CRF at which HandBrakeCLI <cmd> should encode a title of
+    <duration> seconds for an average of <kbps> kbit/s, as estimated from
+    samples by <policy> (a RatePolicy). Returns None if the title cannot be
+    sampled or the samples cannot be trusted; the caller should then fall
+    back to a bitrate-targeted encode."""
+    starts = policy.sampleStarts(duration)
+    if not starts:
+        return None
+    Msg("Sampling %d x %ds of the title at CRF %s" %
+        (len(starts), policy.length, ", ".join(map(str, policy.crfs))))
+    samples = []
+    for crf in policy.crfs:
+        rates = []
+        for start in starts:
+            rate = sampleBitrate(cmd, crf, start, policy.length, workDir,
+                                 procMgr)
+            if rate is None:
+                return None
+            rates.append(rate)
+        # the title's bitrate is the mean over its samples
+        samples.append((crf, sum(rates) / len(rates)))
+        Babble("CRF %d: %.0f kbit/s" % samples[-1])
+    try:
+        model = RateModel(samples)
+        crf   = model.crf(kbps)
+    except ValueError, err:
+        Warn("Cannot fit the rate samples (%s)" % err)
+        return None
+    if model.error() > policy.tolerance:
+        Warn("Rate samples fit to within %.0f%% only; wanted %.0f%%" %
+             (model.error() * 100, policy.tolerance * 100))
+        return None
+    Msg("Chose CRF %.2f for %d kbit/s (predicted %.0f kbit/s)" %
+        (crf, kbps, model.bitrate(crf)))
+    return crf
+
+
+def checkBitrate(path, duration, kbps, tolerance):
+    """Warn if the file <path>, <duration> seconds long, misses the bitrate
+    <kbps> by more than <tolerance>. Returns True if it does not."""
+    if duration <= 0 or not os.path.isfile(path):
+        return True
+    actual = os.path.getsize(path) * 8 / 1000. / duration
+    if abs(actual / kbps - 1) > tolerance:
+        Warn("%s came out at %.0f kbit/s; target was %d kbit/s" %
+             (path, actual, kbps))
+        return False
+    Babble("%s came out at %.0f kbit/s (target %d kbit/s)" %
+           (path, actual, kbps))
+    return True
@@ -0,0 +1,631 @@
+"""
+remoteenc
+
+Offloading of CPU-heavy encodes (HandBrakeCLI, aften, ...) to worker
+processes (see autoripd-worker) on this or other machines, so that the ripping
+host is left with the disc I/O.
+
+The protocol runs over TCP. Every message is one line of JSON with an 'op'; a
+message with a 'size' is followed by that many bytes of file data. A job goes:
+
+    client                                  worker
+    submit {cmd, inputs, outputs, secret} ->
+                                         <- accepted  (or error {message})
+                                         <- want {name}  (for each input file
+    input {name, size} + data             ->   the worker does not have)
+                                         <- queued    (if all slots are busy)
+                                         <- line {src, line}  (tool output)
+                                         <- heartbeat (while the tool runs)
+                                         <- done {returncode}
+                                         <- output {name, size} + data
+                                         <- end
+
+A client may instead send 'heartbeat', which is answered by a 'heartbeat'
+{slots, running}; this is how clients choose a worker.
+
+In the submitted command, the paths of input and output files are written
+{input}/<name> and {output}/<name>, and the worker substitutes its own
+folders. A worker runs only the tools it is configured to allow, and the
+program run is the worker's own, whatever the client asked for; no argument
+may name a file outside the job's folders.
+
+Each input file is described by its name, size and a key which identifies
+its contents (see inputKey()). A worker keeps the input files it receives
+for a while after the jobs which read them are finished, and asks only for
+those it does not have, so that the segments of a title (see segencode),
+sent to the same worker, share one copy of their source.
+"""
+
+import os
+import hmac
+import json
+import time
+import signal
+import hashlib
+import socket
+import shutil
+import tempfile
+import threading
+import collections
+import SocketServer
+
+import jobsched
+from procmgmt import ProcessManager, DFT_TAIL_LINES, SpawnLockedException
+from common_util import Msg, Warn, Babble, strsFromJSON
+
+
+DEFAULT_PORT = 7531
+
+# seconds between heartbeats from a worker running a job; a client gives up
+# on a worker which has been silent for HEARTBEAT_TIMEOUT
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT  = 60
+CONNECT_TIMEOUT    = 10
+
+CHUNK_SIZE  = 1 << 20
+MAX_MESSAGE = 1 << 20
+
+INPUT_DIR  = '{input}'
+OUTPUT_DIR = '{output}'
+
+# seconds for which a worker keeps input files no job is reading
+INPUT_LINGER = 600
+
+# settings of autoripd-worker, which reads the same config file as autoripd
+WORKER_SETTINGS = dict(
+            workerListen = '127.0.0.1:%d' % DEFAULT_PORT,
+               workerDir = '/var/tmp/autoripd-worker',
+             workerSlots = 1,
+             workerTools = ['HandBrakeCLI', 'x264', 'aften', 'dcadec'],
+            workerSecret = None)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class WorkerConfigError(Exception):
+    pass
+
+
+def parseAddress(addr, defaultHost='127.0.0.1'):
+    """Return (host, port) for an address written 'host:port', 'host' or
+    ':port'."""
+    host, sep, port = addr.rpartition(':')
+    if not sep:
+        return (addr, DEFAULT_PORT)
+    return (host or defaultHost, int(port))
+
+
+def isLoopback(host):
+    """Whether <host> is an address of this machine only."""
+    try:
+        addr = socket.gethostbyname(host) if host else '0.0.0.0'
+    except socket.error:
+        return False
+    return addr.startswith('127.')
+
+
+def inputKey(path):
+    """Return a key identifying the contents of the file <path> on this
+    host, as far as its size and modification time tell."""
+    st = os.stat(path)
+    return hashlib.sha1("%s:%s:%d:%d" % (socket.gethostname(),
+                                         os.path.abspath(path), st.st_size,
+                                         int(round(st.st_mtime * 1e9)))
+                        ).hexdigest()
+
+
+def _safeName(name):
+    """Return <name>, a relative path sent by the other end, if it stays in
+    the folder it is relative to."""
+    norm = os.path.normpath(name)
+    if os.path.isabs(norm) or norm == '..' or norm.startswith('..' + os.sep):
+        raise ProtocolError("unsafe file name '%s'" % name)
+    return norm
+
+
+def _confined(args, dirs):
+    """Raise ProtocolError if any of <args> (or the value of an argument
+    written 'opt=value') is an absolute path, or a path out through '..',
+    which is not within one of the folders <dirs>."""
+    roots = [os.path.realpath(d) for d in dirs]
+    for arg in args:
+        values = [arg]
+        if '=' in arg:
+            values.append(arg.split('=', 1)[1])
+        for val in values:
+            if not (os.path.isabs(val) or '..' in val.split(os.sep)):
+                continue
+            real = os.path.realpath(val)
+            if not any(real == r or real.startswith(r + os.sep)
+                       for r in roots):
+                raise ProtocolError("argument '%s' is outside the job's "
+                                    "folders" % arg)
+
+
+class Channel:
+    """A connection carrying protocol messages and file data."""
+
+    def __init__(self, sock):
+        self.sock  = sock
+        self.rfile = sock.makefile('rb')
+        self._lock = threading.Lock()
+
+    def send(self, msg, path=None):
+        """Send <msg>, followed by the contents of the file <path> (if
+        given), whose size is added to the message."""
+        with self._lock:
+            if path is None:
+                self.sock.sendall(json.dumps(msg) + '\n')
+                return
+            size = os.path.getsize(path)
+            msg = dict(msg, size=size)
+            self.sock.sendall(json.dumps(msg) + '\n')
+            with open(path, 'rb') as f:
+                sent = 0
+                while sent < size:
+                    buf = f.read(min(CHUNK_SIZE, size - sent))
+                    if not buf:
+                        raise ProtocolError("%s shrank while being sent" % path)
+                    self.sock.sendall(buf)
+                    sent += len(buf)
+
+    def recv(self):
+        line = self.rfile.readline(MAX_MESSAGE)
+        if not line:
+            raise ProtocolError("connection closed")
+        if not line.endswith('\n'):
+            raise ProtocolError("message too long")
+        try:
+            msg = strsFromJSON(json.loads(line))
+        except ValueError:
+            raise ProtocolError("malformed message")
+        if not isinstance(msg, dict) or 'op' not in msg:
+            raise ProtocolError("malformed message")
+        if msg['op'] == 'error':
+            raise ProtocolError(msg.get('message', 'unknown error'))
+        return msg
+
+    def recvFile(self, size, path):
+        """Write the <size> bytes of data which follow the last message to
+        the file <path>."""
+        with open(path, 'wb') as f:
+            left = size
+            while left > 0:
+                buf = self.rfile.read(min(CHUNK_SIZE, left))
+                if not buf:
+                    raise ProtocolError("connection closed")
+                f.write(buf)
+                left -= len(buf)
+
+    def close(self):
+        try:
+            self.rfile.close()
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+###########################
+# Client                  #
+###########################
+
+
+class RemoteEncoder:
+    """Runs commands on the least busy of the encode <workers> (addresses
+    written 'host:port'), authenticating with <secret>."""
+
+    def __init__(self, workers, secret=None):
+        self.workers = [parseAddress(w) for w in workers]
+        self.secret  = secret
+
+    def _connect(self, addr):
+        sock = socket.create_connection(addr, CONNECT_TIMEOUT)
+        sock.settimeout(HEARTBEAT_TIMEOUT)
+        return Channel(sock)
+
+    def _pick(self):
+        """Return the address of the worker with the most free slots, or None
+        if no worker can be reached."""
+        best = None
+        for addr in self.workers:
+            try:
+                ch = self._connect(addr)
+                try:
+                    ch.send({'op' : 'heartbeat'})
+                    reply = ch.recv()
+                finally:
+                    ch.close()
+                free = reply['slots'] - reply['running']
+            except (socket.error, ProtocolError, KeyError, TypeError), err:
+                Babble("Encode worker %s:%d is unavailable (%s)" %
+                       (addr[0], addr[1], err))
+                continue
+            if best is None or free > best[0]:
+                best = (free, addr)
+        return None if best is None else best[1]
+
+    def run(self, args, onLine=None, inputs=(), outputs=(),
+            tailLines=DFT_TAIL_LINES, cancelled=None):
+        """Run <args> on a worker, as ProcessManager.callStreaming(). The
+        command may read only the files or folders <inputs>, which are sent
+        to the worker, and write only the files <outputs>, which are fetched
+        back to the same paths. If cancelled() becomes true, the job is
+        abandoned, which makes the worker kill the command.
+
+        Returns (returncode, stdout_tail, stderr_tail), or None if no worker
+        could run the command, in which case it should be run locally."""
+        addr = self._pick()
+        if addr is None:
+            return None
+        try:
+            return self._runOn(addr, args, onLine, inputs, outputs, tailLines,
+                               cancelled)
+        except (socket.error, ProtocolError, KeyError, TypeError), err:
+            Warn("Encode worker %s:%d failed to run %s (%s)" %
+                 (addr[0], addr[1], os.path.basename(args[0]), err))
+            return None
+
+    def _runOn(self, addr, args, onLine, inputs, outputs, tailLines,
+               cancelled=None):
+        # local path -> path on the worker
+        paths = {}
+        files = []   # (name on the worker, local path) of each input file
+        for i, path in enumerate(inputs):
+            path = os.path.abspath(path)
+            name = "%d-%s" % (i, os.path.basename(path))
+            paths[path] = "%s/%s" % (INPUT_DIR, name)
+            if os.path.isdir(path):
+                for d, subdirs, fnames in os.walk(path):
+                    for f in fnames:
+                        local = os.path.join(d, f)
+                        files.append((os.path.join(name,
+                                          os.path.relpath(local, path)), local))
+            else:
+                files.append((name, path))
+        outnames = {}   # name on the worker -> local path
+        for i, path in enumerate(outputs):
+            path = os.path.abspath(path)
+            name = "%d-%s" % (i, os.path.basename(path))
+            paths[path] = "%s/%s" % (OUTPUT_DIR, name)
+            outnames[name] = path
+
+        # longest first, so that a file in an input folder is not mistaken
+        # for the folder
+        local = sorted(paths, key=len, reverse=True)
+        def translate(arg):
+            for path in local:
+                if arg == path or arg.startswith(path + os.sep):
+                    return paths[path] + arg[len(path):]
+            return arg
+
+        described = [{'name' : name,
+                      'size' : os.path.getsize(path),
+                      'key'  : inputKey(path)} for name, path in files]
+        innames = dict(files)   # name on the worker -> local path
+
+        ch = self._connect(addr)
+        try:
+            ch.send({'op'      : 'submit',
+                     'cmd'     : [translate(a) for a in args],
+                     'inputs'  : described,
+                     'outputs' : outnames.keys(),
+                     'secret'  : self.secret})
+            ch.recv()   # accepted
+            sent = 0
+
+            tails = {'stdout' : collections.deque(maxlen=tailLines),
+                     'stderr' : collections.deque(maxlen=tailLines)}
+            retcode = None
+            while True:
+                msg = ch.recv()
+                # checked at least at every heartbeat
+                if cancelled is not None and cancelled():
+                    raise ProtocolError("job cancelled")
+                op  = msg['op']
+                if op == 'want':
+                    if not sent:
+                        Msg("Sending input files to encode worker %s:%d" %
+                            addr)
+                    ch.send({'op' : 'input', 'name' : msg['name']},
+                            innames[msg['name']])
+                    sent += 1
+                elif op == 'line':
+                    tails[msg['src']].append(msg['line'])
+                    if onLine is not None:
+                        onLine(msg['src'], msg['line'])
+                elif op == 'done':
+                    retcode = msg['returncode']
+                elif op == 'output':
+                    dst = outnames[msg['name']]
+                    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst),
+                                  prefix='.%s.' % os.path.basename(dst),
+                                  suffix='.part')
+                    os.close(fd)
+                    try:
+                        ch.recvFile(msg['size'], tmp)
+                        os.rename(tmp, dst)
+                    finally:
+                        if os.path.exists(tmp):
+                            os.unlink(tmp)
+                elif op == 'end':
+                    break
+                # 'queued' and 'heartbeat' only keep the connection alive
+        finally:
+            ch.close()
+        if retcode is None:
+            raise ProtocolError("job ended without a result")
+        return retcode, "\n".join(tails['stdout']), "\n".join(tails['stderr'])
+
+
+###########################
+# Worker                  #
+###########################
+
+
+class InputStore:
+    """Input files received by a worker, in <path>, shared by the jobs which
+    read them, and kept for <linger> seconds after the last of those jobs.
+    Each file is identified by a key (see inputKey())."""
+
+    def __init__(self, path, linger=INPUT_LINGER):
+        self.path     = path
+        self.linger   = linger
+        self._cond    = threading.Condition()
+        self._entries = {}  # key -> [size, state, refs, time of last use]
+        # what a previous worker left behind is of no use to anybody
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+    def filePath(self, key):
+        return os.path.join(self.path, key)
+
+    def claim(self, key, size):
+        """Return 'have' if the file <key> is stored (and hold it until
+        release()d), 'fetch' if the caller must receive it (and then call
+        fetched()), or None if another job is receiving it, after waiting a
+        while for that to finish."""
+        with self._cond:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != size:
+                if entry is not None and entry[2] > 0:
+                    raise ProtocolError("input %s changed size" % key)
+                self._entries[key] = [size, 'fetching', 1, time.time()]
+                return 'fetch'
+            if entry[1] == 'fetching':
+                self._cond.wait(HEARTBEAT_INTERVAL)
+                return None
+            entry[2] += 1
+            return 'have'
+
+    def fetched(self, key, ok):
+        """Record the end of the receipt of the file <key>, which, if it
+        failed, another job may then try."""
+        with self._cond:
+            if ok:
+                self._entries[key][1] = 'stored'
+            else:
+                del self._entries[key]
+                self._unlink(key)
+            self._cond.notify_all()
+
+    def release(self, key):
+        with self._cond:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[2] -= 1
+                entry[3] = time.time()
+            self._purge()
+
+    def _purge(self):
+        now = time.time()
+        for key, (size, state, refs, used) in self._entries.items():
+            if refs <= 0 and now - used > self.linger:
+                Babble("Removing input file %s" % key)
+                del self._entries[key]
+                self._unlink(key)
+
+    def _unlink(self, key):
+        try:
+            os.unlink(self.filePath(key))
+        except OSError:
+            pass
+
+
+class EncodeWorker(SocketServer.ThreadingTCPServer):
+    """Serves encode jobs on <address> (host, port), running at most <slots>
+    at once, in folders under <workDir>. Only the programs named in <tools>
+    may be run; <toolPaths> maps a program name to the program to run in its
+    place. Clients must present <secret>, which may be None only if
+    <address> is a loopback address."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, workDir, slots=1, tools=(), toolPaths=None,
+                 secret=None):
+        if not secret and not isLoopback(address[0]):
+            raise WorkerConfigError("a secret is required to serve on %s" %
+                                    address[0])
+        SocketServer.ThreadingTCPServer.__init__(self, address, _JobHandler)
+        self.workDir   = workDir
+        self.slots     = slots
+        self.tools     = set(tools)
+        self.toolPaths = toolPaths or {}
+        self.secret    = secret
+        self.scheduler = jobsched.JobScheduler({jobsched.WORK_CPU : slots})
+        self.procmgr   = ProcessManager(self.scheduler)
+        if not os.path.isdir(workDir):
+            os.makedirs(workDir)
+        self.inputs    = InputStore(os.path.join(workDir, 'inputs'))
+
+    def running(self):
+        return self.scheduler.stats()[jobsched.WORK_CPU]['running']
+
+    def shutdown(self):
+        """Stop serving, and kill the tools of running jobs."""
+        self.procmgr.lockProcessStart()
+        for pid in self.procmgr.getActivePIDs():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        SocketServer.ThreadingTCPServer.shutdown(self)
+
+
+class _JobHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server
+        self.request.settimeout(HEARTBEAT_TIMEOUT)
+        ch = Channel(self.request)
+        peer = "%s:%d" % self.client_address
+        try:
+            msg = ch.recv()
+            if msg['op'] == 'heartbeat':
+                ch.send({'op' : 'heartbeat', 'slots' : server.slots,
+                         'running' : server.running()})
+            elif msg['op'] == 'submit':
+                self.runJob(ch, msg, peer)
+            else:
+                raise ProtocolError("unexpected '%s'" % msg['op'])
+        except (socket.error, ProtocolError, SpawnLockedException), err:
+            Warn("Job from %s abandoned (%s)" % (peer, err))
+            try:
+                ch.send({'op' : 'error', 'message' : str(err)})
+            except socket.error:
+                pass
+        finally:
+            ch.close()
+
+    def runJob(self, ch, msg, peer):
+        server = self.server
+        if server.secret and not hmac.compare_digest(
+                str(msg.get('secret') or ''), server.secret):
+            raise ProtocolError("not authorized")
+        cmd = msg.get('cmd')
+        if not cmd or not isinstance(cmd, list):
+            raise ProtocolError("no command")
+        tool = os.path.basename(cmd[0])
+        if tool not in server.tools:
+            raise ProtocolError("'%s' may not be run here" % tool)
+        try:
+            inputs = [(m['name'], _safeName(m['name']), int(m['size']),
+                       hashlib.sha1(self.client_address[0] +
+                                    str(m['key'])).hexdigest())
+                      for m in msg.get('inputs', [])]
+        except (KeyError, TypeError, ValueError):
+            raise ProtocolError("malformed inputs")
+        outputs = [_safeName(n) for n in msg.get('outputs', [])]
+
+        jobdir = tempfile.mkdtemp(dir=server.workDir, prefix='job.')
+        indir  = os.path.join(jobdir, 'input')
+        outdir = os.path.join(jobdir, 'output')
+        os.makedirs(outdir)
+        args = [server.toolPaths.get(tool, tool)] + \
+               [a.replace(INPUT_DIR, indir).replace(OUTPUT_DIR, outdir)
+                for a in cmd[1:]]
+        held = []
+        try:
+            _confined(args[1:], [indir, outdir])
+            ch.send({'op' : 'accepted'})
+            for sent, name, size, key in inputs:
+                self.fetchInput(ch, sent, size, key)
+                held.append(key)
+                path = os.path.join(indir, name)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                # a link, so that the job's folder holds the file itself
+                os.link(server.inputs.filePath(key), path)
+
+            Msg("Running %s for %s" % (tool, peer))
+            retcode, sout, serr = self.runTool(ch, args)
+            Msg("%s for %s exited with %s" % (tool, peer, retcode))
+
+            ch.send({'op' : 'done', 'returncode' : retcode})
+            for name in outputs:
+                path = os.path.join(outdir, name)
+                if os.path.isfile(path):
+                    ch.send({'op' : 'output', 'name' : name}, path)
+            ch.send({'op' : 'end'})
+        finally:
+            shutil.rmtree(jobdir, ignore_errors=True)
+            for key in held:
+                server.inputs.release(key)
+
+    def fetchInput(self, ch, name, size, key):
+        """Make sure the input file <key> of <size> bytes, which the client
+        calls <name>, is in the worker's InputStore, asking the client for
+        it if need be, and hold it for this job."""
+        store = self.server.inputs
+        while True:
+            claim = store.claim(key, size)
+            if claim == 'have':
+                return
+            if claim == 'fetch':
+                break
+            # another job is receiving it
+            ch.send({'op' : 'heartbeat'})
+        ok = False
+        try:
+            ch.send({'op' : 'want', 'name' : name})
+            m = ch.recv()
+            if m['op'] != 'input' or m['name'] != name or m['size'] != size:
+                raise ProtocolError("expected input '%s' of %d bytes" %
+                                    (name, size))
+            ch.recvFile(size, store.filePath(key))
+            ok = True
+        finally:
+            store.fetched(key, ok)
+
+    def runTool(self, ch, args):
+        """Run <args>, passing its output to the client, with heartbeats in
+        between. If the client goes away, the tool is killed."""
+        pm = self.server.procmgr
+        jobID = "job-%s-%d" % self.client_address
+        pm.setJobContext(jobID)
+        lost = []
+        stop = threading.Event()
+
+        def send(msg):
+            if lost:
+                return
+            try:
+                ch.send(msg)
+            except socket.error, err:
+                lost.append(err)
+                pm.cancelJob(jobID)
+
+        def beat():
+            while not stop.wait(HEARTBEAT_INTERVAL):
+                send({'op' : 'heartbeat'})
+
+        hb = threading.Thread(target=beat, name="heartbeat-%s" % jobID)
+        hb.daemon = True
+        hb.start()
+        try:
+            if self.server.running() >= self.server.slots:
+                send({'op' : 'queued'})
+            result = pm.callStreaming(
+                         args,
+                         lambda src, line: send({'op' : 'line', 'src' : src,
+                             'line' : line.decode('utf-8', 'replace')}),
+                         workClass=jobsched.WORK_CPU)
+        finally:
+            stop.set()
+            pm.endJob(jobID)
+        if lost:
+            raise lost[0]
+        return result
+
+
+def toolPathsFromSettings(settings, tools):
+    """Return {tool : program} for the <tools> whose program is configured
+    by a setting of a plugin (e.g. mux_aften = /opt/bin/aften)."""
+    paths = {}
+    for key, val in settings.iteritems():
+        if isinstance(val, basestring) and os.path.basename(val) in tools and \
+                key.startswith('mux_'):
+            paths[os.path.basename(val)] = val
+    return paths
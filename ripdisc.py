@@ -3,11 +3,19 @@
 import os, sys
 import subprocess as subp
 import glob
-import csv
 import errno
 import tempfile
 
-from procmgmt import DFT_MGR
+import mkvprobe
+from hbscan import ScanParser
+from procmgmt import DFT_MGR, ProcessTimeout
+from progress import lineHandler
+from filemove import moveFile
+from segencode import segmentedEncode, dvdChapterDurations
+from encplanner import withPreset
+from diskspace import reserve, reserveAll, moveFootprint, \
+                      bluRayRipFootprint, handbrakeOutputFootprint, \
+                      DVD_MAX_BYTES
 from common_util import Error, Warn, Msg, Babble, Die, uniquePath
 
 """
@@ -61,55 +69,207 @@ def ripBluRay(device,
               destDir, 
               workingDir, 
               ejectDisc=True,
-              procManager=DFT_MGR):
+              procManager=DFT_MGR,
+              progress=None,
+              scanTimeout=None,
+              discCache=None,
+              minLength=None,
+              space=None):
     """Use makemkvcon to rip a blu-ray movie from the given device. 
     <destDir> is the path of the folder into which finished ripped movies 
     will be moved. <tmpDir> is the path of a folder where unfinished rips 
-    will reside until they are complete.
+    will reside until they are complete. If given, <progress> is a 
+    progress.JobProgress to which the rip's progress will be reported. The
+    disc scan is abandoned if it takes longer than <scanTimeout> seconds. If
+    given, <discCache> is the disccache.CachedDisc of the disc in <device>.
+    Titles shorter than <minLength> seconds are skipped by makemkvcon, and
+    titles which play the same segments as an earlier title (decoy playlists)
+    are not considered as main feature. If given, <space> is the 
+    diskspace.SpaceManager from which to reserve space for the rip.
+    
+    makemkvcon cannot be handed the result of a scan, so the rip enumerates 
+    the disc again, as the scan did; only the scan of a disc found in 
+    <discCache> is skipped.
     
     Returns path of the ripped media file, or None."""
     
-    properties = bluRayDiscProperties(device, procManager)
+    procManager.setStage('scan')
+    if progress is not None:
+        progress.stage('scan')
+    # titles are scored as the scan reads them
+    title_metrics = []
+    signatures = {}
+    def onTitle(title_id, title):
+        sig = bluRayTitleSignature(title)
+        if sig is not None and sig in signatures:
+            Babble("Title %s duplicates title %s" % (title_id, signatures[sig]))
+            return
+        signatures[sig] = title_id
+        title_metrics.append(bluRayTitleMetrics(title_id, title))
+    
+    properties = bluRayDiscProperties(device, procManager, scanTimeout, 
+                                      discCache, onTitle, minLength)
     if properties is None:
         # failure. brdProperties() will have reported the error.
         return None
     
     disc, titles = properties
-    feature_title_id = detectBluRayMainFeature(titles)
+    if len(titles) > len(title_metrics):
+        Msg("Ignoring %d duplicate titles of %d on blu-ray in %s" % 
+            (len(titles) - len(title_metrics), len(titles), device))
+    if len(title_metrics) == 0:
+        Error("No titles found on blu-ray in %s" % device)
+        return None
+    feature_title_id = chooseBluRayMainFeature(title_metrics)
     name = disc['name'] if 'name' in disc else 'Unknown Blu-Ray' 
     
-    Msg("Ripping title %s of %s to %s" % (feature_title_id, name, tmpdest))
-    
-    retcode, sout, serr = procManager.call([
-                             "makemkvcon",
-                             "mkv", 
-                             "dev:%s" % device, 
-                             str(feature_title_id),
-                             workingDir])
-    
-    if retcode != 0:
-        Error("Failed to rip from '%s' %s" % (disc['title'], device))
-        Error("makemkvcon output:\n%s" % serr)
-        # unfinished mkv laying around for debugging. autoripd will delete the
-        # working directory if the user has chosen so with a config setting
-        return None
-    else: 
-        # move tmp mkv to final location
-        f_output = titles[feature_title_id]['outputFileName']
-        f_output = os.path.join(workingDir, f_output)
-        final_filename = "%s.mkv" % name
-        final_path = uniquePath(os.path.join(destDir, final_filename))
-        os.rename(f_output, final_path)
+    Msg("Ripping title %s of %s to %s" % (feature_title_id, name, workingDir))
+    
+    # don't start unless there is room for the rip (and for its copy, if it
+    # must be copied to destDir)
+    rip_bytes = bluRayRipFootprint(titles[feature_title_id])
+    mv_bytes  = None if rip_bytes is None else \
+                rip_bytes * moveFootprint(destDir, workingDir)
+    with reserveAll(space, [(workingDir, rip_bytes, [workingDir]),
+                            (destDir, mv_bytes, ())], "rip of %s" % name):
+        procManager.setStage('rip')
+        # makemkvcon enumerates the disc again before it rips (there is no
+        # way to give it our scan), and numbers the titles it finds as the
+        # scan did only if --minlength is the same
+        retcode, sout, serr = procManager.callStreaming(
+                                 ["makemkvcon",
+                                  "-r",
+                                  "--progress=-same"] + 
+                                 _makeMKVMinLength(minLength) +
+                                 ["mkv", 
+                                  "dev:%s" % device, 
+                                  str(feature_title_id),
+                                  workingDir],
+                                 lineHandler(progress, 'makemkvcon', 'rip'))
+        
+        if retcode != 0:
+            Error("Failed to rip from '%s' %s" % (name, device))
+            Error("makemkvcon output (last lines):\n%s\n%s" % (sout, serr))
+            # unfinished mkv laying around for debugging. autoripd will delete the
+            # working directory if the user has chosen so with a config setting
+            return None
+        else: 
+            # move tmp mkv to final location
+            f_output = titles[feature_title_id]['outputFileName']
+            f_output = os.path.join(workingDir, f_output)
+            if not os.path.isfile(f_output):
+                Error("makemkvcon did not produce %s; its titles may not match "
+                      "the scanned titles" % f_output)
+                return None
+            final_filename = "%s.mkv" % name
+            final_path = uniquePath(os.path.join(destDir, final_filename))
+            moveFile(f_output, final_path, progress)
         
-        if ejectDisc:
-            # not process logged, but probably safe.
-            subp.call(['eject', device])
+            if ejectDisc:
+                eject(device)
+        
+            Msg("Ripped %s successfully" % name)
+            return os.path.abspath(final_path)
+
+
+# attributes whose values are numbers; all others are kept as strings
+MAKEMKV_NUMERIC_ATTRIBUTES = set([
+    'chapterCount',
+    'diskSizeBytes',
+    'audioChannelsCount',
+    'audioSampleRate',
+    'audioSampleSize',
+    'streamFlags',
+    'originalTitleId',
+    'segmentsCount',
+    'orderWeight',
+])
+
+
+class MakeMKVInfoParser:
+    """Incremental parser of the output of `makemkvcon -r info`. Feed it lines
+    as makemkvcon prints them; it can be used directly as the `onLine` 
+    argument of ProcessManager.callStreaming().
+    
+    makemkvcon reports the titles one after another (all of a title's TINFO 
+    lines, then its SINFO lines), so a title is complete as soon as a line 
+    for another title arrives. onTitle(title_id, title_properties) is called 
+    for each title as it is completed; call finish() at the end of the 
+    output to complete the last title."""
+    
+    def __init__(self, onTitle=None):
+        self.disc     = {}
+        self.titles   = {}
+        self._onTitle = onTitle
+        self._current = None
+    
+    def __call__(self, src, line):
+        if src == 'stdout':
+            self.feed(line)
+    
+    def feed(self, line):
+        try:
+            key, data = line.split(':', 1)
+            if key == 'CINFO':
+                # disc info: attr,code,"value"
+                attr, code, val = data.split(',', 2)
+                dst = self.disc
+            elif key == 'TINFO':
+                # title info: title,attr,code,"value"
+                title, attr, code, val = data.split(',', 3)
+                dst = self._title(int(title))
+            elif key == 'SINFO':
+                # stream info: title,stream,attr,code,"value"
+                title, stream, attr, code, val = data.split(',', 4)
+                streams = self._title(int(title))['streams']
+                dst = streams.setdefault(int(stream), {})
+            else:
+                # messages, progress, drive info, etc.
+                return
+            name = MAKEMKV_ATTRIBUTE_ENUMS.get(int(attr))
+        except ValueError:
+            Babble("Unexpected makemkvcon output: %s" % line)
+            return
+        if name is None:
+            return
         
-        Msg("Ripped %s successfully" % name)
-        return os.path.abspath(final_path)
+        # values are quoted (as in csv), except sometimes numbers
+        if len(val) >= 2 and val[0] == '"' and val[-1] == '"':
+            val = val[1:-1].replace('""', '"')
+        if name in MAKEMKV_NUMERIC_ATTRIBUTES:
+            try:
+                val = int(val)
+            except ValueError:
+                pass
+        dst[name] = val
+    
+    def _title(self, title):
+        if title != self._current:
+            self._completeTitle()
+            self._current = title
+        if title not in self.titles:
+            self.titles[title] = {'streams' : {}}
+        return self.titles[title]
+    
+    def _completeTitle(self):
+        if self._current is not None and self._onTitle is not None:
+            self._onTitle(self._current, self.titles[self._current])
+        self._current = None
+    
+    def finish(self):
+        """Complete the last title, and return (disc_properties, titles)."""
+        self._completeTitle()
+        return (self.disc, self.titles)
+
+
+def _makeMKVMinLength(minLength):
+    if minLength is None:
+        return []
+    return ["--minlength=%d" % minLength]
 
 
-def bluRayDiscProperties(device, procManager=DFT_MGR):
+def bluRayDiscProperties(device, procManager=DFT_MGR, timeout=None,
+                         discCache=None, onTitle=None, minLength=None):
     """Use makemkvcon to enumerate the properties of a blu-ray movie disc.
     Note that this method may be quite slow due to I/O (probably too slow for an 
     interactive application).
@@ -126,70 +286,61 @@ def bluRayDiscProperties(device, procManager=DFT_MGR):
                     }
         }
     
-    Returns None on error.
+    If given, onTitle(title_id, title_properties) is called for each title as
+    soon as it has been read; see MakeMKVInfoParser. Titles shorter than
+    <minLength> seconds are skipped (and do not get a title ID).
+    
+    Returns None on error, or if the scan takes more than <timeout> seconds.
+    If <discCache> (a disccache.CachedDisc) holds the properties of this disc,
+    the disc is not scanned at all; otherwise the scan result is stored in it.
     """
     
-    # get the properties in (almost) csv format from makemkvcon \
-    retcode, sout, serr = procManager.call(
-                              ['makemkvcon', 
-                              '-r', 
-                              'info', 
-                              'dev:%s' % device])
+    # scans with different minimum lengths number the titles differently
+    cache_kind = 'bluray' if minLength is None else 'bluray-min%d' % minLength
+    if discCache is not None:
+        cached = discCache.load(cache_kind)
+        if cached is not None:
+            disc, titles = _bluRayPropertiesFromCache(cached)
+            if onTitle is not None:
+                for title in sorted(titles):
+                    onTitle(title, titles[title])
+            return (disc, titles)
+    
+    # the properties are parsed as makemkvcon prints them
+    parser = MakeMKVInfoParser(onTitle)
+    try:
+        retcode, sout, serr = procManager.callStreaming(
+                                  ['makemkvcon', '-r'] + 
+                                  _makeMKVMinLength(minLength) +
+                                  ['info', 'dev:%s' % device],
+                                  parser,
+                                  timeout=timeout)
+    except ProcessTimeout:
+        Error("Timed out reading blu-ray title info from %s" % device)
+        return None
     
     if retcode != 0:
         Error("Could not acquire blu-ray title info from %s" % device)
-        Error("makemkvcon output:\n%s" % serr)
+        Error("makemkvcon output (last lines):\n%s\n%s" % (sout, serr))
         return None
-    else:
-        # parse comma-separated messages, accounting for quoted strings.
-        # this is one line. I heart python.
-        parsed = [x for x in csv.reader(sout.split("\n"))]
-        
-        disc   = {}
-        titles = {}
-        for ifo in parsed:
-            if len(ifo) == 0:
-                # blank line
-                continue
-            
-            # first field contains data after the ":", make it a proper column
-            data = ifo[0].split(":", 1) + ifo[1:]
-            
-            # make integers where possible
-            for i, field in enumerate(data):
-                try:
-                    data[i] = int(field)
-                except ValueError:
-                    # not an int, apparently
-                    pass
-            
-            key = data[0]
-            dst = None
-            val = None
-            property = None
-            if key == 'CINFO':
-                # disk info
-                property, code, val = data[1:]
-                dst = disc
-            elif key == 'TINFO':
-                # track info
-                title, property, code, val = data[1:]
-                if title not in titles:
-                    titles[title] = {'streams' : {}}
-                dst = titles[title]
-            elif key == 'SINFO':
-                # stream info
-                title, stream, property, code, val = data[1:]
-                if title not in titles:
-                    titles[title] = {'streams' : {}}
-                if stream not in titles[title]['streams']:
-                    titles[title]['streams'][stream] = {}
-                dst = titles[title]['streams'][stream]
-            
-            if dst is not None and \
-                    property in MAKEMKV_ATTRIBUTE_ENUMS:
-                dst[MAKEMKV_ATTRIBUTE_ENUMS[property]] = val
-        return (disc, titles)
+    
+    disc, titles = parser.finish()
+    if discCache is not None:
+        discCache.store(cache_kind, (disc, titles))
+    return (disc, titles)
+
+
+def _bluRayPropertiesFromCache(cached):
+    """Restore the integer title and stream IDs of cached blu-ray properties
+    (JSON only has string keys)."""
+    disc, titles = cached
+    restored = {}
+    for title, props in titles.iteritems():
+        props = dict(props)
+        props['streams'] = dict((int(s), sprops) for s, sprops 
+                                in props['streams'].iteritems())
+        restored[int(title)] = props
+    return (disc, restored)
 
 
 def durationToSeconds(duration):
@@ -203,29 +354,33 @@ def durationToSeconds(duration):
         raise ValueError("could not parse timecode") 
 
 
-def detectBluRayMainFeature(titles):
-    """Attempt to guess the main feature using metrics such as time,
-    tracks, number of chapters, etc. Return the number of the detected 
-    title. 
-    
-    May not work quite right, as movie studios like to do crazy shit to try 
-    and confuse algorithms like this one. Also, this has not yet been tested 
-    on a wide collection of titles."""
-    
-    title_metrics = []
-    
+def bluRayTitleMetrics(title_id, title):
+    """Return the metrics by which the blu-ray title <title> is judged as
+    main feature: (duration, n_subtitles, n_audio, n_chapters, title_id)."""
     # 'stream x is of type t' predicate function
     istyp = lambda t: lambda x: 'type' in x and t in x['type'].lower()
     
-    # gather info about each title
-    for i,t in titles.iteritems():
-        streams  = t['streams']
-        duration = durationToSeconds(t['duration']) if 'duration' in t else 0
-        n_subt   = len(filter(istyp('subtitle'), streams.itervalues()))
-        n_audio  = len(filter(istyp('audio'),    streams.itervalues()))
-        n_chapt  = t['chapterCount'] if 'chapterCount' in t else 0
-        
-        title_metrics.append((duration, n_subt, n_audio, n_chapt, i))
+    streams  = title['streams']
+    duration = durationToSeconds(title['duration']) if 'duration' in title else 0
+    n_subt   = len(filter(istyp('subtitle'), streams.itervalues()))
+    n_audio  = len(filter(istyp('audio'),    streams.itervalues()))
+    n_chapt  = title['chapterCount'] if 'chapterCount' in title else 0
+    return (duration, n_subt, n_audio, n_chapt, title_id)
+
+
+def bluRayTitleSignature(title):
+    """Return what identifies the content of the blu-ray title <title>: the
+    segments (clips) it plays, in order. Discs with obfuscated playlists have
+    many titles with the same signature. Returns None if it is not known."""
+    if 'segmentsMap' not in title:
+        return None
+    return (title['segmentsMap'], title.get('segmentsCount'), 
+            title.get('duration'))
+
+
+def chooseBluRayMainFeature(title_metrics):
+    """Return the ID of the title which is most likely the main feature, 
+    given the bluRayTitleMetrics() of each title."""
     
     # some importance weights that I very 
     # scientifically pulled out of my butt:
@@ -236,12 +391,13 @@ def detectBluRayMainFeature(titles):
                     for i in range(len(wts))]
     
     # prune out any titles shorter than 75% of longest title
-    title_metrics = filter(lambda x: x[0] > 0.75 * max_of_field[0], title_metrics)
+    title_metrics = filter(lambda x: x[0] >= 0.75 * max_of_field[0], title_metrics)
     
     # sort according to weighted sum of buttsourced metrics, highest first
     final_metrics = []
     for row in title_metrics:
-        wt = sum([row[i] * wts[i] / max_of_field[i] for i in range(len(wts))])
+        wt = sum([row[i] * wts[i] / max_of_field[i] for i in range(len(wts))
+                  if max_of_field[i] > 0])
         final_metrics.append((wt, row[-1]))
     final_metrics.sort(reverse=True)
     
@@ -249,13 +405,43 @@ def detectBluRayMainFeature(titles):
     return final_metrics[0][-1] 
 
 
+def detectBluRayMainFeature(titles):
+    """Attempt to guess the main feature using metrics such as time,
+    tracks, number of chapters, etc. Return the number of the detected 
+    title. 
+    
+    May not work quite right, as movie studios like to do crazy shit to try 
+    and confuse algorithms like this one. Also, this has not yet been tested 
+    on a wide collection of titles."""
+    return chooseBluRayMainFeature([bluRayTitleMetrics(i, t) 
+                                    for i, t in titles.iteritems()])
+
+
 ###########################
 # MediaInfo parsing       #
 ###########################
 
 
-def mediaInfoData(filename, procManager=DFT_MGR):
+def mediaInfoData(filename, procManager=DFT_MGR, cache=None):
+    """Return the media info of <filename>, as a dictionary of properties 
+    with a list of 'tracks', or None on failure. If <cache> (a 
+    mediacache.MediaInfoCache) is given, it is consulted first, and given
+    the result."""
     fpath = os.path.abspath(filename)
+    if cache is not None:
+        properties = cache.get(fpath)
+        if properties is None:
+            properties = mediaInfoData(fpath, procManager)
+            if properties is not None:
+                cache.put(fpath, properties)
+        return properties
+    
+    # Matroska files are read in-process, which is much cheaper than running
+    # mediainfo; anything else (or any file mkvprobe can't make sense of) 
+    # goes to mediainfo
+    properties = mkvprobe.probe(fpath)
+    if properties is not None:
+        return properties
     
     # get the media info
     # -f means "full", which outputs lots of redundant data in lots of different
@@ -346,36 +532,67 @@ def mediaInfoData(filename, procManager=DFT_MGR):
 ###########################
 
 
-def getIndent(s):
-    x = ''
-    for c in s:
-        if c.isspace():
-            x += c
-        else:
-            break
-    return len(x.expandtabs())
-
-
 def ripDVD(device, 
            destDir, 
            tmpDir, 
            extraOptions=[], 
            ejectDisk=True, 
-           procMgr=DFT_MGR):
+           procMgr=DFT_MGR,
+           progress=None,
+           scanTimeout=None,
+           discCache=None,
+           minDuration=None,
+           space=None,
+           planner=None):
+    """Use HandBrakeCLI to rip the main feature of the DVD in <device>. The
+    disc is scanned once; titles shorter than <minDuration> seconds are 
+    ignored. The main feature is then ripped by its title number, so that 
+    HandBrake need not scan the disc again. See ripBluRay() for the other 
+    arguments.
+    
+    Returns path of the ripped media file, or None."""
+    scan = scanDVD(device, procMgr, progress, scanTimeout, discCache, 
+                   minDuration)
+    if scan is None:
+        return None
+    name, main_title, chapters, fmt = scan
+    
+    final_file = encodeDVD(device, main_title, name, destDir, tmpDir, 
+                           extraOptions, procMgr, progress, space, chapters,
+                           None, planner, fmt)
+    if final_file is not None and ejectDisk:
+        eject(device)
+    return final_file
+
+
+def scanDVD(device, 
+            procMgr=DFT_MGR, 
+            progress=None, 
+            scanTimeout=None, 
+            discCache=None, 
+            minDuration=None):
+    """Scan the DVD in <device> (see dvdDiscProperties()), and return 
+    (disc_name, main_feature_title, chapter_durations, title_format), or 
+    None on failure. <title_format> holds the 'size' (e.g. '720x480'), 
+    'fps' and 'interlaced' (whether HandBrake saw combing) of the main 
+    feature, as far as they are known."""
     Msg("Reading metadata from %s" % device)
-    dvd_data = dvdDiscProperties(device, procMgr)
+    procMgr.setStage('scan')
+    if progress is not None:
+        progress.stage('scan')
+    dvd_data = dvdDiscProperties(device, procMgr, scanTimeout, discCache,
+                                 minDuration)
     
     if dvd_data is None:
-        return False
+        return None
     
-    name1 = dvd_data['dvd_title']
-    name2 = dvd_data['dvd_alt_title']
+    name1 = dvd_data.get('dvd_title', '')
+    name2 = dvd_data.get('dvd_alt_title', '')
     
-    # find main_feature title
-    main_title = 'unknown'
-    for title, props in dvd_data['titles'].iteritems():
-        if 'main_feature' in props and props['main_feature']:
-            main_title = title
+    main_title = detectDVDMainFeature(dvd_data['titles'])
+    if main_title is None:
+        Error("No titles found on DVD in %s" % device)
+        return None
     
     if len(name1) > 0:
         name = name1
@@ -383,144 +600,218 @@ def ripDVD(device,
         name = name2
     else:
         name = "Unknown DVD" 
-    
+    title = dvd_data['titles'][main_title]
+    chapters = dvdChapterDurations(title)
+    fmt = dict((k, title[k]) for k in ('size', 'fps') if k in title)
+    fmt['interlaced'] = title.get('combing', False)
+    return (name, main_title, chapters, fmt)
+
+
+def backupDVD(device, stagingDir, procMgr=DFT_MGR, progress=None, space=None):
+    """Use makemkvcon to make a decrypted copy of the DVD in <device> (a 
+    VIDEO_TS folder) in <stagingDir>. This reads the disc at full speed, 
+    which is much faster than encoding from it. HandBrake can read the copy
+    in place of the disc, with the same title numbers.
+    
+    Returns the path of the copy, to be passed to encodeDVD(), or None."""
+    Msg("Copying DVD in %s to %s" % (device, stagingDir))
+    with reserve(space, stagingDir, DVD_MAX_BYTES, "copy of %s" % device,
+                 [stagingDir]):
+        procMgr.setStage('backup')
+        retcode, sout, serr = procMgr.callStreaming(
+                                 ["makemkvcon",
+                                  "-r",
+                                  "--progress=-same",
+                                  "backup",
+                                  "--decrypt",
+                                  "dev:%s" % device,
+                                  stagingDir],
+                                 lineHandler(progress, 'makemkvcon', 'backup'))
+    if retcode != 0 or \
+            not os.path.isdir(os.path.join(stagingDir, 'VIDEO_TS')):
+        Error("Failed to copy DVD in %s" % device)
+        Error("makemkvcon output (last lines):\n%s\n%s" % (sout, serr))
+        return None
+    return stagingDir
+
+
+def encodeDVD(source,
+              main_title,
+              name,
+              destDir,
+              tmpDir,
+              extraOptions=[],
+              procMgr=DFT_MGR,
+              progress=None,
+              space=None,
+              chapters=None,
+              segmentPolicy=None,
+              planner=None,
+              titleFormat=None):
+    """Use HandBrakeCLI to encode the title <main_title> (as returned by 
+    scanDVD()) of the DVD <source>, which is either a device or a copy made 
+    by backupDVD(). The result is moved to <destDir> once it is complete.
+    
+    If <segmentPolicy> (a segencode.SegmentPolicy) is given and <source> is
+    a copy, the title is encoded in segments split at its <chapters> (a list
+    of durations, as returned by scanDVD()), concurrently, and the segments
+    are joined into the same MP4 a whole encode would make. Encoding from 
+    the drive is never segmented; the segments would fight over the drive.
+    
+    A copy may be encoded by a remote worker, if the process manager has 
+    any (see ProcessManager.callEncoder()).
+    
+    If <planner> (an encplanner.EncodePlanner) is given, the x264 preset is
+    chosen by it, for a title of the <titleFormat> returned by scanDVD().
+    
+    Returns path of the encoded media file, or None."""
+    # a drive can't be sent to a worker
+    inputs = [source] if os.path.isdir(source) else None
+    segments = []
+    if segmentPolicy is not None and chapters and os.path.isdir(source):
+        segments = segmentPolicy.plan(chapters)
     tmpfile = uniquePath(os.path.join(tmpDir,"%s.mp4" % name)) 
     
     Msg("Ripping title %s of %s to %s" % (main_title, name, tmpDir))
     
-    retcode, sout, serr = procMgr.call(
-                               ['HandBrakeCLI',
-                                '-i', device,
-                                '-o', tmpfile] + extraOptions)
-    
-    if retcode != 0:
-        Error("HandBrake failed to rip title '%s' of disc '%s'" %
-               (main_title, name))
-        Error("HandBrake output:\n %s" % serr)
+    # we have already chosen the title; --main-feature would scan them all
+    # over again
+    extraOptions = [opt for opt in extraOptions if opt != '--main-feature']
+    cmd = ['HandBrakeCLI',
+           '-i', source,
+           '-t', str(dvdTitleNumber(main_title))] + extraOptions
+    fmt = titleFormat or {}
+    try:
+        # as HandBrake prints it, e.g. '23.976 fps'
+        fps = float(fmt['fps'].split()[0])
+    except (KeyError, IndexError, ValueError):
+        fps = None
+    if planner is not None:
+        # clips are not read from the drive; only rates measured before on
+        # copies can be used for it
+        preset = planner.choose(cmd, fmt.get('size'), sum(chapters or []),
+                                fps, procMgr, tmpDir, fmt.get('interlaced'),
+                                benchmark=os.path.isdir(source))
+        if preset is not None:
+            cmd = withPreset(cmd, preset)
+    
+    # segments (and the MKV they are joined into) are kept in a folder of
+    # their own, so that the reservation can count what is written there
+    segDir = os.path.join(tmpDir, 'segments')
+    if segments and not os.path.isdir(segDir):
+        os.makedirs(segDir)
+    
+    out_bytes = handbrakeOutputFootprint(extraOptions)
+    # segments and the MKV they are joined into exist at the same time, as
+    # do that MKV and its copy into the MP4
+    work_bytes = out_bytes * (2 if segments else 1)
+    mv_bytes = out_bytes * moveFootprint(destDir, tmpDir)
+    with reserveAll(space, [(tmpDir, work_bytes, [tmpfile, segDir]),
+                            (destDir, mv_bytes, ())], "encode of %s" % name):
+        procMgr.setStage('encode')
+        if segments:
+            if segmentedEncode(cmd, tmpfile, segments, segDir, procMgr,
+                               progress, inputs=inputs, fps=fps) is None:
+                Error("HandBrake failed to rip title '%s' of disc '%s'" %
+                       (main_title, name))
+                return None
+        else:
+            retcode, sout, serr = procMgr.callEncoder(
+                                   cmd + ['-o', tmpfile],
+                                   lineHandler(progress, 'HandBrakeCLI', 'encode'),
+                                   inputs,
+                                   [tmpfile])
+            if retcode != 0:
+                Error("HandBrake failed to rip title '%s' of disc '%s'" %
+                       (main_title, name))
+                Error("HandBrake output (last lines):\n %s" % serr)
+            
+                # autoripd will clear up the temp directory
+                return None
         
-        # autoripd will clear up the temp directory
-        return None
-    else:
         # move movie back to destination
         final_file = uniquePath(os.path.join(destDir, "%s.mp4" % name))
-        os.rename(tmpfile, final_file)
-        if ejectDisk:
-            # not process logged, but probably safe.
-            subp.call(['eject', device])
+        moveFile(tmpfile, final_file, progress)
         return os.path.abspath(final_file)
 
 
-#TODO: This fails on amadeus side 2
-def dvdDiscProperties(device, procMgr=DFT_MGR):
+def eject(device):
+    # not process logged, but probably safe.
+    subp.call(['eject', device])
+
+
+def dvdTitleNumber(title):
+    """Return the number of the title called <title> (e.g. 'title 3') in
+    the output of dvdDiscProperties()."""
+    return int(title.split()[-1])
+
+
+def detectDVDMainFeature(titles):
+    """Return the name of the title flagged as main feature by HandBrake's 
+    scan of a DVD, or else of the longest title. Returns None if there are no
+    titles."""
+    longest = None
+    longest_duration = -1
+    for title, props in titles.iteritems():
+        if not title.startswith('title'):
+            continue
+        if props.get('main_feature'):
+            return title
+        try:
+            duration = durationToSeconds(props.get('duration', '0'))
+        except ValueError:
+            duration = 0
+        if duration > longest_duration:
+            longest, longest_duration = title, duration
+    return longest
+
+
+def dvdDiscProperties(device, procMgr=DFT_MGR, timeout=None, discCache=None,
+                      minDuration=None):
     """Return the on-disc title, duration, chapters, audio tracks, subtitle 
-    tracks, etc. by parsing HandBrakeCLI output. Note that the reported disc 
-    title may not reflect the actual movie title (e.g., "SONY")."""
-    
-    properties = {'titles':{}}
-    
-    retcode, sout, serr = procMgr.call(
-                               ["HandBrakeCLI", 
-                                "-t", "0",
-                                "-i", device])
+    tracks, etc. by parsing HandBrakeCLI output (see hbscan). Note that the 
+    reported disc title may not reflect the actual movie title (e.g., 
+    "SONY"). Titles shorter than <minDuration> seconds are not scanned. 
+    Returns None
+    on error, or if the scan takes more than <timeout> seconds. If <discCache>
+    (a disccache.CachedDisc) holds the properties of this disc, the disc is not
+    scanned at all; otherwise the scan result is stored in it."""
+    
+    # scans with different minimum durations hold different titles
+    cache_kind = 'dvd' if minDuration is None else \
+                 'dvd-min%d' % int(minDuration)
+    if discCache is not None:
+        cached = discCache.load(cache_kind)
+        if cached is not None:
+            return cached
+    
+    scan_cmd = ["HandBrakeCLI", 
+                "-t", "0",
+                "-i", device]
+    if minDuration is not None:
+        scan_cmd += ["--min-duration", str(int(minDuration))]
+    
+    # why yes, it *does* print valid, normal-operations data to stderr! 
+    # it is parsed as it arrives; long scans are never held in memory
+    parser = ScanParser()
+    try:
+        retcode, sout, serr = procMgr.callStreaming(
+                                  scan_cmd, 
+                                  lambda src, line: parser.feed(line),
+                                  timeout=timeout)
+    except ProcessTimeout:
+        Error("Timed out reading DVD info from %s" % device)
+        return None
     if retcode != 0:
         Error("Unable to obtain DVD info from %s" % device)
-        Error("HandBrake output: %s \n\n %s" % (sout, serr))
+        Error("HandBrake output (last lines): %s \n\n %s" % (sout, serr))
         return None
+    if parser.errors:
+        Warn("Skipped %d unparseable line(s) of the scan of %s" % 
+             (parser.errors, device))
+    properties = parser.properties()
     
-    # data is hierarchical, delimited by indent.
-    # handbrake's data formatting is absolutely abysmal, thus parsing is also 
-    # ugly and complex.
-    
-    # top of this stack is current indent amt
-    indentStack = [0]
-    # top of this stack is what we add properties to
-    dictStack = [properties['titles']]
-    # top of this stack is the key (i.e. name) of our parent node
-    keyStack = ['']
-    
-    # why yes, it *does* print valid, normal-operations data to stderr!
-    for line in serr.splitlines():
-        if len(line.strip()) == 0:
-            # blank line
-            continue
-        if len(dictStack) <= 1:
-            # root-level properties
-            if 'DVD Title:' in line:
-                # example:
-                # libdvdnav: DVD Title: AMADEUS_SIDE_A_16X9_LB
-                properties['dvd_title'] = line.rsplit(":", 1)[1].strip()
-            elif 'DVD Title (Alternative):' in line:
-                properties['dvd_alt_title'] = line.rsplit(":", 1)[1].strip()
-            elif 'DVD Serial Number' in line:
-                properties['dvd_serial_number'] = line.rsplit(":", 1)[1].strip()
-        if line.strip().startswith('+'):
-            # a property tree node
-            
-            curIndent = getIndent(line) 
-            if curIndent > indentStack[-1]:
-                # we've descended into a child node
-                indentStack.append(curIndent)
-            else:
-                # we've popped back up to a parent node
-                while curIndent < indentStack[-1]:
-                    # pop stuff off the stacks
-                    del dictStack[-1]
-                    del keyStack[-1]
-                    del indentStack[-1]
-            
-            # try to get a key : value pair
-            # strip off the leading '  +'
-            trimline = line.lstrip(' +\t\r\n')
-            pair = map(str.strip, trimline.split(":",1))
-            if len(pair) == 1 and 'Main Feature' in pair[0]:
-                dictStack[-1]['main_feature'] = True
-                continue
-            elif 'track' in keyStack[-1]:
-                # a special case. this data is like: 
-                # 1, English (AC3) (5.1 ch) (iso639-2: eng), 48000Hz, 384000bps
-                # seriously, what is the logic behind this crap
-                key, val = map(str.strip, trimline.split(',', 1))
-            elif len(pair) == 2:
-                key, val = pair
-            else:
-                # I don't care what this stupid node is, it's not even labeled.
-                continue
-            
-            if len(val) == 0:
-                # a parent node. like: 'title 1:'
-                # create a new dict for us to add to 
-                newDict = {}
-                dictStack[-1][key] = newDict
-                dictStack.append(newDict)
-                keyStack.append(key)
-                continue
-            
-            # now handle the actual data
-            # special cases all over the place
-            if keyStack[-1] == 'chapters':
-                # data like:
-                #   cells 0->0, 93287 blocks, duration 00:04:48
-                datachunks = map(str.strip, val.split(','))
-                datapairs = map(str.split, datachunks)
-                val = {'cells' : datapairs[0][1],
-                       'blocks' : datapairs[1][0],
-                       'duration' : datapairs[2][1]}
-            elif key == 'size':
-                # data like: 
-                # size: 720x480, pixel aspect: 853/720, display aspect: 1.78, 23.976 fps
-                datachunks = trimline.split(",")
-                datapairs  = [map(str.strip, x.split(':')) for x in datachunks]
-                dictStack[-1][datapairs[0][0]] = datapairs[0][1]
-                dictStack[-1][datapairs[1][0]] = datapairs[1][1]
-                dictStack[-1][datapairs[2][0]] = datapairs[2][1]
-                dictStack[-1]['fps']           = datapairs[3][0]
-                continue
-            
-            # store data
-            dictStack[-1][key] = val
-        else:
-            # garbage data
-            continue
-    
+    if discCache is not None:
+        discCache.store(cache_kind, properties)
     return properties
 
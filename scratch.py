@@ -0,0 +1,162 @@
+"""
+scratch
+
+Placement of working directories and intermediate files on tiers of scratch
+storage (e.g. NVMe, a RAID array, tmpfs), each configured as:
+
+    {"path" : "/mnt/nvme/autoripd",   # root folder of the tier
+     "speed" : 2000,                  # throughput hint, MB/s
+     "capacityMB" : 100000,           # optional: most we may use
+     "maxFileMB" : 4000}              # optional: largest file to put there
+
+Working directories, which hold whole rips, go to the tier with the most
+room. Intermediate files go to the fastest tier which has room for them, so
+that the small, hot files of a remux (extracted subtitles and audio) land on
+fast storage while multi-GB transcodes go wherever they fit.
+"""
+
+import os
+import shutil
+import threading
+import collections
+
+from common_util import Babble, Warn, uniquePath
+from diskspace import fsFree
+
+
+class ScratchTier:
+    def __init__(self, cfg):
+        self.path     = os.path.abspath(cfg['path'])
+        self.speed    = cfg.get('speed', 0)
+        self.capacity = cfg.get('capacityMB')
+        self.maxFile  = cfg.get('maxFileMB')
+        if self.capacity is not None:
+            self.capacity <<= 20
+        if self.maxFile is not None:
+            self.maxFile <<= 20
+
+    def __str__(self):
+        return self.path
+
+
+class ScratchAllocator:
+    """Allocates scratch space from the tiers configured by <roots> (a list
+    of tier dictionaries, as above). If <space> (a diskspace.SpaceManager)
+    is given, every intermediate file of known size is reserved with it on
+    its tier, and space reserved by running jobs is not considered free."""
+
+    def __init__(self, roots, space=None):
+        self.tiers  = [ScratchTier(cfg) for cfg in roots]
+        self._space = space
+        self._lock  = threading.Lock()
+        # files allocated to each job: jobID -> [(tier path, path, bytes)]
+        self._alloc = collections.defaultdict(list)
+        # their reservations: jobID -> [ReservationSet]
+        self._rsvs  = collections.defaultdict(list)
+
+    def _allocated(self, tier):
+        return [(path, size) for allocs in self._alloc.itervalues()
+                for tpath, path, size in allocs if tpath == tier.path]
+
+    def _free(self, tier):
+        if not os.path.isdir(tier.path):
+            try:
+                os.makedirs(tier.path)
+            except OSError, err:
+                Warn("Scratch folder %s is unusable (%s)" % (tier.path, err))
+                return 0
+        if self._space is not None:
+            free = self._space.available(tier.path)
+        else:
+            # files allocated but not yet (fully) written are not free space,
+            # though statvfs() says they are
+            free = fsFree(tier.path) - sum(max(0, size - _written(path))
+                                     for path, size in self._allocated(tier))
+        if tier.capacity is not None:
+            used = sum(size for path, size in self._allocated(tier))
+            free = min(free, tier.capacity - used)
+        return free
+
+    def _rank(self, size, prefer):
+        """Return the tiers with room for a file of <size> bytes (which may
+        be None if not known), best first. <prefer> ranks the candidate
+        tiers, given (tier, free bytes)."""
+        candidates = []
+        for tier in self.tiers:
+            if size is not None and tier.maxFile is not None and \
+                    size > tier.maxFile:
+                continue
+            free = self._free(tier)
+            if size is None or free >= size:
+                candidates.append((prefer(tier, free), tier))
+        candidates.sort(reverse=True)
+        return [tier for rank, tier in candidates]
+
+    def workingDir(self, discID):
+        """Create and return a working directory for a job ripping <discID>,
+        on the tier with the most free space, or None if there are no usable
+        tiers."""
+        with self._lock:
+            tiers = self._rank(None, lambda tier, free: free)
+        if not tiers:
+            return None
+        wdir = uniquePath(os.path.join(tiers[0].path, "tmp.%s.ripdir" % discID))
+        os.makedirs(wdir)
+        return wdir
+
+    def filePath(self, jobID, wdir, name, size=None):
+        """Return a path for an intermediate file <name> of job <jobID>, of
+        (about) <size> bytes, on the fastest tier which has room for it, and
+        reserve the space there until cleanup(). If no tier has room, the
+        file goes in the job's working directory <wdir>, whose space is the
+        job's own business."""
+        with self._lock:
+            for tier in self._rank(size, lambda tier, free: tier.speed):
+                d = self.jobScratchDir(tier, jobID)
+                if not os.path.isdir(d):
+                    os.makedirs(d)
+                path = uniquePath(os.path.join(d, name))
+                if self._space is not None and size is not None:
+                    # don't wait for space; another tier (or the working
+                    # dir) will do
+                    rsv = self._space.reserveAll([(tier.path, size, [path])],
+                                                 "scratch of %s" % jobID,
+                                                 wait=False)
+                    if rsv is None:
+                        continue
+                    self._rsvs[jobID].append(rsv)
+                self._alloc[jobID].append((tier.path, path, size or 0))
+                Babble("Placing %s on scratch tier %s" % (name, tier))
+                return path
+        return uniquePath(os.path.join(wdir, name))
+
+    def jobScratchDir(self, tier, jobID):
+        return os.path.join(tier.path, "%s.scratch" % jobID)
+
+    def cleanup(self, jobID):
+        """Remove the intermediate files of <jobID> from all tiers, and
+        release the space reserved for them."""
+        with self._lock:
+            self._alloc.pop(jobID, None)
+            rsvs = self._rsvs.pop(jobID, [])
+        for tier in self.tiers:
+            d = self.jobScratchDir(tier, jobID)
+            if os.path.isdir(d):
+                shutil.rmtree(d, ignore_errors=True)
+        for rsv in rsvs:
+            rsv.release()
+
+
+def _written(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def scratchPath(allocator, wdir, name, size=None):
+    """As allocator.filePath() for the job working in <wdir>, but
+    <allocator> may be None, in which case the file goes in <wdir>."""
+    if allocator is None:
+        return uniquePath(os.path.join(wdir, name))
+    return allocator.filePath(os.path.basename(wdir), wdir, name, size)
@@ -0,0 +1,340 @@
+"""
+segencode
+
+Segmented encoding of a single title. One HandBrakeCLI process cannot keep a
+many-core machine busy, so the title is split at chapter boundaries into
+segments which are encoded concurrently, with identical encoder settings, and
+then appended losslessly into one MKV by mkvmerge (and copied into another
+container, such as MP4, by ffmpeg if need be). The joined file is checked
+against its segments and against the source title (duration and frame count)
+before it is accepted.
+"""
+
+import os
+import Queue
+import threading
+
+import jobsched
+from progress import lineHandler
+from common_util import Msg, Error, Babble, uniquePath
+
+
+# a joined file may be this many seconds longer or shorter than its segments
+JOIN_TOLERANCE = 1.0
+
+# ... and its segments this much shorter or longer than their chapters
+CHAPTER_TOLERANCE = 0.02
+
+
+###########################
+# Chapters                #
+###########################
+
+
+def _timestampToSeconds(ts):
+    """Convert a timestamp like 01:02:03.456 to seconds."""
+    secs = 0.
+    for part in ts.split(':'):
+        secs = secs * 60 + float(part)
+    return secs
+
+
+def dvdChapterDurations(title):
+    """Return the durations in seconds of the chapters of a DVD title, as
+    parsed by ripdisc.dvdDiscProperties(), in order."""
+    chapters = title.get('chapters', {})
+    durations = []
+    for num in sorted(chapters, key=int):
+        durations.append(_timestampToSeconds(chapters[num]['duration']))
+    return durations
+
+
+def mediaInfoChapterDurations(info):
+    """Return the durations in seconds of the chapters listed in the menu
+    track of <info> (as returned by ripdisc.mediaInfoData()), in order."""
+    starts = []
+    for track in info.get('tracks', []):
+        if track.get('type') == 'menu':
+            for ts in track.get('items', {}).itervalues():
+                try:
+                    starts.append(_timestampToSeconds(ts))
+                except ValueError:
+                    continue
+            break
+    if not starts:
+        return []
+    starts.sort()
+    ends = starts[1:] + [info.get('duration', 0) / 1000.]   # ms
+    return [max(end - start, 0.) for start, end in zip(starts, ends)]
+
+
+###########################
+# Planning                #
+###########################
+
+
+class Segment:
+    """Chapters <first> through <last> (numbered from 1) of a title, which
+    play for <duration> seconds."""
+
+    def __init__(self, index, first, last, duration):
+        self.index    = index
+        self.first    = first
+        self.last     = last
+        self.duration = duration
+
+    def __str__(self):
+        return "chapters %d-%d" % (self.first, self.last)
+
+
+class SegmentPolicy:
+    """How to split titles for segmented encoding: into at most <segments>
+    segments (by default, one per CPU), of at least <minDuration> seconds
+    each."""
+
+    def __init__(self, segments=None, minDuration=300):
+        if not segments:
+            try:
+                import multiprocessing
+                segments = multiprocessing.cpu_count()
+            except (ImportError, NotImplementedError):
+                segments = 1
+        self.segments    = segments
+        self.minDuration = minDuration
+
+    def plan(self, chapters):
+        """Return the Segments into which a title with chapters of the
+        durations <chapters> should be split, or [] if the title should not
+        be split."""
+        total = sum(chapters)
+        n = min(self.segments, len(chapters))
+        if self.minDuration:
+            n = min(n, int(total // self.minDuration))
+        if n < 2:
+            return []
+        # cut at the chapter boundary nearest to each of n equal shares
+        bounds = [sum(chapters[:j]) for j in xrange(len(chapters) + 1)]
+        cuts = [0]
+        for k in xrange(1, n):
+            target = total * k / n
+            later = xrange(cuts[-1] + 1, len(chapters))
+            if later:
+                cuts.append(min(later, key=lambda j: abs(bounds[j] - target)))
+        cuts.append(len(chapters))
+        segments = []
+        for a, b in zip(cuts, cuts[1:]):
+            if a < b:
+                segments.append(Segment(len(segments), a + 1, b,
+                                        bounds[b] - bounds[a]))
+        if len(segments) < 2:
+            return []
+        return segments
+
+
+def _segmentOptions(options, segment, total):
+    """Return HandBrake <options> for encoding <segment> of a title <total>
+    seconds long. A target size (-S) is shared among segments by duration;
+    everything else is left alone, so that all segments are encoded alike."""
+    options = list(options)
+    if '-S' in options and total > 0:
+        i = options.index('-S') + 1
+        size = float(options[i]) * segment.duration / total
+        options[i] = str(max(1, int(round(size))))
+    return options + ['-c', '%d-%d' % (segment.first, segment.last)]
+
+
+###########################
+# Encoding                #
+###########################
+
+
+def probeVideo(path, procMgr):
+    """Return (duration in seconds, frame count) of the first video track of
+    <path>, or None if mediainfo cannot tell."""
+    retcode, sout, serr = procMgr.call(
+                              ['mediainfo',
+                               '--Inform=Video;%Duration% %FrameCount%\\n',
+                               path])
+    if retcode != 0:
+        return None
+    fields = sout.strip().split('\n')[0].split()
+    try:
+        return (float(fields[0]) / 1000., int(float(fields[1])))
+    except (IndexError, ValueError):
+        return None
+
+
+def segmentedEncode(cmd, outfile, segments, workDir, procMgr, progress=None,
+                    stage='encode', workClass=jobsched.WORK_CPU, inputs=None,
+                    duration=None, fps=None):
+    """Encode the <segments> (as planned by SegmentPolicy.plan()) of a title
+    concurrently, each by HandBrakeCLI <cmd> (all arguments but the output
+    file and chapters), and join them into <outfile>, in the container its
+    extension names (MKV, unless it is e.g. '.mp4'). Segments are written 
+    to <workDir> and removed once joined. The progress of segment i is 
+    reported to <progress> as '<stage>-<i>'. If <inputs> (the files or 
+    folders read by <cmd>) are given, segments may be encoded by remote 
+    workers (see ProcessManager.callEncoder()).
+
+    The joined file must play for the <duration> (by default, the length 
+    of the segments' chapters) and, if <fps> is given, have the frame count
+    of the source title.
+
+    Returns <outfile>, or None on failure."""
+    total = sum(s.duration for s in segments)
+    if duration is None:
+        duration = total
+    base  = os.path.splitext(os.path.basename(outfile))[0]
+    jobID, parentStage = procMgr.jobContext()
+    failed = threading.Event()
+    queue  = Queue.Queue()
+    files  = {}
+    for seg in segments:
+        files[seg.index] = uniquePath(os.path.join(
+                               workDir, "%s.seg%02d.mkv" % (base, seg.index)))
+        queue.put(seg)
+
+    Msg("Encoding %s in %d segments" % (base, len(segments)))
+
+    def work():
+        procMgr.setJobContext(jobID, parentStage)
+        while not failed.is_set():
+            try:
+                seg = queue.get_nowait()
+            except Queue.Empty:
+                return
+            segStage = '%s-%d' % (stage, seg.index)
+            procMgr.setStage(segStage)
+            segcmd = _segmentOptions(cmd, seg, total) + \
+                     ['-o', files[seg.index]]
+            Babble("Encoding %s of %s: %s" % (seg, base, " ".join(segcmd)))
+            retcode, sout, serr = procMgr.callEncoder(
+                                      segcmd,
+                                      lineHandler(progress, 'HandBrakeCLI',
+                                                  segStage),
+                                      inputs,
+                                      [files[seg.index]],
+                                      workClass=workClass)
+            if retcode != 0 or not os.path.isfile(files[seg.index]):
+                Error("Encode of %s of %s failed:\n%s" % (seg, base, serr))
+                failed.set()
+
+    # each thread encodes one segment at a time; the scheduler's 'cpu'
+    # budget decides how many actually run at once
+    threads = [threading.Thread(target=work,
+                                name="segment-%s-%d" % (jobID, i))
+               for i in xrange(len(segments))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    procMgr.setStage(parentStage)
+
+    joined = outfile
+    if os.path.splitext(outfile)[1].lower() != '.mkv':
+        # mkvmerge only writes MKVs
+        joined = uniquePath(os.path.join(workDir, "%s.joined.mkv" % base))
+    try:
+        if failed.is_set():
+            return None
+        if joinSegments([files[s.index] for s in segments], joined,
+                        duration, procMgr, fps) is None:
+            return None
+        if joined == outfile:
+            return outfile
+        # the segments are no longer needed; make room for the copy
+        _remove(files.values())
+        return copyContainer(joined, outfile, procMgr)
+    finally:
+        _remove([f for f in files.values() + [joined] if f != outfile])
+
+
+def _remove(paths):
+    for f in paths:
+        if os.path.exists(f):
+            os.unlink(f)
+
+
+def joinSegments(segfiles, outfile, expectedDuration, procMgr, fps=None):
+    """Append the MKVs <segfiles> into <outfile> without re-encoding, and
+    check that the result is as long as its parts, and that both are about 
+    as long as the source title: <expectedDuration> seconds (and, if <fps> 
+    is given, <expectedDuration> * <fps> frames). Returns <outfile>, or 
+    None on failure."""
+    probes = [probeVideo(f, procMgr) for f in segfiles]
+    if None in probes:
+        Error("Could not measure the encoded segments of %s" % outfile)
+        return None
+    seg_duration = sum(p[0] for p in probes)
+    seg_frames   = sum(p[1] for p in probes)
+    if abs(seg_duration - expectedDuration) > \
+            max(JOIN_TOLERANCE, expectedDuration * CHAPTER_TOLERANCE):
+        Error("Segments of %s play for %.1fs; expected %.1fs" %
+              (outfile, seg_duration, expectedDuration))
+        return None
+
+    # mkvmerge appends files given as "a + b + c"
+    cmd = ['mkvmerge', '-o', outfile, segfiles[0]]
+    for f in segfiles[1:]:
+        cmd += ['+', f]
+    retcode, sout, serr = procMgr.call(cmd, workClass=jobsched.WORK_IO)
+    # mkvmerge returns 1 for warnings
+    if retcode not in (0, 1) or not os.path.isfile(outfile):
+        Error("Could not join the segments of %s:\n%s\n%s" %
+              (outfile, sout, serr))
+        return None
+
+    joined = probeVideo(outfile, procMgr)
+    if joined is None:
+        Error("Could not measure %s" % outfile)
+        return None
+    duration, frames = joined
+    if frames != seg_frames or \
+            abs(duration - seg_duration) > JOIN_TOLERANCE:
+        Error("%s has %d frames (%.1fs) but its segments have %d (%.1fs)" %
+              (outfile, frames, duration, seg_frames, seg_duration))
+        return None
+    if not _matchesSource(outfile, duration, frames, expectedDuration, fps):
+        return None
+    Msg("Joined %d segments into %s (%d frames, %.1fs)" %
+        (len(segfiles), outfile, frames, duration))
+    return outfile
+
+
+def _matchesSource(path, duration, frames, srcDuration, fps):
+    """Return whether <path>, which plays for <duration> seconds and has
+    <frames> frames, is about as long as a source of <srcDuration> seconds 
+    at <fps> frames per second (if known). Logs an error if not."""
+    tolerance = max(JOIN_TOLERANCE, srcDuration * CHAPTER_TOLERANCE)
+    if abs(duration - srcDuration) > tolerance:
+        Error("%s plays for %.1fs; the source title plays for %.1fs" %
+              (path, duration, srcDuration))
+        return False
+    if fps:
+        srcFrames = int(round(srcDuration * fps))
+        if abs(frames - srcFrames) > tolerance * fps:
+            Error("%s has %d frames; the source title has about %d" %
+                  (path, frames, srcFrames))
+            return False
+    return True
+
+
+def copyContainer(src, outfile, procMgr):
+    """Copy all streams (and chapters) of <src> into <outfile>, in the 
+    container its extension names, without re-encoding. Returns <outfile>, 
+    or None on failure."""
+    retcode, sout, serr = procMgr.call(['ffmpeg', '-nostdin', '-y',
+                                        '-i', src,
+                                        '-map', '0',
+                                        '-c', 'copy',
+                                        outfile],
+                                       workClass=jobsched.WORK_IO)
+    if retcode != 0 or not os.path.isfile(outfile):
+        Error("Could not copy %s into %s:\n%s" % (src, outfile, serr))
+        return None
+    before = probeVideo(src, procMgr)
+    after  = probeVideo(outfile, procMgr)
+    if before is None or after is None or before[1] != after[1]:
+        Error("%s does not have the frames of %s" % (outfile, src))
+        return None
+    return outfile
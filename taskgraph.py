@@ -0,0 +1,131 @@
+"""
+taskgraph
+
+Runs a set of interdependent tasks (e.g. the extraction and transcodes of the
+tracks of one file), each as soon as the tasks it depends on have finished,
+on a bounded pool of threads. When a task fails, the tasks still running are
+cancelled, so that the failure is not reported only after hours of work
+whose result would be thrown away.
+"""
+
+import threading
+import traceback
+
+from common_util import Error, Babble
+
+
+class Task:
+    def __init__(self, name, fn, args, deps):
+        self.name  = name
+        self.fn    = fn
+        self.args  = args
+        self.deps  = set(deps)
+        self.state = 'waiting'   # 'running', 'done', 'failed' or 'skipped'
+
+
+class TaskGraph:
+    """Tasks to be run at most <workers> at a time. If given, setup() is
+    called in each worker thread before it runs any task (e.g. to set the
+    job context of the thread), and cancel() is called (from the thread of
+    the failed task) when a task fails, to stop the tasks still running
+    (e.g. by cancelling their processes' job)."""
+
+    def __init__(self, workers, setup=None, cancel=None):
+        self.workers = max(1, workers)
+        self.setup   = setup
+        self.cancel  = cancel
+        self._tasks  = {}
+        self._order  = []
+        self._cond   = threading.Condition()
+        self._failed = False
+
+    def add(self, name, fn, args=(), deps=()):
+        """Add the task <name>, which calls fn(*args) once the tasks named in
+        <deps> have succeeded. The task fails if <fn> returns False or raises.
+        Returns <name>."""
+        for d in deps:
+            if d not in self._tasks:
+                raise ValueError("task %s depends on unknown task %s" %
+                                 (name, d))
+        self._tasks[name] = Task(name, fn, args, deps)
+        self._order.append(name)
+        return name
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def run(self):
+        """Run all the tasks, and return True if they all succeeded. Once a
+        task has failed, no further tasks are started, and those running are
+        cancelled if a cancel() was given; otherwise they are allowed to
+        finish, and the failure is reported only once they have."""
+        nthreads = min(self.workers, len(self._tasks))
+        threads = [threading.Thread(target=self._work, name="task-%d" % i)
+                   for i in xrange(nthreads)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        with self._cond:
+            for task in self._tasks.itervalues():
+                if task.state == 'waiting':
+                    task.state = 'skipped'
+            return not self._failed
+
+    def states(self):
+        """Return {task name : state}."""
+        with self._cond:
+            return dict((t.name, t.state) for t in self._tasks.itervalues())
+
+    def _next(self):
+        """Return the next task which may run, or None if there will be no
+        more. Called with the lock held; waits for running tasks to finish
+        if nothing is ready."""
+        while True:
+            if self._failed:
+                return None
+            waiting = False
+            for name in self._order:
+                task = self._tasks[name]
+                if task.state != 'waiting':
+                    continue
+                waiting = True
+                if all(self._tasks[d].state == 'done' for d in task.deps):
+                    task.state = 'running'
+                    return task
+            running = any(t.state == 'running'
+                          for t in self._tasks.itervalues())
+            if not waiting or not running:
+                return None
+            self._cond.wait()
+
+    def _work(self):
+        if self.setup is not None:
+            self.setup()
+        while True:
+            with self._cond:
+                task = self._next()
+            if task is None:
+                return
+            Babble("Starting task %s" % task.name)
+            try:
+                ok = task.fn(*task.args) is not False
+            except Exception:
+                if self._failed:
+                    # most likely cancelled, since another task failed
+                    Babble("Task %s stopped:\n%s" % (task.name,
+                                                     traceback.format_exc()))
+                else:
+                    Error("Task %s failed:\n%s" % (task.name,
+                                                   traceback.format_exc()))
+                ok = False
+            with self._cond:
+                task.state = 'done' if ok else 'failed'
+                first = not ok and not self._failed
+                if not ok:
+                    self._failed = True
+                self._cond.notify_all()
+            if first and self.cancel is not None:
+                Babble("Task %s failed; cancelling the others" % task.name)
+                self.cancel()